@@ -0,0 +1,267 @@
+import bisect
+import heapq
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from .models import Account, Follow
+
+GENERATION_KEY = "autocomplete:generation"
+# How often a worker compares its index with the shared generation
+GENERATION_CHECK_INTERVAL = 5
+# Prefixes this short match too many accounts to rank on every keystroke
+MEMO_PREFIX_LENGTH = 2
+
+
+def get_rebuild_interval():
+    return getattr(settings, "AUTOCOMPLETE_REBUILD_INTERVAL", 300)
+
+
+def bump_generation():
+    """Ask every worker to rebuild its index on its next lookup."""
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def account_keys(username, name):
+    """The lowercased prefixes an account can be found by."""
+    keys = {username.casefold()}
+    keys.update(word.casefold() for word in (name or "").split())
+    return keys
+
+
+def follower_counts(account_ids=None):
+    """Follower count of every followed account, or of ``account_ids``."""
+    follows = Follow.objects.all()
+    if account_ids is not None:
+        follows = follows.filter(following_id__in=account_ids)
+    return dict(
+        follows.values("following_id")
+        .annotate(total=Count("id"))
+        .values_list("following_id", "total")
+        .order_by()
+    )
+
+
+class AutocompleteIndex:
+    """
+    In-process prefix index of usernames and name words for @-mentions.
+
+    Keys live in a sorted list of ``(key, account_id)`` pairs, so a lookup
+    is a binary search for the first key with the prefix followed by a scan
+    of the matching range, ranked by follower count. Results of very short
+    prefixes are memoized until the next change.
+
+    The index is built once, by the first lookup, and then kept up to date
+    by the account and follow signals of this worker. Writes handled by
+    other workers are picked up by a rebuild, in a background thread, every
+    ``AUTOCOMPLETE_REBUILD_INTERVAL`` seconds or as soon as the shared
+    generation changes (see bump_generation). Changes signalled while a
+    build reads the database are applied again to the index it builds.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held for a whole build, so concurrent lookups build the index once
+        self._build_lock = threading.Lock()
+        # Changes signalled during a build, None when no build is running
+        self._changes = None
+        self._keys = []
+        self._account_keys = {}
+        self._usernames = {}
+        self._followers = {}
+        self._memo = {}
+        self._built_at = None
+        self._generation = None
+        self._checked_at = 0
+        self._rebuilding = False
+
+    def __len__(self):
+        return len(self._account_keys)
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    def build(self):
+        """Load every account and its follower count from the database."""
+        with self._build_lock:
+            self._build()
+
+    def _build(self):
+        with self._lock:
+            self._changes = []
+        try:
+            generation = cache.get(GENERATION_KEY)
+            followers = follower_counts()
+            keys = []
+            keys_by_account = {}
+            usernames = {}
+            for pk, username, name in Account.objects.values_list(
+                "id", "username", "name"
+            ):
+                keys_by_account[pk] = account_keys(username, name)
+                usernames[pk] = username.casefold()
+                keys.extend((key, pk) for key in keys_by_account[pk])
+            keys.sort()
+        except BaseException:
+            with self._lock:
+                self._changes = None
+            raise
+
+        with self._lock:
+            changes, self._changes = self._changes, None
+            self._keys = keys
+            self._account_keys = keys_by_account
+            self._usernames = usernames
+            self._followers = followers
+            self._memo = {}
+            self._built_at = time.monotonic()
+            self._generation = generation
+
+            # The database may have been read before or after each change
+            recount = set()
+            for change, pk, *args in changes:
+                if change == "account":
+                    self._update_account(pk, *args)
+                elif change == "remove":
+                    self._remove_account(pk)
+                else:
+                    recount.add(pk)
+            if recount:
+                # Follower deltas are not idempotent, the rows are counted again
+                self._followers.update(dict.fromkeys(recount, 0))
+                self._followers.update(follower_counts(recount))
+
+    def _rebuild_in_background(self):
+        def rebuild():
+            from django.db import connection
+
+            try:
+                self.build()
+            finally:
+                self._rebuilding = False
+                connection.close()
+
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(
+            target=rebuild, name="autocomplete-rebuild", daemon=True
+        ).start()
+
+    def ensure_fresh(self):
+        """Build the index if needed and start a rebuild when it is stale."""
+        if not self.is_built:
+            with self._build_lock:
+                # Another lookup may have built it meanwhile
+                if not self.is_built:
+                    self._build()
+            return
+
+        now = time.monotonic()
+        stale = now - self._built_at > get_rebuild_interval()
+        if not stale and now - self._checked_at > GENERATION_CHECK_INTERVAL:
+            self._checked_at = now
+            stale = cache.get(GENERATION_KEY) != self._generation
+        if stale:
+            # Keep answering from the current index meanwhile
+            self._rebuild_in_background()
+
+    def search(self, query, limit=5):
+        """
+        Return the ids of the accounts matching ``query``, best first.
+
+        Args:
+            query (str): What the user typed so far (a leading @ is ignored).
+            limit (int, optional): Maximum number of ids to return.
+
+        Returns:
+            list: Account ids ranked by follower count, then username.
+        """
+        prefix = query.strip().lstrip("@").casefold()
+        if not prefix:
+            return []
+        self.ensure_fresh()
+
+        with self._lock:
+            memo_key = (prefix, limit)
+            if memo_key in self._memo:
+                return self._memo[memo_key]
+
+            matches = set()
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while position < len(self._keys):
+                key, pk = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                matches.add(pk)
+                position += 1
+
+            ranked = heapq.nsmallest(
+                limit,
+                matches,
+                key=lambda pk: (-self._followers.get(pk, 0), self._usernames[pk], pk),
+            )
+            if len(prefix) <= MEMO_PREFIX_LENGTH:
+                self._memo[memo_key] = ranked
+            return ranked
+
+    def _record(self, *change):
+        if self._changes is not None:
+            self._changes.append(change)
+
+    def update_account(self, pk, username, name):
+        """Add an account or re-index its username and name."""
+        with self._lock:
+            self._record("account", pk, username, name)
+            if self.is_built:
+                self._update_account(pk, username, name)
+
+    def _update_account(self, pk, username, name):
+        with self._lock:
+            old_keys = self._account_keys.get(pk, set())
+            new_keys = account_keys(username, name)
+            if old_keys == new_keys:
+                return
+            for key in old_keys - new_keys:
+                self._remove_key(key, pk)
+            for key in new_keys - old_keys:
+                bisect.insort(self._keys, (key, pk))
+            self._account_keys[pk] = new_keys
+            self._usernames[pk] = username.casefold()
+            self._memo = {}
+
+    def remove_account(self, pk):
+        with self._lock:
+            self._record("remove", pk)
+            if self.is_built:
+                self._remove_account(pk)
+
+    def _remove_account(self, pk):
+        with self._lock:
+            for key in self._account_keys.pop(pk, ()):
+                self._remove_key(key, pk)
+            self._usernames.pop(pk, None)
+            self._followers.pop(pk, None)
+            self._memo = {}
+
+    def adjust_followers(self, pk, delta):
+        with self._lock:
+            self._record("followers", pk)
+            if not self.is_built:
+                return
+            self._followers[pk] = max(self._followers.get(pk, 0) + delta, 0)
+            self._memo = {}
+
+    def _remove_key(self, key, pk):
+        index = bisect.bisect_left(self._keys, (key, pk))
+        if index < len(self._keys) and self._keys[index] == (key, pk):
+            del self._keys[index]
+
+
+index = AutocompleteIndex()
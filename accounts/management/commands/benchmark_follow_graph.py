@@ -0,0 +1,107 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.graph import FollowGraph, np
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the memory and lookup throughput of the in-memory follow graph "
+        "on a synthetic graph. Nothing is read from or written to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--edges", type=int, default=10_000_000)
+        parser.add_argument("--accounts", type=int, default=1_000_000)
+        parser.add_argument(
+            "--popular",
+            type=float,
+            default=0.2,
+            help="Share of follows going to the top 1%% of accounts.",
+        )
+        parser.add_argument("--lookups", type=int, default=100_000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("The follow graph needs NumPy.")
+
+        rng = np.random.default_rng(options["seed"])
+        followers, following = self.synthetic_edges(rng, options)
+
+        graph = FollowGraph()
+        start = time.perf_counter()
+        graph.load(followers, following)
+        build = time.perf_counter() - start
+        stats = graph.as_dict()
+        self.stdout.write(
+            f"Graph: {stats['follows']} follows between {options['accounts']} "
+            f"accounts, built in {build:.2f}s"
+        )
+        self.stdout.write(
+            f"Memory: {stats['bytes'] / 2**20:.1f} MiB, "
+            f"{stats['bytes_per_follow']} bytes per follow"
+        )
+
+        lookups = options["lookups"]
+        pairs = rng.integers(0, options["accounts"], size=(lookups, 2)).tolist()
+        # Half of the checks hit an existing follow
+        picks = rng.integers(0, len(followers), size=lookups // 2)
+        pairs[: len(picks)] = np.column_stack(
+            [followers[picks], following[picks]]
+        ).tolist()
+        self.report(
+            "is_following", lambda pair: graph.is_following(*pair), pairs, lookups
+        )
+
+        accounts = rng.integers(0, options["accounts"], size=lookups // 10).tolist()
+        self.report("follower_ids", graph.follower_ids, accounts, len(accounts))
+        self.report(
+            "mutual_followers",
+            lambda pair: graph.mutual_followers(*pair),
+            pairs[: lookups // 10],
+            lookups // 10,
+        )
+
+        # Pending changes are answered from the overlay until the next rebuild
+        start = time.perf_counter()
+        for follower_id, following_id in pairs[: lookups // 10]:
+            graph.remove_follow(follower_id, following_id)
+            graph.add_follow(follower_id, following_id)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'update':>16}: {2 * (lookups // 10) / elapsed:,.0f} changes/s"
+            )
+        )
+
+    def synthetic_edges(self, rng, options):
+        edges, accounts = options["edges"], options["accounts"]
+        followers = rng.integers(0, accounts, size=edges)
+        following = rng.integers(0, accounts, size=edges)
+        popular = rng.random(edges) < options["popular"]
+        following[popular] = rng.integers(
+            0, max(1, accounts // 100), size=popular.sum()
+        )
+        keep = followers != following
+        return followers[keep], following[keep]
+
+    def report(self, name, lookup, arguments, count):
+        timings = []
+        start = time.perf_counter()
+        for argument in arguments:
+            started = time.perf_counter()
+            lookup(argument)
+            timings.append(time.perf_counter() - started)
+        elapsed = time.perf_counter() - start
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{name:>16}: {count / elapsed:,.0f} lookups/s, "
+                f"p50 {statistics.median(timings) * 1e6:.1f}us / "
+                f"p99 {p99 * 1e6:.1f}us"
+            )
+        )
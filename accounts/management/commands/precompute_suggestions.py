@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import suggestions
+from accounts.models import Account
+
+
+class Command(BaseCommand):
+    help = "Score and store the follow suggestions of every account"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--username",
+            action="append",
+            dest="usernames",
+            help="Only precompute the given account (can be repeated).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of accounts scored per sparse matrix product.",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=None, help="Suggestions stored per account."
+        )
+        parser.add_argument(
+            "--activity-days",
+            type=int,
+            default=None,
+            help="Days of posts counted as recent activity.",
+        )
+
+    def handle(self, *args, **options):
+        if suggestions.sparse is None:
+            raise CommandError("Precomputing suggestions needs NumPy and SciPy.")
+
+        account_ids = None
+        if options["usernames"]:
+            account_ids = Account.objects.filter(
+                username__in=options["usernames"]
+            ).values_list("pk", flat=True)
+
+        try:
+            stored = suggestions.precompute_suggestions(
+                account_ids,
+                batch_size=options["batch_size"],
+                limit=options["limit"],
+                activity_days=options["activity_days"],
+            )
+            self.stdout.write(
+                self.style.SUCCESS(f"Suggestions stored for {stored} accounts")
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
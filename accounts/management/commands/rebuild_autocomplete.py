@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.autocomplete import bump_generation
+from base.utils import cache_is_shared
+
+
+class Command(BaseCommand):
+    help = (
+        "Make every worker rebuild its username autocomplete index on its next "
+        "lookup. Run it periodically or after bulk account changes. The signal "
+        "reaches the workers through the cache, so it needs a shared backend."
+    )
+
+    def handle(self, *args, **options):
+        # A per-process cache would only signal this command's own process
+        if not cache_is_shared():
+            raise CommandError(
+                "The default cache is not shared between processes; configure "
+                "a shared backend (CACHE_BACKEND) to signal the workers."
+            )
+        try:
+            bump_generation()
+            self.stdout.write(
+                self.style.SUCCESS("Autocomplete index rebuild signalled")
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import Account
+from accounts.utils import sync_referral_points
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored referral points of every account"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--username",
+            action="append",
+            dest="usernames",
+            help="Only reconcile the given account (can be repeated).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of accounts per batch.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            queryset = Account.objects.all()
+            if options["usernames"]:
+                queryset = queryset.filter(username__in=options["usernames"])
+
+            changed = sync_referral_points(queryset, batch_size=options["batch_size"])
+
+            self.stdout.write(
+                self.style.SUCCESS(f"Points reconciled. Accounts corrected: {changed}")
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import Account
+from accounts.utils import recount_account_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored follower, following, post and referral counts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--username",
+            action="append",
+            dest="usernames",
+            help="Only repair the given account (can be repeated).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of accounts per batch.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            queryset = Account.objects.all()
+            if options["usernames"]:
+                queryset = queryset.filter(username__in=options["usernames"])
+
+            changed = recount_account_stats(queryset, batch_size=options["batch_size"])
+
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Account stats repaired. Accounts corrected: {changed}"
+                )
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:30
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_points(apps, schema_editor):
+    Account = apps.get_model("accounts", "Account")
+    Referral = Account.referred_accounts.through
+
+    # 10 points per referred account with a verified primary email
+    counts = (
+        Referral.objects.filter(
+            to_account__email_address__primary=True,
+            to_account__email_address__verified=True,
+        )
+        .values("from_account_id")
+        .annotate(total=Count("to_account_id", distinct=True))
+        .order_by()
+    )
+    Account.objects.update(points=0)
+    for row in counts:
+        Account.objects.filter(pk=row["from_account_id"]).update(points=row["total"] * 10)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_account_updated_at'),
+        ('dj_waanverse_auth', '0004_remove_resetpasswordcode_attempts'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_points, migrations.RunPython.noop),
+    ]
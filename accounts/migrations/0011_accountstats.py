@@ -0,0 +1,61 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_account_stats(apps, schema_editor):
+    Account = apps.get_model("accounts", "Account")
+    AccountStats = apps.get_model("accounts", "AccountStats")
+    Follow = apps.get_model("accounts", "Follow")
+    Post = apps.get_model("main", "Post")
+    Referral = Account.referred_accounts.through
+
+    def count_by(queryset, field):
+        rows = queryset.values(field).annotate(total=Count("id")).order_by()
+        return {row[field]: row["total"] for row in rows}
+
+    followers = count_by(Follow.objects.all(), "following_id")
+    following = count_by(Follow.objects.all(), "follower_id")
+    posts = count_by(Post.objects.filter(parent=None), "author_id")
+    referrals = count_by(Referral.objects.all(), "from_account_id")
+    AccountStats.objects.bulk_create(
+        [
+            AccountStats(
+                account_id=pk,
+                followers_count=followers.get(pk, 0),
+                following_count=following.get(pk, 0),
+                posts_count=posts.get(pk, 0),
+                referrals_count=referrals.get(pk, 0),
+            )
+            for pk in Account.objects.values_list("pk", flat=True)
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_backfill_points'),
+        ('main', '0014_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountStats',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('followers_count', models.PositiveIntegerField(default=0)),
+                ('following_count', models.PositiveIntegerField(default=0)),
+                ('posts_count', models.PositiveIntegerField(default=0)),
+                ('referrals_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['followers_count'], name='stats_followers_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_account_stats, migrations.RunPython.noop),
+    ]
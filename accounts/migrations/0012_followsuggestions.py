@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_accountstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FollowSuggestions',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='follow_suggestions', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('suggestions', models.JSONField(blank=True, default=list)),
+                ('computed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
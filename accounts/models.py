@@ -1,7 +1,6 @@
 import uuid
 
 from dj_waanverse_auth.signals import user_created_via_google
-from dj_waanverse_auth.utils import get_email_verification_status
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
@@ -12,6 +11,9 @@ from django.db import models, transaction
 from django.dispatch import receiver
 from django.templatetags.static import static
 from django.urls import reverse
+from django.utils import timezone
+
+POINTS_PER_VERIFIED_REFERRAL = 10
 
 
 class AccountManager(BaseUserManager):
@@ -88,6 +90,7 @@ class Account(AbstractBaseUser, PermissionsMixin):
     profile_image_url = models.URLField(blank=True, null=True)
     date_joined = models.DateTimeField(auto_now_add=True, verbose_name="Date joined")
     last_login = models.DateTimeField(auto_now=True, verbose_name="Last login")
+    updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
     tagline = models.CharField(max_length=255, blank=True, null=True)
@@ -110,6 +113,9 @@ class Account(AbstractBaseUser, PermissionsMixin):
 
     referral_code = models.CharField(max_length=255, blank=True, unique=True, null=True)
     referred_accounts = models.ManyToManyField("self", blank=True)
+    # POINTS_PER_VERIFIED_REFERRAL for every referred account with a verified
+    # email, kept up to date by accounts.utils.sync_referral_points
+    points = models.IntegerField(default=0)
 
     USERNAME_FIELD = "username"
     REQUIRED_FIELDS = ["email"]
@@ -156,9 +162,9 @@ class Account(AbstractBaseUser, PermissionsMixin):
 
     def follow(self, user):
         """Follow a user."""
-        if not self.is_following(user):
-            if user != self:
-                Follow.objects.create(follower=self, following=user)
+        if user != self:
+            # Checked against the table, the follow graph may lag behind
+            Follow.objects.get_or_create(follower=self, following=user)
 
     def unfollow(self, user):
         """Unfollow a user."""
@@ -166,6 +172,10 @@ class Account(AbstractBaseUser, PermissionsMixin):
 
     def is_following(self, user):
         """Check if the user is following another user."""
+        from .graph import follow_graph
+
+        if follow_graph.is_enabled:
+            return follow_graph.is_following(self.pk, user.pk)
         return Follow.objects.filter(follower=self, following=user).exists()
 
     def get_following(self):
@@ -180,19 +190,6 @@ class Account(AbstractBaseUser, PermissionsMixin):
             accounts_following__following=self
         )  # Updated related_name
 
-    @property
-    def points(self):
-        """Calculate points based on the email verification status of referred accounts."""
-        verified_referrals_count = 0
-
-        for account in self.referred_accounts.all():
-            # Use get_email_verification_status to check if the referred account is verified
-            if get_email_verification_status(account):
-                verified_referrals_count += 1
-
-        # Calculate points (assuming 10 points per verified referral)
-        return verified_referrals_count * 10
-
     @property
     def is_verified_account(self):
         return self.verified or self.verified_company
@@ -216,11 +213,67 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ("follower", "following")
+        indexes = [
+            # Follower and following lists, newest first (keyset pagination)
+            models.Index(
+                fields=["following", "-created_at", "-id"], name="follow_followers_idx"
+            ),
+            models.Index(
+                fields=["follower", "-created_at", "-id"], name="follow_following_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.follower} follows {self.following}"
 
 
+class AccountStats(models.Model):
+    """
+    Materialized profile counters of an account.
+
+    Kept up to date by the follow, post and referral signals, and repaired
+    by the repair_account_stats command.
+    """
+
+    account = models.OneToOneField(
+        Account, primary_key=True, related_name="stats", on_delete=models.CASCADE
+    )
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    # Top-level posts, as listed on the profile
+    posts_count = models.PositiveIntegerField(default=0)
+    referrals_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Finds the accounts above the timeline pull threshold
+            models.Index(fields=["followers_count"], name="stats_followers_idx"),
+        ]
+
+    def __str__(self):
+        return f"Stats of {self.account_id}"
+
+
+class FollowSuggestions(models.Model):
+    """
+    Accounts to suggest following, precomputed by precompute_suggestions.
+
+    ``suggestions`` holds ``[account_id, score]`` pairs, best first.
+    """
+
+    account = models.OneToOneField(
+        Account,
+        primary_key=True,
+        related_name="follow_suggestions",
+        on_delete=models.CASCADE,
+    )
+    suggestions = models.JSONField(default=list, blank=True)
+    computed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Suggestions for {self.account_id}"
+
+
 @receiver(user_created_via_google, dispatch_uid="handle_user_created_via_google")
 def handle_user_created_via_google(sender, user, user_info, **kwargs):
     try:
@@ -1,9 +1,74 @@
 from dj_waanverse_auth.serializers import SignupSerializer as WaanverseSignupSerializer
+from django.db import models, transaction
 from rest_framework import serializers
 
-from main.utils import get_image_hash, upload_profile_image
+from main.executor import MediaExecutorBusy, MediaTaskTimeout
+from main.uploads import (
+    UploadError,
+    claim_uploads,
+    discard_uploads,
+    store_uploads,
+    uploaded_sessions,
+)
+from main.utils import process_and_upload_images
 
-from .models import Account
+from .graph import follow_graph
+from .models import Account, AccountStats, Follow
+from .utils import STATS_FIELDS, count_account_stats
+
+
+def preload_account_stats(context, accounts):
+    """
+    Load the stored follower and following counts of many accounts at once.
+
+    The figures are stored in the serializer context, which nested
+    serializers share with their root, so BasicAccountSerializer picks them
+    up wherever the accounts are embedded. With an authenticated viewer in
+    the request, which of the accounts the viewer follows is loaded too.
+    Accounts already loaded are skipped, so the cost is a fixed number of
+    queries per call.
+
+    Args:
+        context (dict): The root serializer's context.
+        accounts (iterable): Account instances.
+    """
+    stats = context.setdefault("account_stats", {})
+    account_ids = {account.pk for account in accounts} - stats.keys()
+    if not account_ids:
+        return
+
+    stored = AccountStats.objects.in_bulk(account_ids)
+    # Accounts without a stats row yet are counted from the source tables
+    counted = count_account_stats(account_ids - stored.keys())
+    for pk in account_ids:
+        if pk in stored:
+            counts = {field: getattr(stored[pk], field) for field in STATS_FIELDS}
+        else:
+            counts = counted[pk]
+        stats[pk] = {
+            "followers": counts["followers_count"],
+            "following": counts["following_count"],
+        }
+
+    request = context.get("request")
+    if request and request.user.is_authenticated:
+        if follow_graph.is_enabled:
+            followed = follow_graph.followed_among(request.user.pk, account_ids)
+        else:
+            followed = Follow.objects.filter(
+                follower=request.user, following_id__in=account_ids
+            ).values_list("following_id", flat=True)
+        context.setdefault("viewer_following", set()).update(followed)
+
+
+class BasicAccountListSerializer(serializers.ListSerializer):
+    """Serialize a list of accounts with their figures preloaded in batch."""
+
+    def to_representation(self, data):
+        accounts = data.all() if isinstance(data, models.manager.BaseManager) else data
+        accounts = list(accounts)
+        preload_account_stats(self.context, accounts)
+        return super().to_representation(accounts)
 
 
 class BasicAccountSerializer(serializers.ModelSerializer):
@@ -14,6 +79,7 @@ class BasicAccountSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Account
+        list_serializer_class = BasicAccountListSerializer
         fields = [
             "username",
             "name",
@@ -30,6 +96,7 @@ class BasicAccountSerializer(serializers.ModelSerializer):
             "is_verified_account",
             "points",
         ]
+        read_only_fields = ["points"]
 
     def get_is_self(self, obj):
         request = self.context.get("request", None)
@@ -37,20 +104,44 @@ class BasicAccountSerializer(serializers.ModelSerializer):
             return obj == request.user
         return False
 
+    def get_preloaded(self, obj, key):
+        stats = self.context.get("account_stats", {}).get(obj.pk)
+        return stats[key] if stats else None
+
+    def get_stored_stats(self, obj):
+        try:
+            return obj.stats
+        except (AttributeError, AccountStats.DoesNotExist):
+            return None
+
     def get_is_following_account(self, obj):
         request = self.context.get("request", None)
 
         if request and request.user.is_authenticated:
+            if obj.pk in self.context.get("account_stats", {}):
+                return obj.pk in self.context.get("viewer_following", ())
             return request.user.is_following(obj) if isinstance(obj, Account) else False
         return False
 
     def get_followers(self, obj):
+        followers = self.get_preloaded(obj, "followers")
+        if followers is not None:
+            return followers
+        stats = self.get_stored_stats(obj)
+        if stats is not None:
+            return stats.followers_count
         try:
             return obj.get_followers().count()
         except Exception:
             return 0
 
     def get_following(self, obj):
+        following = self.get_preloaded(obj, "following")
+        if following is not None:
+            return following
+        stats = self.get_stored_stats(obj)
+        if stats is not None:
+            return stats.following_count
         try:
             return obj.get_following().count()
         except Exception:
@@ -58,6 +149,7 @@ class BasicAccountSerializer(serializers.ModelSerializer):
 
 
 class AccountSerializer(BasicAccountSerializer):
+    posts = serializers.SerializerMethodField()
     referrals = serializers.SerializerMethodField()
 
     class Meta(BasicAccountSerializer.Meta):
@@ -71,10 +163,20 @@ class AccountSerializer(BasicAccountSerializer):
             "date_joined",
             "website",
             "referral_code",
+            "posts",
             "referrals",
         ]
 
+    def get_posts(self, obj):
+        stats = self.get_stored_stats(obj)
+        if stats is not None:
+            return stats.posts_count
+        return obj.post_set.filter(parent=None).count()
+
     def get_referrals(self, obj):
+        stats = self.get_stored_stats(obj)
+        if stats is not None:
+            return stats.referrals_count
         return obj.referred_accounts.all().count()
 
 
@@ -94,8 +196,8 @@ class SignupSerializer(WaanverseSignupSerializer):
         # If a referral code was provided, apply referral logic
         if referral_code:
             referral = Account.objects.get(referral_code=referral_code)
+            # Points are synced by the referred_accounts m2m_changed receiver
             referral.referred_accounts.add(user)
-            referral.save()
 
         return user
 
@@ -109,6 +211,9 @@ class SignupSerializer(WaanverseSignupSerializer):
 class UpdateProfileSerializer(serializers.ModelSerializer):
     profile_image = serializers.ImageField(write_only=True, required=False)
     cover_image = serializers.ImageField(write_only=True, required=False)
+    # Upload sessions to use instead, see main.uploads
+    profile_image_upload = serializers.UUIDField(write_only=True, required=False)
+    cover_image_upload = serializers.UUIDField(write_only=True, required=False)
 
     class Meta:
         model = Account
@@ -118,54 +223,93 @@ class UpdateProfileSerializer(serializers.ModelSerializer):
             "location",
             "profile_image",
             "cover_image",
+            "profile_image_upload",
+            "cover_image_upload",
             "website",
             "tagline",
         ]
 
+    def validate(self, attrs):
+        for kind in ("profile", "cover"):
+            upload_id = attrs.pop(f"{kind}_image_upload", None)
+            if upload_id is None:
+                continue
+            try:
+                attrs[f"{kind}_image_session"] = uploaded_sessions(
+                    self.context["request"].user, [upload_id]
+                )[0]
+            except UploadError as e:
+                raise serializers.ValidationError({f"{kind}_image_upload": str(e)})
+        return attrs
+
     def update(self, instance, validated_data):
-        if "profile_image" in validated_data:
-            profile_image = validated_data.pop("profile_image")
-            if profile_image:
-                try:
-                    hash = get_image_hash(profile_image)
-                    instance.profile_image_hash = hash
-
-                    # Rewind the file pointer before uploading
-                    profile_image.seek(0)
-
-                    # Upload the image to Cloudinary
-                    url = upload_profile_image(
-                        file=profile_image,
-                        file_name=instance.username,
-                        folder="profiles",
-                        request=self.context.get("request"),
+        # Where each image is stored, replacing the previous one
+        places = {
+            "profile": (instance.username, "profiles"),
+            "cover": (f"cover_{instance.username}", "covers"),
+        }
+        sessions = {
+            kind: validated_data.pop(f"{kind}_image_session")
+            for kind in places
+            if f"{kind}_image_session" in validated_data
+        }
+        images = {}
+        for kind in places:
+            image = validated_data.pop(f"{kind}_image", None)
+            if image:
+                images[kind] = image
+
+        processed = {}
+        try:
+            if images:
+                # Decode, hash and upload both images in one go
+                processed.update(
+                    zip(
+                        images,
+                        process_and_upload_images(
+                            list(images.values()),
+                            folder=[places[kind][1] for kind in images],
+                            request=self.context.get("request"),
+                            file_names=[places[kind][0] for kind in images],
+                        ),
                     )
-                    instance.profile_image_url = url
-                except Exception as e:
-                    print(f"Error processing image: {e}")
-        if "cover_image" in validated_data:
-            cover_image = validated_data.pop("cover_image")
-            if cover_image:
-                try:
-                    hash = get_image_hash(cover_image)
-                    instance.cover_image_hash = hash
-
-                    # Rewind the file pointer before uploading
-                    cover_image.seek(0)
-
-                    # Upload the image to Cloudinary
-                    url = upload_profile_image(
-                        file=cover_image,
-                        file_name=f"cover_{instance.username}",
-                        folder="covers",
-                        request=self.context.get("request"),
+                )
+            if sessions:
+                # Direct uploads are processed where they are, see main.uploads
+                processed.update(
+                    zip(
+                        sessions,
+                        store_uploads(
+                            list(sessions.values()),
+                            folder=[places[kind][1] for kind in sessions],
+                            request=self.context.get("request"),
+                            file_names=[places[kind][0] for kind in sessions],
+                        ),
                     )
-                    instance.cover_image_url = url
-                except Exception as e:
-                    print(f"Error processing image: {e}")
+                )
+        except (MediaExecutorBusy, MediaTaskTimeout):
+            raise
+        except Exception:
+            raise serializers.ValidationError(
+                "An error occurred while uploading the images."
+            )
+        for kind, image in processed.items():
+            setattr(instance, f"{kind}_image_url", image["image_url"])
+            setattr(instance, f"{kind}_image_hash", image["image_hash"])
+
         # Update other fields
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
 
-        instance.save()
+        with transaction.atomic():
+            if sessions:
+                # Claimed with the save, so a session cannot be attached twice
+                # and one that failed to store can be attached again
+                try:
+                    claim_uploads(list(sessions.values()))
+                except UploadError as e:
+                    raise serializers.ValidationError(str(e))
+                upload_ids = [session.id for session in sessions.values()]
+                transaction.on_commit(lambda: discard_uploads(upload_ids))
+            instance.save()
         return instance
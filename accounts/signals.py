@@ -0,0 +1,121 @@
+from dj_waanverse_auth.models import EmailAddress
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .autocomplete import index as autocomplete_index
+from .graph import follow_graph
+from .models import Account, AccountStats, Follow
+from .utils import adjust_account_stats, recount_account_stats, sync_referral_points
+
+
+@receiver(post_save, sender=Account, dispatch_uid="index_account_for_autocomplete")
+def index_account(sender, instance, **kwargs):
+    pk, username, name = instance.pk, instance.username, instance.name
+    transaction.on_commit(lambda: autocomplete_index.update_account(pk, username, name))
+
+
+@receiver(post_delete, sender=Account, dispatch_uid="unindex_account_for_autocomplete")
+def unindex_account(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: autocomplete_index.remove_account(pk))
+
+
+@receiver(post_save, sender=Follow, dispatch_uid="rank_followed_for_autocomplete")
+def rank_followed_account(sender, instance, created, **kwargs):
+    if created:
+        following_id = instance.following_id
+        transaction.on_commit(
+            lambda: autocomplete_index.adjust_followers(following_id, 1)
+        )
+
+
+@receiver(post_delete, sender=Follow, dispatch_uid="rank_unfollowed_for_autocomplete")
+def rank_unfollowed_account(sender, instance, **kwargs):
+    following_id = instance.following_id
+    transaction.on_commit(lambda: autocomplete_index.adjust_followers(following_id, -1))
+
+
+@receiver(post_save, sender=Follow, dispatch_uid="add_follow_to_graph")
+def add_follow_to_graph(sender, instance, created, **kwargs):
+    if created and follow_graph.is_enabled:
+        edge = (instance.follower_id, instance.following_id)
+        transaction.on_commit(lambda: follow_graph.add_follow(*edge))
+
+
+@receiver(post_delete, sender=Follow, dispatch_uid="remove_follow_from_graph")
+def remove_follow_from_graph(sender, instance, **kwargs):
+    if follow_graph.is_enabled:
+        edge = (instance.follower_id, instance.following_id)
+        transaction.on_commit(lambda: follow_graph.remove_follow(*edge))
+
+
+# Account stats: follows are counted in the transaction that writes them
+
+
+@receiver(post_save, sender=Account, dispatch_uid="create_account_stats")
+def create_account_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        AccountStats.objects.get_or_create(account=instance)
+
+
+@receiver(post_save, sender=Follow, dispatch_uid="count_follow")
+def count_follow(sender, instance, created, **kwargs):
+    if created:
+        adjust_account_stats(instance.follower_id, following_count=1)
+        adjust_account_stats(instance.following_id, followers_count=1)
+
+
+@receiver(post_delete, sender=Follow, dispatch_uid="count_unfollow")
+def count_unfollow(sender, instance, **kwargs):
+    adjust_account_stats(instance.follower_id, following_count=-1)
+    adjust_account_stats(instance.following_id, followers_count=-1)
+
+
+# Referral points and counts: only the accounts a change touches are recounted
+
+
+def sync_points_on_commit(account_ids):
+    transaction.on_commit(
+        lambda: sync_referral_points(Account.objects.filter(pk__in=account_ids))
+    )
+
+
+def recount_referrals_on_commit(account_ids):
+    # The reverse rows of a symmetrical add are written after post_add
+    transaction.on_commit(
+        lambda: recount_account_stats(Account.objects.filter(pk__in=account_ids))
+    )
+
+
+@receiver(
+    m2m_changed,
+    sender=Account.referred_accounts.through,
+    dispatch_uid="sync_points_on_referral",
+)
+def sync_points_on_referral(sender, instance, action, pk_set, **kwargs):
+    if action == "pre_clear":
+        # The links are gone by post_clear, remember who was on the other side
+        instance._cleared_referral_ids = set(
+            instance.referred_accounts.values_list("pk", flat=True)
+        )
+    elif action == "post_clear":
+        account_ids = {instance.pk, *getattr(instance, "_cleared_referral_ids", ())}
+        sync_points_on_commit(account_ids)
+        recount_referrals_on_commit(account_ids)
+    elif action in ("post_add", "post_remove"):
+        # referred_accounts is symmetrical, both sides may gain or lose points
+        account_ids = {instance.pk, *(pk_set or ())}
+        sync_points_on_commit(account_ids)
+        recount_referrals_on_commit(account_ids)
+
+
+@receiver(post_save, sender=EmailAddress, dispatch_uid="sync_points_on_verification")
+def sync_points_on_verification(sender, instance, **kwargs):
+    sync_points_on_commit(
+        list(
+            Account.referred_accounts.through.objects.filter(
+                to_account_id=instance.user_id
+            ).values_list("from_account_id", flat=True)
+        )
+    )
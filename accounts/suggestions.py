@@ -0,0 +1,308 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from .models import AccountStats, Follow, FollowSuggestions
+from .utils import count_by
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # pragma: no cover - only needed to precompute
+    np = sparse = None
+
+# Weights of the signals a candidate is ranked by
+OVERLAP_WEIGHT = 1.0
+MUTUAL_WEIGHT = 0.5
+ACTIVITY_WEIGHT = 0.25
+# Neighbours of an account taken into account, so that the followers of a
+# very popular account do not blow up its batch
+MAX_NEIGHBOURS = 1000
+POPULAR_KEY = "popular"
+
+
+def get_suggestions_size():
+    return getattr(settings, "SUGGESTIONS_PER_ACCOUNT", 50)
+
+
+class SuggestionCache:
+    """
+    Per-process LRU cache of suggestion lists with a time to live.
+
+    Holds at most SUGGESTIONS_CACHE_SIZE lists, each for
+    SUGGESTIONS_CACHE_TTL seconds; the least recently used list is evicted
+    first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def ttl(self):
+        return getattr(settings, "SUGGESTIONS_CACHE_TTL", 300)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, "SUGGESTIONS_CACHE_SIZE", 10000)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+suggestion_cache = SuggestionCache()
+
+
+# Precomputation
+
+
+def follow_matrix():
+    """
+    Load the follow graph as a sparse adjacency matrix.
+
+    Returns:
+        tuple: ``(account_ids, matrix)``, where ``matrix[i, j]`` is 1 when
+        ``account_ids[i]`` follows ``account_ids[j]``.
+    """
+    rows = Follow.objects.values_list("follower_id", "following_id")
+    edges = np.fromiter(
+        (pk for row in rows.iterator(chunk_size=10000) for pk in row),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    account_ids, positions = np.unique(edges, return_inverse=True)
+    positions = positions.reshape(-1, 2)
+    matrix = sparse.csr_matrix(
+        (
+            np.ones(len(edges), dtype=np.float32),
+            (positions[:, 0], positions[:, 1]),
+        ),
+        shape=(len(account_ids), len(account_ids)),
+    )
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return account_ids, matrix
+
+
+def cap_rows(matrix, limit):
+    """Keep at most ``limit`` entries of every row of a CSR matrix."""
+    degrees = np.diff(matrix.indptr)
+    if not len(degrees) or degrees.max() <= limit:
+        return matrix
+    offsets = np.arange(matrix.nnz) - np.repeat(matrix.indptr[:-1], degrees)
+    keep = offsets < limit
+    indptr = np.zeros_like(matrix.indptr)
+    np.cumsum(np.minimum(degrees, limit), out=indptr[1:])
+    return sparse.csr_matrix(
+        (matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape
+    )
+
+
+def activity_boost(account_ids, days):
+    """``1 + ACTIVITY_WEIGHT * log(1 + posts)`` over the last ``days`` days."""
+    from main.models import Post
+
+    posts = count_by(
+        Post.objects.filter(created_at__gte=timezone.now() - timedelta(days=days)),
+        "author_id",
+    )
+    counts = np.zeros(len(account_ids), dtype=np.float32)
+    if posts:
+        authors = np.fromiter(posts.keys(), dtype=np.int64)
+        positions = np.searchsorted(account_ids, authors)
+        positions[positions == len(account_ids)] = 0
+        found = account_ids[positions] == authors
+        counts[positions[found]] = np.fromiter(posts.values(), dtype=np.float32)[found]
+    return 1 + ACTIVITY_WEIGHT * np.log1p(counts)
+
+
+def score_rows(following, followers, boost, rows, limit):
+    """
+    Rank the candidates of a batch of accounts.
+
+    A candidate scores OVERLAP_WEIGHT for every account followed by the
+    account that follows it (friends of friends) and MUTUAL_WEIGHT for every
+    follower the two accounts share, scaled by its recent activity. Accounts
+    already followed and the account itself are left out.
+
+    Args:
+        following (csr_matrix): Follow adjacency, rows follow columns.
+        followers (csr_matrix): Its transpose, with rows capped.
+        boost (ndarray): Activity multiplier of every column.
+        rows (ndarray): Row indices of the batch.
+        limit (int): Candidates to keep per row.
+
+    Returns:
+        list: ``(columns, scores)`` array pairs per row, best first.
+    """
+    followed = following[rows]
+    capped = cap_rows(followed, MAX_NEIGHBOURS)
+    scores = OVERLAP_WEIGHT * (capped @ following) + MUTUAL_WEIGHT * (
+        followers[rows] @ following
+    )
+    scores = scores.tocsr()
+
+    ranked = []
+    for offset, row in enumerate(rows):
+        start, end = scores.indptr[offset], scores.indptr[offset + 1]
+        columns = scores.indices[start:end]
+        values = scores.data[start:end] * boost[columns]
+        already = followed.indices[
+            followed.indptr[offset] : followed.indptr[offset + 1]
+        ]
+        keep = (columns != row) & ~np.isin(columns, already)
+        columns, values = columns[keep], values[keep]
+        if len(columns) > limit:
+            top = np.argpartition(-values, limit - 1)[:limit]
+            columns, values = columns[top], values[top]
+        # Best first, ties broken by the older account
+        order = np.lexsort((columns, -values))
+        ranked.append((columns[order], values[order]))
+    return ranked
+
+
+def precompute_suggestions(
+    account_ids=None, batch_size=500, limit=None, activity_days=None
+):
+    """
+    Score and store the follow suggestions of accounts.
+
+    The follow graph is loaded once as a sparse matrix and accounts are
+    scored in batches of sparse products, see score_rows.
+
+    Args:
+        account_ids (iterable, optional): Accounts to precompute (default:
+            every account in the follow graph).
+        batch_size (int, optional): Accounts scored per matrix product.
+        limit (int, optional): Suggestions stored per account.
+        activity_days (int, optional): Window of the activity signal.
+
+    Returns:
+        int: The number of accounts whose suggestions were stored.
+    """
+    if sparse is None:
+        raise ImproperlyConfigured("Precomputing suggestions needs NumPy and SciPy.")
+
+    limit = limit or get_suggestions_size()
+    if activity_days is None:
+        activity_days = getattr(settings, "SUGGESTIONS_ACTIVITY_DAYS", 14)
+
+    ids, following = follow_matrix()
+    followers = cap_rows(following.T.tocsr(), MAX_NEIGHBOURS)
+    boost = activity_boost(ids, activity_days)
+
+    rows = np.arange(len(ids))
+    if account_ids is not None:
+        wanted = np.fromiter(account_ids, dtype=np.int64)
+        rows = rows[np.isin(ids, wanted)]
+
+    stored = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start : start + batch_size]
+        now = timezone.now()
+        FollowSuggestions.objects.bulk_create(
+            [
+                FollowSuggestions(
+                    account_id=int(ids[row]),
+                    suggestions=[
+                        [int(ids[column]), round(float(score), 4)]
+                        for column, score in zip(columns, scores)
+                    ],
+                    computed_at=now,
+                )
+                for row, (columns, scores) in zip(
+                    batch, score_rows(following, followers, boost, batch, limit)
+                )
+            ],
+            update_conflicts=True,
+            unique_fields=["account"],
+            update_fields=["suggestions", "computed_at"],
+        )
+        stored += len(batch)
+    return stored
+
+
+# Online path: cache, then the stored row, never the graph
+
+
+def popular_account_ids():
+    """The most followed accounts, for accounts without suggestions yet."""
+    account_ids = suggestion_cache.get(POPULAR_KEY)
+    if account_ids is None:
+        account_ids = list(
+            AccountStats.objects.order_by("-followers_count", "account_id").values_list(
+                "account_id", flat=True
+            )[: get_suggestions_size()]
+        )
+        suggestion_cache.set(POPULAR_KEY, account_ids)
+    return account_ids
+
+
+def get_suggestions(account, limit=10):
+    """
+    Return the ids of up to ``limit`` accounts to suggest to ``account``.
+
+    Suggestions come from the per-process cache or the row stored by
+    precompute_suggestions, falling back to the most followed accounts.
+    Accounts followed since the suggestions were computed are skipped.
+    """
+    account_ids = suggestion_cache.get(account.pk)
+    if account_ids is None:
+        suggestions = (
+            FollowSuggestions.objects.filter(account=account)
+            .values_list("suggestions", flat=True)
+            .first()
+        )
+        account_ids = [pk for pk, _ in suggestions or ()]
+        suggestion_cache.set(account.pk, account_ids)
+    if not account_ids:
+        account_ids = popular_account_ids()
+
+    followed = set(
+        Follow.objects.filter(
+            follower=account, following_id__in=account_ids
+        ).values_list("following_id", flat=True)
+    )
+    return [pk for pk in account_ids if pk not in followed and pk != account.pk][:limit]
@@ -1,3 +1,469 @@
-from django.test import TestCase
+import importlib
+import json
+import math
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from dj_waanverse_auth.models import EmailAddress
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from main.models import Post
+
+from .autocomplete import AutocompleteIndex
+from .graph import FollowGraph
+from .models import (
+    POINTS_PER_VERIFIED_REFERRAL,
+    Account,
+    AccountStats,
+    Follow,
+    FollowSuggestions,
+)
+from .suggestions import ACTIVITY_WEIGHT, get_suggestions, suggestion_cache
+
+
+class FollowListTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.account = Account.objects.create_user("owner@example.com", "owner")
+        self.followers = []
+        for index in range(5):
+            follower = Account.objects.create_user(
+                f"follower{index}@example.com", f"follower{index}"
+            )
+            follower.follow(self.account)
+            self.followers.append(follower)
+        # Ties on when the follow happened are broken by id
+        Follow.objects.filter(following=self.account).update(
+            created_at=Follow.objects.filter(following=self.account).first().created_at
+        )
+
+    def get_list(self, interaction_type="followers", **params):
+        return self.client.get(
+            reverse("account_interactions", args=[interaction_type, "owner"]), params
+        )
+
+    def usernames(self, data):
+        return [account["username"] for account in data["results"]]
+
+    def test_followers_are_paginated_most_recent_first(self):
+        expected = list(
+            Follow.objects.filter(following=self.account)
+            .order_by("-created_at", "-id")
+            .values_list("follower__username", flat=True)
+        )
+
+        first = self.get_list(page_size=2).data
+        self.assertIsNone(first["previous"])
+        seen = self.usernames(first)
+        page = first
+        while page["next"]:
+            page = self.get_list(page_size=2, cursor=page["next"]).data
+            seen += self.usernames(page)
+
+        self.assertEqual(seen, expected)
+        second = self.get_list(page_size=2, cursor=first["next"]).data
+        back = self.get_list(page_size=2, cursor=second["previous"]).data
+        self.assertEqual(self.usernames(back), self.usernames(first))
+
+    def test_following_lists_the_followed_accounts(self):
+        self.account.follow(self.followers[0])
+
+        data = self.get_list("following").data
+
+        self.assertEqual(self.usernames(data), ["follower0"])
+        self.assertIsNone(data["next"])
+
+    def test_mutual_keeps_accounts_that_follow_back(self):
+        self.account.follow(self.followers[1])
+        self.account.follow(self.followers[3])
+
+        data = self.get_list(mutual="true").data
+
+        self.assertEqual(sorted(self.usernames(data)), ["follower1", "follower3"])
+
+    def test_streamed_page_matches_the_regular_page(self):
+        response = self.get_list(stream="true", page_size=3)
+
+        self.assertEqual(response["Content-Type"], "application/json")
+        streamed = json.loads(b"".join(response.streaming_content))
+        regular = self.get_list(page_size=3).data
+        self.assertEqual(self.usernames(streamed), self.usernames(regular))
+        self.assertEqual(streamed["next"], regular["next"])
+        self.assertIsNone(streamed["previous"])
+
+        rest = json.loads(
+            b"".join(
+                self.get_list(stream="true", cursor=streamed["next"]).streaming_content
+            )
+        )
+        self.assertEqual(len(rest["results"]), 2)
+        self.assertIsNone(rest["next"])
+        self.assertIsNotNone(rest["previous"])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get_list("friends").status_code, 400)
+        self.assertEqual(self.get_list(cursor="not-a-cursor").status_code, 404)
+        first = self.get_list(page_size=2).data
+        second = self.get_list(page_size=2, cursor=first["next"]).data
+        # Streamed pages only move forward
+        response = self.get_list(stream="true", cursor=second["previous"])
+        self.assertEqual(response.status_code, 404)
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = Account.objects.create_user("alice@example.com", "alice")
+        self.alex = Account.objects.create_user("alex@example.com", "alex")
+        self.bob = Account.objects.create_user(
+            "bob@example.com", "bob", name="Bob Alvarez"
+        )
+        self.carol = Account.objects.create_user("carol@example.com", "carol")
+        self.carol.follow(self.alex)
+        self.index = AutocompleteIndex()
+
+    def test_prefix_matches_usernames_and_name_words(self):
+        # Most followed first, then by username
+        self.assertEqual(
+            self.index.search("al"), [self.alex.pk, self.alice.pk, self.bob.pk]
+        )
+        self.assertEqual(self.index.search("@ALI"), [self.alice.pk])
+        self.assertEqual(self.index.search("alv"), [self.bob.pk])
+        self.assertEqual(self.index.search("al", limit=1), [self.alex.pk])
+        self.assertEqual(self.index.search("zed"), [])
+        self.assertEqual(self.index.search("@"), [])
+
+    def test_incremental_add_rename_and_remove(self):
+        self.index.build()
+
+        self.index.update_account(99, "alfred", "")
+        self.index.adjust_followers(99, 2)
+        self.assertEqual(self.index.search("al")[0], 99)
+        self.index.update_account(self.alice.pk, "zoe", "Zoe")
+        self.assertEqual(self.index.search("zo"), [self.alice.pk])
+        self.assertNotIn(self.alice.pk, self.index.search("al"))
+        self.index.remove_account(self.alex.pk)
+        self.assertEqual(self.index.search("al"), [99, self.bob.pk])
+
+    def test_signals_update_the_index_on_commit(self):
+        self.index.build()
+
+        with mock.patch("accounts.signals.autocomplete_index", self.index):
+            with self.captureOnCommitCallbacks(execute=True):
+                dave = Account.objects.create_user("dave@example.com", "alvin")
+            self.assertIn(dave.pk, self.index.search("alv"))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.carol.follow(self.alice)
+                self.bob.follow(self.alice)
+            self.assertEqual(self.index.search("al")[0], self.alice.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                dave.delete()
+            self.assertNotIn(dave.pk, self.index.search("alv"))
+
+    def test_changes_made_during_a_build_are_kept(self):
+        self.alice.follow(self.bob)
+        self.carol.follow(self.bob)
+        accounts = Account.objects.values_list
+
+        def read_accounts(*fields):
+            rows = list(accounts(*fields))
+            # Committed after the snapshot, signalled before the swap
+            Account.objects.filter(pk=self.alice.pk).update(username="zoe")
+            self.index.update_account(self.alice.pk, "zoe", "")
+            # Already counted, but only signalled now
+            self.index.adjust_followers(self.alex.pk, 1)
+            return rows
+
+        with mock.patch.object(Account.objects, "values_list", read_accounts):
+            self.index.build()
+
+        self.assertEqual(self.index.search("zo"), [self.alice.pk])
+        self.assertEqual(self.index.search("ali"), [])
+        # The late follow is counted again rather than applied twice
+        self.assertEqual(self.index.search("al"), [self.bob.pk, self.alex.pk])
+
+    def test_concurrent_first_lookups_build_once(self):
+        builds = []
+
+        def build():
+            builds.append(None)
+            time.sleep(0.05)
+            self.index._built_at = time.monotonic()
+
+        with mock.patch.object(self.index, "_build", build):
+            threads = [
+                threading.Thread(target=self.index.ensure_fresh) for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(builds), 1)
+
+
+class ReferralPointsTests(TestCase):
+    def setUp(self):
+        self.referrer = Account.objects.create_user("referrer@example.com", "referrer")
+        self.verified = Account.objects.create_user("verified@example.com", "verified")
+        self.pending = Account.objects.create_user("pending@example.com", "pending")
+
+    def refer(self):
+        self.referrer.referred_accounts.add(self.verified, self.pending)
+        EmailAddress.objects.create(
+            user=self.verified, email=self.verified.email, verified=True, primary=True
+        )
+        EmailAddress.objects.create(
+            user=self.pending, email=self.pending.email, verified=False, primary=True
+        )
+
+    def points(self):
+        return dict(Account.objects.values_list("username", "points"))
+
+    def test_verified_referrals_earn_points(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.refer()
+
+        self.assertEqual(
+            self.points(),
+            {"referrer": POINTS_PER_VERIFIED_REFERRAL, "verified": 0, "pending": 0},
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            EmailAddress.objects.filter(user=self.pending).update(verified=True)
+            # update() sends no signal, the verification view saves the row
+            EmailAddress.objects.get(user=self.pending).save()
+
+        self.assertEqual(self.points()["referrer"], 2 * POINTS_PER_VERIFIED_REFERRAL)
+
+    def test_backfill_migration_counts_verified_referrals(self):
+        # Without the on-commit signals the points are never synced
+        self.refer()
+        self.assertEqual(self.points()["referrer"], 0)
+
+        migration = importlib.import_module("accounts.migrations.0010_backfill_points")
+        migration.backfill_points(apps, None)
+
+        self.assertEqual(
+            self.points(),
+            {"referrer": POINTS_PER_VERIFIED_REFERRAL, "verified": 0, "pending": 0},
+        )
+
+    def test_reconcile_corrects_drifted_points(self):
+        self.refer()
+        Account.objects.update(points=5)
+        out = StringIO()
+
+        call_command("reconcile_points", username=["pending"], stdout=out)
+        self.assertEqual(self.points(), {"referrer": 5, "verified": 5, "pending": 0})
+        self.assertIn("Accounts corrected: 1", out.getvalue())
+
+        call_command("reconcile_points", batch_size=1, stdout=out)
+        self.assertEqual(
+            self.points(),
+            {"referrer": POINTS_PER_VERIFIED_REFERRAL, "verified": 0, "pending": 0},
+        )
+        self.assertIn("Accounts corrected: 2", out.getvalue())
+
+
+class AccountStatsTests(TestCase):
+    def setUp(self):
+        self.alice = Account.objects.create_user("alice@example.com", "alice")
+        self.bob = Account.objects.create_user("bob@example.com", "bob")
+
+    def stats(self, account):
+        stats = AccountStats.objects.get(account=account)
+        return (
+            stats.followers_count,
+            stats.following_count,
+            stats.posts_count,
+            stats.referrals_count,
+        )
+
+    def test_counters_follow_writes(self):
+        self.alice.follow(self.bob)
+        self.assertEqual(self.stats(self.alice), (0, 1, 0, 0))
+        self.assertEqual(self.stats(self.bob), (1, 0, 0, 0))
+        # Following twice is a single follow
+        self.alice.follow(self.bob)
+        self.assertEqual(self.stats(self.bob), (1, 0, 0, 0))
+
+        post = Post.objects.create(author=self.alice, content="Hello")
+        # Replies are not listed on the profile
+        Post.objects.create(author=self.alice, content="Reply", parent=post)
+        self.assertEqual(self.stats(self.alice), (0, 1, 1, 0))
+
+        self.alice.unfollow(self.bob)
+        post.delete()
+        self.assertEqual(self.stats(self.alice), (0, 0, 0, 0))
+        self.assertEqual(self.stats(self.bob), (0, 0, 0, 0))
+
+    def test_repair_recounts_drifted_and_missing_stats(self):
+        self.alice.follow(self.bob)
+        Post.objects.create(author=self.bob, content="Hello")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.referred_accounts.add(self.bob)
+        AccountStats.objects.filter(account=self.alice).update(
+            following_count=7, referrals_count=0
+        )
+        AccountStats.objects.filter(account=self.bob).delete()
+        out = StringIO()
+
+        call_command("repair_account_stats", stdout=out)
+
+        self.assertEqual(self.stats(self.alice), (0, 1, 0, 1))
+        self.assertEqual(self.stats(self.bob), (1, 0, 1, 1))
+        self.assertIn("Accounts corrected: 2", out.getvalue())
+        call_command("repair_account_stats", stdout=out)
+        self.assertIn("Accounts corrected: 0", out.getvalue())
+
+
+@override_settings(FOLLOW_GRAPH_ENABLED=True)
+class FollowGraphTests(TestCase):
+    FOLLOWS = [(0, 1), (0, 2), (1, 0), (2, 1), (3, 1), (3, 2), (4, 5), (5, 1)]
+
+    def setUp(self):
+        self.accounts = [
+            Account.objects.create_user(f"user{index}@example.com", f"user{index}")
+            for index in range(6)
+        ]
+        for follower, following in self.FOLLOWS:
+            self.accounts[follower].follow(self.accounts[following])
+        self.graph = FollowGraph()
+
+    def assert_matches_database(self):
+        ids = [account.pk for account in self.accounts]
+        follows = set(Follow.objects.values_list("follower_id", "following_id"))
+        for follower_id in ids:
+            for following_id in ids:
+                self.assertEqual(
+                    self.graph.is_following(follower_id, following_id),
+                    (follower_id, following_id) in follows,
+                )
+            followers = {a for a, b in follows if b == follower_id}
+            self.assertEqual(
+                self.graph.follower_ids(follower_id).tolist(), sorted(followers)
+            )
+            for other_id in ids:
+                mutual = followers & {a for a, b in follows if b == other_id}
+                self.assertEqual(
+                    self.graph.mutual_followers(follower_id, other_id).tolist(),
+                    sorted(mutual),
+                )
+
+    def test_lookups_match_the_database(self):
+        self.assert_matches_database()
+        user0, user1, user2, user3, *_ = self.accounts
+        self.assertEqual(
+            self.graph.followed_among(user3.pk, [user0.pk, user1.pk, user2.pk]),
+            {user1.pk, user2.pk},
+        )
+
+    def test_follows_are_applied_on_commit(self):
+        self.graph.build()
+        user0, user1, user2, *_ = self.accounts
+
+        with mock.patch("accounts.signals.follow_graph", self.graph):
+            with self.captureOnCommitCallbacks(execute=True):
+                user2.follow(user0)
+                user0.unfollow(user1)
+                user1.follow(user2)
+                user1.unfollow(user2)
+
+        self.assertEqual(len(self.graph), Follow.objects.count())
+        self.assert_matches_database()
+        # A rebuild picks up the same follows
+        self.graph.build()
+        self.assert_matches_database()
+
+    def test_account_is_following_uses_the_graph(self):
+        user0, user1, *_ = self.accounts
+
+        with mock.patch("accounts.graph.follow_graph", self.graph):
+            with self.assertNumQueries(1):
+                self.assertTrue(user0.is_following(user1))
+            with self.assertNumQueries(0):
+                self.assertFalse(user1.is_following(self.accounts[2]))
+
+    def test_benchmark_runs_on_a_small_graph(self):
+        out = StringIO()
+
+        call_command(
+            "benchmark_follow_graph", edges=2000, accounts=200, lookups=100, stdout=out
+        )
+
+        self.assertIn("is_following", out.getvalue())
+        self.assertIn("mutual_followers", out.getvalue())
+
+
+class SuggestionTests(APITestCase):
+    def setUp(self):
+        suggestion_cache.clear()
+        self.me, self.a, self.b, self.c, self.d, self.x = [
+            Account.objects.create_user(f"{username}@example.com", username)
+            for username in ["me", "a", "b", "c", "d", "x"]
+        ]
+        for follower, followed in [
+            (self.me, [self.a, self.b]),
+            (self.a, [self.c, self.d, self.me]),
+            (self.b, [self.c]),
+            (self.x, [self.me, self.c]),
+        ]:
+            for account in followed:
+                follower.follow(account)
+
+    def stored(self, account):
+        return FollowSuggestions.objects.get(account=account).suggestions
+
+    def test_friends_of_friends_and_shared_followers_are_ranked(self):
+        Post.objects.create(author=self.d, content="Hello")
+        out = StringIO()
+
+        call_command("precompute_suggestions", username=["me"], stdout=out)
+
+        # c: followed by a and b, and by x and a who follow me
+        # d: followed by a, and by a who follows me, with one recent post
+        self.assertEqual(
+            self.stored(self.me),
+            [
+                [self.c.pk, 3.0],
+                [self.d.pk, round(1.5 * (1 + ACTIVITY_WEIGHT * math.log(2)), 4)],
+            ],
+        )
+        self.assertIn("Suggestions stored for 1 accounts", out.getvalue())
+        self.assertFalse(FollowSuggestions.objects.exclude(account=self.me).exists())
+
+    def test_followed_accounts_and_self_are_not_suggested(self):
+        call_command("precompute_suggestions", limit=10, stdout=StringIO())
+
+        for account in Account.objects.all():
+            followed = set(
+                Follow.objects.filter(follower=account).values_list(
+                    "following_id", flat=True
+                )
+            )
+            suggested = {pk for pk, _ in self.stored(account)}
+            self.assertNotIn(account.pk, suggested)
+            self.assertFalse(suggested & followed)
+
+        # Follows made since the precompute are skipped when serving
+        self.me.follow(self.c)
+        self.assertEqual(get_suggestions(self.me), [self.d.pk])
+
+    def test_accounts_without_suggestions_get_popular_accounts(self):
+        self.client.force_authenticate(self.b)
+
+        response = self.client.get(reverse("account_suggestions"))
+
+        # Most followed first, minus b itself and the accounts it follows
+        self.assertEqual(
+            [account["username"] for account in response.data],
+            ["me", "a", "d", "x"],
+        )
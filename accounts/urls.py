@@ -2,6 +2,7 @@ from django.urls import path
 
 from .views import (
     account_interactions,
+    account_suggestions,
     basic_user_info,
     update_profile,
     user_account_action,
@@ -11,6 +12,7 @@ from .views import (
 
 urlpatterns = [
     path("users", user_list, name="user_list"),
+    path("suggestions", account_suggestions, name="account_suggestions"),
     path("users/<str:username>", user_detail, name="user_detail"),
     path("update", update_profile, name="update"),
     path("peep/<str:username>", basic_user_info, name="peep"),
@@ -0,0 +1,192 @@
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import POINTS_PER_VERIFIED_REFERRAL, Account, AccountStats, Follow
+
+STATS_FIELDS = ("followers_count", "following_count", "posts_count", "referrals_count")
+
+
+def count_by(queryset, field):
+    return dict(
+        queryset.values(field)
+        .annotate(total=Count("id"))
+        .values_list(field, "total")
+        .order_by()
+    )
+
+
+def verified_referral_counts(account_ids):
+    """
+    Count the referred accounts with a verified primary email of each account.
+
+    Returns:
+        dict: Counts keyed by account id (accounts without any are left out).
+    """
+    return dict(
+        Account.referred_accounts.through.objects.filter(
+            from_account_id__in=account_ids,
+            to_account__email_address__primary=True,
+            to_account__email_address__verified=True,
+        )
+        .values("from_account_id")
+        .annotate(total=Count("to_account_id", distinct=True))
+        .values_list("from_account_id", "total")
+        .order_by()
+    )
+
+
+def sync_referral_points(queryset=None, batch_size=1000):
+    """
+    Bring the stored points of accounts in line with their verified referrals.
+
+    Called with the few accounts a referral or an email verification
+    affects, and in bulk by the reconcile_points command. Only accounts
+    whose points changed are written.
+
+    Args:
+        queryset (QuerySet, optional): Accounts to update (default: all).
+        batch_size (int, optional): Accounts per batch.
+
+    Returns:
+        int: The number of accounts whose points changed.
+    """
+    from main.cache import bump_account_version
+
+    if queryset is None:
+        queryset = Account.objects.all()
+
+    accounts = queryset.order_by("pk").values_list("pk", "points")
+    changed = 0
+    last_pk = 0
+    while True:
+        batch = list(accounts.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        counts = verified_referral_counts([pk for pk, _ in batch])
+        now = timezone.now()
+        stale = [
+            Account(
+                pk=pk,
+                points=counts.get(pk, 0) * POINTS_PER_VERIFIED_REFERRAL,
+                updated_at=now,
+            )
+            for pk, points in batch
+            if points != counts.get(pk, 0) * POINTS_PER_VERIFIED_REFERRAL
+        ]
+        Account.objects.bulk_update(stale, ["points", "updated_at"])
+        changed += len(stale)
+
+        # Points are part of every cached account card
+        stale_ids = [account.pk for account in stale]
+        transaction.on_commit(lambda ids=stale_ids: bump_account_version(*ids))
+
+    return changed
+
+
+def adjust_account_stats(account_id, **deltas):
+    """
+    Add ``deltas`` to the stored counters of an account.
+
+    The change is a single UPDATE relative to the stored value, so
+    concurrent follows or posts never overwrite each other, and counters
+    never go below zero. Accounts without a stats row are left alone; the
+    repair_account_stats command creates it.
+
+    Example:
+        adjust_account_stats(account.pk, followers_count=1)
+    """
+    updates = {
+        field: Greatest(F(field) + delta, 0) for field, delta in deltas.items() if delta
+    }
+    if updates:
+        AccountStats.objects.filter(account_id=account_id).update(**updates)
+
+
+def count_account_stats(account_ids):
+    """
+    Count the followers, following, top-level posts and referrals of accounts.
+
+    Returns:
+        dict: ``{account_id: {field: count}}`` for every id in ``account_ids``.
+    """
+    from main.models import Post
+
+    Referral = Account.referred_accounts.through
+    counts = {
+        "followers_count": count_by(
+            Follow.objects.filter(following_id__in=account_ids), "following_id"
+        ),
+        "following_count": count_by(
+            Follow.objects.filter(follower_id__in=account_ids), "follower_id"
+        ),
+        "posts_count": count_by(
+            Post.objects.filter(author_id__in=account_ids, parent=None), "author_id"
+        ),
+        "referrals_count": count_by(
+            Referral.objects.filter(from_account_id__in=account_ids),
+            "from_account_id",
+        ),
+    }
+    return {
+        pk: {field: counts[field].get(pk, 0) for field in STATS_FIELDS}
+        for pk in account_ids
+    }
+
+
+def recount_account_stats(queryset=None, batch_size=1000):
+    """
+    Recompute the stored counters of accounts from the source tables.
+
+    Missing stats rows are created and rows that drifted are rewritten;
+    accounts whose counters are right are not written.
+
+    Args:
+        queryset (QuerySet, optional): Accounts to repair (default: all).
+        batch_size (int, optional): Accounts per batch.
+
+    Returns:
+        int: The number of accounts whose stats were created or changed.
+    """
+    from main.cache import bump_account_version
+
+    if queryset is None:
+        queryset = Account.objects.all()
+
+    account_ids = queryset.order_by("pk").values_list("pk", flat=True)
+    changed = 0
+    last_pk = 0
+    while True:
+        batch = list(account_ids.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1]
+
+        counts = count_account_stats(batch)
+        stored = AccountStats.objects.in_bulk(batch)
+        missing = [
+            AccountStats(account_id=pk, **counts[pk])
+            for pk in batch
+            if pk not in stored
+        ]
+        stale = []
+        for pk, stats in stored.items():
+            if any(
+                getattr(stats, field) != counts[pk][field] for field in STATS_FIELDS
+            ):
+                for field in STATS_FIELDS:
+                    setattr(stats, field, counts[pk][field])
+                stale.append(stats)
+        # A row created concurrently is already counting, keep it
+        AccountStats.objects.bulk_create(missing, ignore_conflicts=True)
+        AccountStats.objects.bulk_update(stale, STATS_FIELDS)
+        changed += len(missing) + len(stale)
+
+        repaired_ids = [stats.account_id for stats in missing + stale]
+        if repaired_ids:
+            transaction.on_commit(lambda ids=repaired_ids: bump_account_version(*ids))
+
+    return changed
@@ -1,10 +1,15 @@
+from django.db.models import Exists, OuterRef
 from django.shortcuts import get_object_or_404
 from rest_framework import generics, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
-from accounts.models import Account
+from accounts.autocomplete import index as autocomplete_index
+from accounts.models import Account, Follow
+from accounts.suggestions import get_suggestions
+from base.utils import KeysetPagination, not_modified_response, validated_response
+from main.cache import account_etag
 
 from .serializers import (
     AccountSerializer,
@@ -22,7 +27,10 @@ class UserList(generics.ListAPIView):
         username = self.request.query_params.get("username", None)
 
         if username:
-            return Account.objects.filter(username__icontains=username)[:5]
+            # Matching and ranking happen in memory, only the hits are loaded
+            account_ids = autocomplete_index.search(username, limit=5)
+            accounts = Account.objects.in_bulk(account_ids)
+            return [accounts[pk] for pk in account_ids if pk in accounts]
         return Account.objects.none()
 
 
@@ -32,7 +40,7 @@ user_list = UserList.as_view()
 class UserDetail(generics.RetrieveAPIView):
     permission_classes = [AllowAny]
     serializer_class = AccountSerializer
-    queryset = Account.objects.all()
+    queryset = Account.objects.select_related("stats")
     lookup_field = "username"
 
     def get_serializer_context(self):
@@ -41,6 +49,19 @@ class UserDetail(generics.RetrieveAPIView):
         context.update({"request": self.request})
         return context
 
+    def retrieve(self, request, *args, **kwargs):
+        account = self.get_object()
+
+        # Answer conditional requests before doing any serialization
+        etag = account_etag(account, request.user)
+        if etag is not None:
+            not_modified = not_modified_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
+        serializer = self.get_serializer(account)
+        return validated_response(request, serializer.data, etag)
+
 
 user_detail = UserDetail.as_view()
 
@@ -69,11 +90,18 @@ def update_profile(request):
 def basic_user_info(request, username):
     try:
         user = Account.objects.get(username=username)
-        serializer = BasicAccountSerializer(user, context={"request": request})
-        return Response(data=serializer.data, status=status.HTTP_200_OK)
     except Exception:
         return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
+    etag = account_etag(user, request.user, extra=("basic",))
+    if etag is not None:
+        not_modified = not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+    serializer = BasicAccountSerializer(user, context={"request": request})
+    return validated_response(request, serializer.data, etag)
+
 
 @api_view(["POST"])
 def user_account_action(request, action, username):
@@ -101,25 +129,84 @@ def user_account_action(request, action, username):
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+# The Follow field pointing at the account whose list it is, and the one
+# pointing at the listed accounts
+FOLLOW_LIST_FIELDS = {
+    "followers": ("following", "follower"),
+    "following": ("follower", "following"),
+}
+
+
 @api_view(["GET"])
 def account_interactions(request, interaction_type, username):
+    """
+    The followers or followed accounts of an account, most recent first.
+
+    Pages are keyset paginated on when the follow happened (``cursor`` and
+    ``page_size``). ``mutual=true`` keeps the accounts that follow each
+    other with this account, and ``stream=true`` streams pages of up to
+    10000 accounts for exports.
+    """
     user_account = get_object_or_404(Account, username=username)
 
-    if interaction_type not in ["following", "followers"]:
+    if interaction_type not in FOLLOW_LIST_FIELDS:
         return Response({"error": "Invalid type"}, status=status.HTTP_400_BAD_REQUEST)
 
-    try:
-        if interaction_type == "following":
-            accounts = user_account.get_following()
-        elif interaction_type == "followers":
-            accounts = user_account.get_followers()
-
-        serializer = BasicAccountSerializer(
-            accounts, many=True, context={"request": request}
+    owner_field, listed_field = FOLLOW_LIST_FIELDS[interaction_type]
+    follows = Follow.objects.filter(**{owner_field: user_account}).select_related(
+        listed_field
+    )
+    if request.query_params.get("mutual") in ("1", "true"):
+        follows = follows.filter(
+            Exists(
+                Follow.objects.filter(
+                    follower=OuterRef("following"), following=OuterRef("follower")
+                )
+            )
         )
-        return Response(serializer.data, status=status.HTTP_200_OK)
 
-    except Exception:
+    def serialize(page):
+        # A fresh context per chunk keeps streamed exports flat in memory
+        return BasicAccountSerializer(
+            [getattr(follow, listed_field) for follow in page],
+            many=True,
+            context={"request": request},
+        ).data
+
+    paginator = KeysetPagination()
+    if request.query_params.get("stream") in ("1", "true"):
+        return paginator.stream_page(follows, request, serialize)
+
+    page = paginator.paginate_queryset(follows, request)
+    return paginator.get_paginated_response(serialize(page))
+
+
+SUGGESTIONS_DEFAULT_LIMIT = 10
+SUGGESTIONS_MAX_LIMIT = 50
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def account_suggestions(request):
+    """
+    Accounts the viewer may want to follow, best first.
+
+    Served from precomputed suggestions (see precompute_suggestions), so the
+    follow graph is never walked while answering.
+    """
+    try:
+        limit = int(request.GET.get("limit", SUGGESTIONS_DEFAULT_LIMIT))
+    except ValueError:
         return Response(
-            {"error": "Something went wrong"}, status=status.HTTP_400_BAD_REQUEST
+            {"error": "limit must be an integer."}, status=status.HTTP_400_BAD_REQUEST
         )
+    limit = max(1, min(limit, SUGGESTIONS_MAX_LIMIT))
+
+    account_ids = get_suggestions(request.user, limit=limit)
+    accounts = Account.objects.in_bulk(account_ids)
+    serializer = BasicAccountSerializer(
+        [accounts[pk] for pk in account_ids if pk in accounts],
+        many=True,
+        context={"request": request},
+    )
+    return Response(serializer.data, status=status.HTTP_200_OK)
@@ -178,3 +178,101 @@ WAANVERSE_AUTH = {
 
 ADMIN_ENABLED = os.environ.get("ADMIN_ENABLED", "False").lower() == "true"
 ADMIN_URL = os.environ.get("ADMIN_URL", "admin")
+
+
+# Home timeline (fan-out-on-write)
+TIMELINE_MAX_ENTRIES = int(os.environ.get("TIMELINE_MAX_ENTRIES", 800))
+TIMELINE_BACKFILL_SIZE = int(os.environ.get("TIMELINE_BACKFILL_SIZE", 50))
+TIMELINE_FANOUT_BATCH_SIZE = 1000
+# Seconds between background trims of timelines over TIMELINE_MAX_ENTRIES
+TIMELINE_TRIM_INTERVAL = int(os.environ.get("TIMELINE_TRIM_INTERVAL", 300))
+# Authors with at least this many followers are merged in at read time
+TIMELINE_PULL_FOLLOWER_THRESHOLD = int(
+    os.environ.get("TIMELINE_PULL_FOLLOWER_THRESHOLD", 10000)
+)
+TIMELINE_PULL_AUTHORS_TTL = 300
+
+
+# Cache. Use a shared backend (e.g. Redis) in multi-worker deployments:
+# the post payload cache is off with a per-process backend, and
+# autocomplete rebuilds (rebuild_autocomplete) need it to reach every worker.
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    }
+}
+
+# Viewer-independent post payloads (main.cache): None caches them only with
+# a shared cache backend, True or False forces the cache on or off
+POST_PAYLOAD_CACHE = None
+POST_PAYLOAD_CACHE_TIMEOUT = int(os.environ.get("POST_PAYLOAD_CACHE_TIMEOUT", 300))
+
+# Write-behind post view counter (main.counters.view_counter): seconds
+# between flushes, and pending posts that trigger an early flush
+POST_VIEW_FLUSH_INTERVAL = float(os.environ.get("POST_VIEW_FLUSH_INTERVAL", 10))
+POST_VIEW_BUFFER_SIZE = int(os.environ.get("POST_VIEW_BUFFER_SIZE", 1000))
+
+# Shared media executor (main.executor): threads per process, calls that
+# may wait for a thread before uploads are rejected with a 429, and seconds
+# the uploads or deletions of one call may take, from when they are queued
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 8))
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", 64))
+MEDIA_TASK_TIMEOUT = int(os.environ.get("MEDIA_TASK_TIMEOUT", 30))
+
+# Worker processes per process for BlurHash encoding (main.executor.hash_executor),
+# which shares the queue size and timeout above
+BLURHASH_PROCESSES = int(os.environ.get("BLURHASH_PROCESSES", 2))
+
+# Widths of the responsive variants made of every post image (main.utils),
+# comma separated
+IMAGE_VARIANT_WIDTHS = [
+    int(width)
+    for width in os.environ.get("IMAGE_VARIANT_WIDTHS", "320,640,1080").split(",")
+]
+
+# Image backend of main.utils: "local" storage, the stand-in used to run
+# everything on one machine, or "cloudinary"; unset, local in DEBUG mode
+IMAGE_BACKEND = os.environ.get("IMAGE_BACKEND", "")
+
+# Database-backed job outbox (main.jobs, run workers with `manage.py run_jobs`):
+# whether post images upload and deleted media go away in the background,
+# runs before a job fails, first retry delay and its cap in seconds, seconds
+# a worker may hold a job before it runs again, and days done jobs are kept
+MEDIA_JOBS_ENABLED = os.environ.get("MEDIA_JOBS_ENABLED", "False").lower() == "true"
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", 10))
+JOB_RETRY_MAX_DELAY = int(os.environ.get("JOB_RETRY_MAX_DELAY", 3600))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 300))
+JOB_RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", 7))
+# Directory shared by API and job workers where uploads wait for their job
+MEDIA_STAGING_ROOT = os.environ.get(
+    "MEDIA_STAGING_ROOT", os.path.join(BASE_DIR, "media_staging")
+)
+
+# Direct-to-storage upload sessions (main.uploads): seconds a session and its
+# signed upload target stay valid, and the largest upload in bytes
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 600))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 20 * 1024 * 1024))
+
+# Seconds between rebuilds of each worker's username autocomplete index
+AUTOCOMPLETE_REBUILD_INTERVAL = int(
+    os.environ.get("AUTOCOMPLETE_REBUILD_INTERVAL", 300)
+)
+
+# In-memory follow graph for relationship checks (accounts.graph, needs
+# NumPy), and seconds between rebuilds of each worker's copy
+FOLLOW_GRAPH_ENABLED = os.environ.get("FOLLOW_GRAPH_ENABLED", "False").lower() == "true"
+FOLLOW_GRAPH_REBUILD_INTERVAL = int(
+    os.environ.get("FOLLOW_GRAPH_REBUILD_INTERVAL", 600)
+)
+
+# "Who to follow" (accounts.suggestions): suggestions stored per account by
+# precompute_suggestions, days of posts counted as recent activity, and the
+# per-process cache in front of the stored suggestions
+SUGGESTIONS_PER_ACCOUNT = 50
+SUGGESTIONS_ACTIVITY_DAYS = 14
+SUGGESTIONS_CACHE_TTL = int(os.environ.get("SUGGESTIONS_CACHE_TTL", 300))
+SUGGESTIONS_CACHE_SIZE = int(os.environ.get("SUGGESTIONS_CACHE_SIZE", 10000))
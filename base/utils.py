@@ -1,5 +1,21 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import hashlib
+import json
+from datetime import datetime
+from itertools import islice
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 
 
 class CustomPageNumberPagination(PageNumberPagination):
@@ -22,3 +38,262 @@ class CustomPageNumberPagination(PageNumberPagination):
         if not self.page.has_previous():
             return None
         return self.page.previous_page_number()
+
+
+def encode_cursor(payload):
+    """Encode a JSON-serializable payload as an opaque, URL-safe cursor."""
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor, or raise ValueError."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opaque-cursor pagination keyed on ``(created_at, id)``, newest first.
+
+    Each page is a single indexed range query: no COUNT(*) and no OFFSET, so
+    the cost of a page does not depend on how deep it is. Views can override
+    the key with a ``cursor_fields`` attribute, e.g. ``("date_joined", "id")``.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    max_stream_page_size = 10000
+    cursor_query_param = "cursor"
+    cursor_fields = ("created_at", "id")
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        queryset, position, reverse = self.get_page_queryset(queryset, request, view)
+
+        # Fetch one extra row to know whether there is a further page
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = has_more if not reverse else position is not None
+        self.has_previous = position is not None if not reverse else has_more
+        self.page = results
+        return results
+
+    def get_page_queryset(self, queryset, request, view=None):
+        """Order ``queryset`` on the key and start it at the request's cursor."""
+        self.time_field, self.id_field = getattr(
+            view, "cursor_fields", self.cursor_fields
+        )
+
+        position, reverse = self.get_position(request)
+        if reverse:
+            ordering = (self.time_field, self.id_field)
+        else:
+            ordering = (f"-{self.time_field}", f"-{self.id_field}")
+        queryset = queryset.order_by(*ordering)
+
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(position, reverse))
+        return queryset, position, reverse
+
+    def get_page_size(self, request, max_page_size=None):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, max_page_size or self.max_page_size))
+
+    def get_position(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            payload = decode_cursor(cursor)
+            position = (datetime.fromisoformat(payload["t"]), int(payload["i"]))
+            return position, bool(payload.get("r", False))
+        except (KeyError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_keyset_filter(self, position, reverse):
+        timestamp, pk = position
+        lookup = "gt" if reverse else "lt"
+        return Q(**{f"{self.time_field}__{lookup}": timestamp}) | Q(
+            **{self.time_field: timestamp, f"{self.id_field}__{lookup}": pk}
+        )
+
+    def get_cursor(self, instance, reverse=False):
+        payload = {
+            "t": getattr(instance, self.time_field).isoformat(),
+            "i": getattr(instance, self.id_field),
+        }
+        if reverse:
+            payload["r"] = True
+        return encode_cursor(payload)
+
+    def get_next_cursor(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.get_cursor(self.page[-1])
+
+    def get_previous_cursor(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.get_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_cursor(),
+                "previous": self.get_previous_cursor(),
+                "results": data,
+            }
+        )
+
+    def stream_page(self, queryset, request, serialize, view=None, chunk_size=500):
+        """
+        Stream one page as JSON, for pages too large to build in memory.
+
+        Rows are read with a database cursor and passed to ``serialize``
+        ``chunk_size`` at a time, so memory use does not grow with the page
+        size (up to ``max_stream_page_size``). The body has the same keys as
+        get_paginated_response, with the cursors written after the results.
+        Streamed pages only move forward.
+
+        Args:
+            queryset (QuerySet): The rows to paginate.
+            request (Request): Carries the cursor and page size.
+            serialize (callable): Turns a list of rows into a list of
+                JSON-serializable items.
+
+        Returns:
+            StreamingHttpResponse: The page, as ``application/json``.
+        """
+        self.page_size = self.get_page_size(request, self.max_stream_page_size)
+        queryset, position, reverse = self.get_page_queryset(queryset, request, view)
+        if reverse:
+            raise NotFound(self.invalid_cursor_message)
+        encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+        def chunks():
+            rows = queryset[: self.page_size + 1].iterator(chunk_size=chunk_size)
+            first = last = None
+            count = 0
+            has_more = False
+            yield '{"results":['
+            while chunk := list(islice(rows, chunk_size)):
+                # The extra row only tells whether there is a further page
+                if count + len(chunk) > self.page_size:
+                    has_more = True
+                    chunk = chunk[: self.page_size - count]
+                    if not chunk:
+                        break
+                separator = "," if count else ""
+                count += len(chunk)
+                first = first or chunk[0]
+                last = chunk[-1]
+                items = ",".join(encoder.encode(item) for item in serialize(chunk))
+                yield separator + items
+
+            next_cursor = self.get_cursor(last) if has_more else None
+            previous_cursor = None
+            if position is not None and first is not None:
+                previous_cursor = self.get_cursor(first, reverse=True)
+            yield (
+                f'],"next":{encoder.encode(next_cursor)},'
+                f'"previous":{encoder.encode(previous_cursor)}}}'
+            )
+
+        return StreamingHttpResponse(chunks(), content_type="application/json")
+
+
+class SelectablePaginationMixin:
+    """
+    Let clients pick the pagination style of a list view.
+
+    Page-number pagination stays the default; ``?pagination=cursor`` (or any
+    request carrying a ``cursor``) switches the view to KeysetPagination so
+    clients can move over endpoint by endpoint.
+    """
+
+    pagination_classes = {
+        "page": CustomPageNumberPagination,
+        "cursor": KeysetPagination,
+    }
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            params = self.request.query_params
+            style = params.get("pagination")
+            if style is None:
+                style = "cursor" if "cursor" in params else "page"
+            pagination_class = self.pagination_classes.get(style, self.pagination_class)
+            self._paginator = pagination_class() if pagination_class else None
+        return self._paginator
+
+
+def make_etag(*parts):
+    """Build a strong ETag value from the parts a representation depends on."""
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8"))
+    return quote_etag(digest.hexdigest())
+
+
+def body_etag(data):
+    """Build a strong ETag value from a serialized representation itself."""
+    return make_etag(json.dumps(data, sort_keys=True, cls=JSONEncoder))
+
+
+def set_validators(response, etag=None, last_modified=None, vary_on_viewer=True):
+    """Attach ETag/Last-Modified headers to a response."""
+    if etag:
+        response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    if vary_on_viewer:
+        # The representation depends on who is asking
+        patch_vary_headers(response, ("Cookie", "Authorization"))
+    return response
+
+
+def not_modified_response(request, etag=None, last_modified=None):
+    """
+    Evaluate the request's conditional headers before doing any real work.
+
+    Returns:
+        HttpResponse: A 304 (or 412) response when the client's copy is
+        current, otherwise None.
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def validated_response(request, data, etag=None):
+    """
+    A Response for ``data`` with validators, or a 304 (or 412) response when
+    the client's copy is current.
+
+    Without an ``etag`` computed before serialization, the body's own hash
+    is used: always right, but it only saves the transfer.
+    """
+    etag = etag or body_etag(data)
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+    return set_validators(Response(data), etag)
+
+
+def cache_is_shared(alias="default"):
+    """Whether a cache is shared between processes, unlike the local-memory one."""
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
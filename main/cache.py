@@ -0,0 +1,351 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.humanize.templatetags.humanize import naturalday, naturaltime
+from django.core.cache import cache
+
+from accounts.models import Follow
+from accounts.serializers import preload_account_stats
+from base.utils import cache_is_shared, make_etag
+
+from .models import Post
+
+PAYLOAD_KEY = "post-payload:{}"
+POST_VERSION_KEY = "post-version:{}"
+ACCOUNT_VERSION_KEY = "account-version:{}"
+
+# Fields of a post payload that depend on who is looking at it
+VIEWER_POST_FIELDS = ("is_liked", "reaction")
+VIEWER_ACCOUNT_FIELDS = ("is_self", "is_following_account")
+# Relative timestamps go stale on their own, so they are recomputed per read
+TIME_FIELDS = ("natural_time_created", "natural_date_created")
+# Counted too often to invalidate the shared payload over; read from the
+# page's own post rows instead
+LIVE_POST_FIELDS = ("views",)
+
+
+class PayloadCacheStats:
+    """Per-process hit, miss and rebuild counters of the post payload cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+            self.rebuilds = 0
+            self.rebuild_seconds = 0.0
+
+    def record(self, hits, misses, stale, rebuild_seconds):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.stale += stale
+            if misses or stale:
+                self.rebuilds += 1
+                self.rebuild_seconds += rebuild_seconds
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "rebuilds": self.rebuilds,
+                "avg_rebuild_ms": (
+                    round(self.rebuild_seconds * 1000 / self.rebuilds, 3)
+                    if self.rebuilds
+                    else None
+                ),
+            }
+
+
+stats = PayloadCacheStats()
+
+
+def get_timeout():
+    return getattr(settings, "POST_PAYLOAD_CACHE_TIMEOUT", 300)
+
+
+def is_enabled():
+    """
+    Whether payloads and their version tokens are cached.
+
+    A version bump only reaches the workers that share its cache, so with a
+    per-process backend payloads are rendered on every read instead, unless
+    POST_PAYLOAD_CACHE forces the cache on (or off).
+    """
+    enabled = getattr(settings, "POST_PAYLOAD_CACHE", None)
+    return cache_is_shared() if enabled is None else enabled
+
+
+def bump_post_version(*post_ids):
+    """Invalidate the cached payloads of the given posts."""
+    if not is_enabled():
+        return
+    cache.set_many(
+        {POST_VERSION_KEY.format(pk): uuid.uuid4().hex for pk in post_ids if pk},
+        None,
+    )
+
+
+def bump_account_version(*account_ids):
+    """Invalidate every cached payload that embeds the given accounts."""
+    if not is_enabled():
+        return
+    cache.set_many(
+        {ACCOUNT_VERSION_KEY.format(pk): uuid.uuid4().hex for pk in account_ids if pk},
+        None,
+    )
+
+
+def get_versions(keys):
+    """
+    Return the current version token of each key, creating missing ones.
+
+    Versions are random tokens rather than counters, so a version evicted
+    from the cache can never come back equal to a token stored in a payload.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def _payload_accounts(payload):
+    """Yield every account card embedded in a post payload."""
+    yield payload["author"]
+    if payload.get("parent"):
+        yield payload["parent"]["author"]
+    yield from payload["tagged_accounts"]
+
+
+def _dependency_keys(payload):
+    keys = [POST_VERSION_KEY.format(payload["id"])]
+    if payload.get("parent"):
+        keys.append(POST_VERSION_KEY.format(payload["parent"]["id"]))
+    keys += [
+        ACCOUNT_VERSION_KEY.format(account["id"])
+        for account in _payload_accounts(payload)
+    ]
+    return keys
+
+
+def render_shared_payloads(post_ids, serializer_class):
+    """
+    Serialize the viewer-independent payload of each post.
+
+    Returns:
+        dict: Payloads keyed by post id.
+    """
+    serializer = serializer_class(context={})
+    posts = list(Post.objects.filter(id__in=post_ids).for_feed(None))
+    # Figures of every embedded account card in one batch
+    accounts = [post.author for post in posts]
+    accounts += [post.parent.author for post in posts if post.parent_id]
+    accounts += [account for post in posts for account in post.tagged_accounts.all()]
+    preload_account_stats(serializer.context, accounts)
+    return {post.id: serializer.to_representation(post) for post in posts}
+
+
+def build_shared_payloads(post_ids, serializer_class):
+    """
+    Serialize the viewer-independent payload of each post and cache it.
+
+    Returns:
+        dict: Payloads keyed by post id.
+    """
+    # Read the post versions first so a write racing with the build makes the
+    # stored payload stale instead of hiding the write
+    pre_versions = get_versions([POST_VERSION_KEY.format(pk) for pk in post_ids])
+    payloads = render_shared_payloads(post_ids, serializer_class)
+
+    dependencies = {pk: _dependency_keys(payload) for pk, payload in payloads.items()}
+    versions = get_versions(
+        sorted({key for keys in dependencies.values() for key in keys})
+    )
+    versions.update(pre_versions)
+
+    cache.set_many(
+        {
+            PAYLOAD_KEY.format(pk): {
+                "payload": payload,
+                "versions": {key: versions[key] for key in dependencies[pk]},
+            }
+            for pk, payload in payloads.items()
+        },
+        get_timeout(),
+    )
+    return payloads
+
+
+def get_shared_payloads(post_ids, serializer_class):
+    """
+    Fetch cached shared payloads, rebuilding missing and stale ones in batch.
+
+    Returns:
+        dict: Payloads keyed by post id (deleted posts are left out).
+    """
+    if not is_enabled():
+        return render_shared_payloads(post_ids, serializer_class)
+    entries = cache.get_many([PAYLOAD_KEY.format(pk) for pk in post_ids])
+    entries = {int(key.rsplit(":", 1)[1]): entry for key, entry in entries.items()}
+
+    dependency_keys = sorted(
+        {key for entry in entries.values() for key in entry["versions"]}
+    )
+    versions = get_versions(dependency_keys) if dependency_keys else {}
+
+    payloads = {}
+    stale = 0
+    for pk, entry in entries.items():
+        if all(versions.get(key) == token for key, token in entry["versions"].items()):
+            payloads[pk] = entry["payload"]
+        else:
+            stale += 1
+
+    missing = [pk for pk in post_ids if pk not in payloads]
+    start = time.perf_counter()
+    if missing:
+        payloads.update(build_shared_payloads(missing, serializer_class))
+    stats.record(
+        hits=len(post_ids) - len(missing),
+        misses=len(missing) - stale,
+        stale=stale,
+        rebuild_seconds=time.perf_counter() - start,
+    )
+    return payloads
+
+
+def apply_viewer_overlay(payloads, posts, viewer):
+    """
+    Merge the viewer-specific and live fields into shared payloads in place.
+
+    The viewer's likes and reactions come from one annotated query over the
+    page and the followed accounts from one query over every embedded card.
+    """
+    posts_by_id = {post.id: post for post in posts}
+    liked, reactions, following = {}, {}, set()
+
+    if viewer is not None and viewer.is_authenticated:
+        rows = (
+            Post.objects.filter(id__in=list(payloads))
+            .with_viewer_state(viewer)
+            .values_list("id", "viewer_liked", "viewer_reaction")
+        )
+        for pk, viewer_liked, viewer_reaction in rows:
+            liked[pk] = viewer_liked
+            reactions[pk] = viewer_reaction
+
+        account_ids = {
+            account["id"]
+            for payload in payloads.values()
+            for account in _payload_accounts(payload)
+        }
+        following = set(
+            Follow.objects.filter(
+                follower=viewer, following_id__in=account_ids
+            ).values_list("following_id", flat=True)
+        )
+
+    viewer_id = viewer.pk if viewer is not None else None
+    for pk, payload in payloads.items():
+        payload["is_liked"] = liked.get(pk, False)
+        payload["reaction"] = reactions.get(pk)
+        for account in _payload_accounts(payload):
+            account["is_self"] = account["id"] == viewer_id
+            account["is_following_account"] = account["id"] in following
+
+        post = posts_by_id.get(pk)
+        if post is not None:
+            for field in LIVE_POST_FIELDS:
+                payload[field] = getattr(post, field)
+            payload["natural_time_created"] = naturaltime(post.created_at)
+            payload["natural_date_created"] = naturalday(post.created_at)
+    return payloads
+
+
+def serialize_posts(posts, serializer_class, viewer=None):
+    """
+    Render posts from the shared payload cache plus a per-viewer overlay.
+
+    Args:
+        posts (iterable): Post instances, in the order to render them.
+        serializer_class (type): Serializer that builds the shared payload.
+        viewer (Account, optional): The requesting user.
+
+    Returns:
+        list: One payload per post that still exists.
+    """
+    posts = list(posts)
+    post_ids = [post.id for post in posts]
+    payloads = get_shared_payloads(post_ids, serializer_class)
+    apply_viewer_overlay(payloads, posts, viewer)
+    return [payloads[pk] for pk in post_ids if pk in payloads]
+
+
+def versions_etag(post_ids=(), account_ids=(), extra=()):
+    """
+    ETag over the current version tokens of posts and accounts.
+
+    None while the payload cache is off, since the tokens are then not
+    bumped; callers validate the rendered body instead (body_etag).
+    """
+    if not is_enabled():
+        return None
+    keys = {POST_VERSION_KEY.format(pk) for pk in post_ids if pk}
+    keys |= {ACCOUNT_VERSION_KEY.format(pk) for pk in account_ids if pk}
+    versions = get_versions(sorted(keys))
+    return make_etag(*(f"{key}={versions[key]}" for key in sorted(versions)), *extra)
+
+
+def post_etag(post, viewer=None, extra=()):
+    """
+    ETag of a post's PostSerializer payload as seen by ``viewer``.
+
+    Likes, reactions and follows bump the versions of the post and of the
+    accounts it embeds, so the viewer-specific fields are covered too.
+    None while the payload cache is off, see versions_etag.
+    """
+    if not is_enabled():
+        return None
+    tagged_ids = Post.tagged_accounts.through.objects.filter(
+        post_id=post.pk
+    ).values_list("account_id", flat=True)
+    parent = post.parent if post.parent_id else None
+    return versions_etag(
+        post_ids=(post.pk, post.parent_id),
+        account_ids=(post.author_id, parent and parent.author_id, *tagged_ids),
+        extra=(
+            post.updated_at.isoformat(),
+            post.views,
+            post.likes_count,
+            post.replies_count,
+            post.retweets_count,
+            sorted((post.reaction_counts or {}).items()),
+            naturaltime(post.created_at),
+            naturalday(post.created_at),
+            getattr(viewer, "pk", None),
+            *extra,
+        ),
+    )
+
+
+def account_etag(account, viewer=None, extra=()):
+    """
+    ETag of an account's serialized card/profile as seen by ``viewer``.
+    None while the payload cache is off, see versions_etag.
+    """
+    return versions_etag(
+        account_ids=(account.pk,),
+        extra=(account.updated_at.isoformat(), getattr(viewer, "pk", None), *extra),
+    )
@@ -0,0 +1,139 @@
+from collections import defaultdict
+
+from django.db.models import Q
+
+from base.utils import encode_cursor
+
+from .cache import apply_viewer_overlay, get_shared_payloads
+from .models import Post
+
+DEFAULT_DEPTH = 3
+MAX_DEPTH = 10
+DEFAULT_SIZE = 50
+MAX_SIZE = 200
+# Guards the ancestor walk against runaway parent chains
+MAX_ANCESTORS = 100
+
+ANCESTORS_SQL = """
+WITH RECURSIVE ancestors(id, parent_id, depth) AS (
+    SELECT id, parent_id, 0 FROM {table} WHERE id = %s
+    UNION ALL
+    SELECT p.id, p.parent_id, a.depth - 1
+    FROM {table} p JOIN ancestors a ON p.id = a.parent_id
+    WHERE a.depth > %s
+)
+SELECT p.*, a.depth AS depth FROM ancestors a JOIN {table} p ON p.id = a.id
+"""
+
+
+def fetch_conversation(
+    post_id, depth=DEFAULT_DEPTH, size=DEFAULT_SIZE, after=None, ancestors=True
+):
+    """
+    Load a post, its ancestors and its replies down to ``depth``.
+
+    Replies are walked one level at a time, breadth first and oldest first,
+    and each level only fetches what is left of ``size``: a page costs one
+    query per level however large the thread is, and when ``size`` cuts the
+    tree every parent of a returned reply is returned too.
+
+    Args:
+        post_id (int): The post the conversation is centred on.
+        depth (int, optional): Levels of replies to descend.
+        size (int, optional): Maximum number of replies.
+        after (tuple, optional): ``(created_at, id)`` of the last direct reply
+            already seen; direct replies up to it are skipped.
+        ancestors (bool, optional): Whether to load the ancestors.
+
+    Returns:
+        list: Post instances with a ``depth`` attribute: negative for
+        ancestors, 0 for the post itself and 1 or more for replies.
+    """
+    sql = ANCESTORS_SQL.format(table=Post._meta.db_table)
+    posts = list(Post.objects.raw(sql, [post_id, -MAX_ANCESTORS if ancestors else 0]))
+    if not posts:
+        return posts
+
+    parent_ids = [post_id]
+    remaining = size
+    for level in range(1, depth + 1):
+        if not parent_ids or remaining <= 0:
+            break
+        replies = Post.objects.filter(parent_id__in=parent_ids)
+        if level == 1 and after is not None:
+            created_at, pk = after
+            replies = replies.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            )
+        replies = list(replies.order_by("created_at", "id")[:remaining])
+        for reply in replies:
+            reply.depth = level
+        posts += replies
+        remaining -= len(replies)
+        parent_ids = [reply.id for reply in replies]
+    return posts
+
+
+def build_conversation(
+    post_id,
+    serializer_class,
+    viewer=None,
+    depth=DEFAULT_DEPTH,
+    size=DEFAULT_SIZE,
+    after=None,
+    seen=0,
+    ancestors=True,
+):
+    """
+    Serialize a conversation as the post's ancestors plus a tree of replies.
+
+    Every node of the tree carries its ``replies``, ``has_more_replies`` and
+    a ``replies_cursor``. When a node has replies left out, by ``size`` or
+    by the depth limit, its cursor continues them in the conversation of
+    that node: after the last reply returned, or from the first one.
+
+    ``after`` and ``seen`` come from a replies cursor: the last direct reply
+    already returned and how many direct replies were returned so far.
+    Conversations continued from a cursor leave the ``ancestors`` out.
+
+    Raises:
+        Post.DoesNotExist: If the post does not exist.
+    """
+    posts = fetch_conversation(post_id, depth, size, after, ancestors)
+    root = next((post for post in posts if post.depth == 0), None)
+
+    # Every node is serialized in one batch
+    payloads = get_shared_payloads([post.id for post in posts], serializer_class)
+    apply_viewer_overlay(payloads, posts, viewer)
+    if root is None or root.id not in payloads:
+        raise Post.DoesNotExist
+
+    children = defaultdict(list)
+    for post in sorted(posts, key=lambda post: (post.created_at, post.id)):
+        if post.depth > 0 and post.id in payloads:
+            children[post.parent_id].append(post)
+
+    def node(post, seen=0):
+        replies = children.get(post.id, [])
+        seen += len(replies)
+        has_more = post.replies_count > seen
+        cursor = None
+        if has_more:
+            position = {"n": seen}
+            if replies:
+                position.update(t=replies[-1].created_at.isoformat(), i=replies[-1].id)
+            cursor = encode_cursor(position)
+        return {
+            "post": payloads[post.id],
+            "replies": [node(reply) for reply in replies],
+            "has_more_replies": has_more,
+            "replies_cursor": cursor,
+        }
+
+    ancestors = sorted(
+        (post for post in posts if post.depth < 0 and post.id in payloads),
+        key=lambda post: post.depth,
+    )
+    conversation = {"ancestors": [payloads[post.id] for post in ancestors]}
+    conversation.update(node(root, seen))
+    return conversation
@@ -0,0 +1,346 @@
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import Count, F, OuterRef
+from django.db.models.functions import Greatest
+
+from .cache import bump_post_version
+from .models import Post, Reaction, count_subquery
+
+logger = logging.getLogger(__name__)
+
+COUNTER_FIELDS = ("likes_count", "replies_count", "retweets_count")
+
+
+def adjust_post_counter(post_id, field, delta):
+    """
+    Atomically add ``delta`` to one of the post's counter columns.
+
+    Args:
+        post_id (int): The post to update.
+        field (str): One of COUNTER_FIELDS.
+        delta (int): The amount to add (negative to decrement).
+
+    Returns:
+        None
+    """
+    if field not in COUNTER_FIELDS:
+        raise ValueError(f"Unknown post counter: {field}")
+    # Counters never go below zero, even if they drifted before the update
+    Post.objects.filter(pk=post_id).update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def reaction_histogram(counts=None):
+    """Return a histogram with every reaction emoji, including the unused ones."""
+    histogram = {emoji: 0 for emoji, _ in Reaction.REACTION_CHOICES}
+    histogram.update(counts or {})
+    return histogram
+
+
+def _apply_reaction_changes(counts, added=(), removed=()):
+    counts = dict(counts or {})
+    for emoji in removed:
+        remaining = counts.get(emoji, 0) - 1
+        if remaining > 0:
+            counts[emoji] = remaining
+        else:
+            counts.pop(emoji, None)
+
+    for emoji in added:
+        counts[emoji] = counts.get(emoji, 0) + 1
+    return counts
+
+
+def upsert_reaction(post_id, account_id, emoji):
+    """
+    Set the account's reaction on a post, replacing any previous one.
+
+    The reaction row is written with a single upsert on ``(post, user)`` and
+    the post's histogram is adjusted in the same transaction, under the
+    post's row lock.
+
+    Returns:
+        dict: The updated histogram (only the emojis in use).
+    """
+    with transaction.atomic():
+        post = Post.objects.select_for_update().only("reaction_counts").get(pk=post_id)
+        previous = (
+            Reaction.objects.filter(post_id=post_id, user_id=account_id)
+            .values_list("emoji", flat=True)
+            .first()
+        )
+        if previous == emoji:
+            return dict(post.reaction_counts or {})
+
+        Reaction.objects.bulk_create(
+            [Reaction(post_id=post_id, user_id=account_id, emoji=emoji)],
+            update_conflicts=True,
+            unique_fields=["post", "user"],
+            update_fields=["emoji", "created_at"],
+        )
+        counts = _apply_reaction_changes(
+            post.reaction_counts, added=[emoji], removed=[previous] if previous else []
+        )
+        Post.objects.filter(pk=post_id).update(reaction_counts=counts)
+    # bulk_create sends no post_save
+    transaction.on_commit(lambda: bump_post_version(post_id))
+    return counts
+
+
+def toggle_like(post_id, account_id):
+    """
+    Like the post if the account has not liked it yet, otherwise unlike it.
+
+    Works on the likes through table directly: a delete, and an insert only
+    when nothing was deleted, so the cost does not depend on how many
+    accounts liked the post.
+
+    Raises:
+        Post.DoesNotExist: If the post is gone, even if it went meanwhile.
+
+    Returns:
+        tuple: ``(liked, likes_count)`` after the toggle.
+    """
+    through = Post.likes.through
+    like = through.objects.filter(post_id=post_id, account_id=account_id)
+    try:
+        with transaction.atomic():
+            deleted, _ = like.delete()
+            if deleted:
+                liked = False
+                adjust_post_counter(post_id, "likes_count", -1)
+            else:
+                liked = True
+                try:
+                    with transaction.atomic():
+                        through.objects.create(post_id=post_id, account_id=account_id)
+                except IntegrityError:
+                    if not like.exists():
+                        # Not a concurrent like of the same post
+                        raise
+                    # A concurrent request liked it first and counted it
+                else:
+                    adjust_post_counter(post_id, "likes_count", 1)
+            likes_count = (
+                Post.objects.filter(pk=post_id)
+                .values_list("likes_count", flat=True)
+                .get()
+            )
+    except IntegrityError as e:
+        # Foreign keys are checked at commit on PostgreSQL, so a post deleted
+        # meanwhile can fail the whole transaction
+        if Post.objects.filter(pk=post_id).exists():
+            raise
+        raise Post.DoesNotExist(f"Post {post_id} does not exist.") from e
+    # The through table is written directly, so no m2m_changed is sent
+    transaction.on_commit(lambda: bump_post_version(post_id))
+    return liked, likes_count
+
+
+def recount_post_counters(queryset=None, batch_size=1000):
+    """
+    Recompute every denormalized counter from the source rows.
+
+    Args:
+        queryset (QuerySet, optional): Posts to repair (default: all posts).
+        batch_size (int, optional): Posts per histogram batch.
+
+    Returns:
+        int: The number of posts whose reaction histogram changed.
+    """
+    if queryset is None:
+        queryset = Post.objects.all()
+
+    # One UPDATE repairs the scalar counters of every selected post
+    queryset.update(
+        likes_count=count_subquery(
+            Post.likes.through.objects.filter(post=OuterRef("pk")), "post"
+        ),
+        replies_count=count_subquery(
+            Post.objects.filter(parent=OuterRef("pk")), "parent"
+        ),
+        retweets_count=count_subquery(
+            Post.objects.filter(original_post=OuterRef("pk")), "original_post"
+        ),
+    )
+
+    changed = 0
+    posts = queryset.order_by("pk").only("pk", "reaction_counts")
+    last_pk = 0
+    while True:
+        batch = list(posts.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        histograms = {post.pk: {} for post in batch}
+        rows = (
+            Reaction.objects.filter(post_id__in=histograms)
+            .values("post_id", "emoji")
+            .annotate(total=Count("id"))
+            .order_by()
+        )
+        for row in rows:
+            histograms[row["post_id"]][row["emoji"]] = row["total"]
+
+        stale = []
+        for post in batch:
+            if post.reaction_counts != histograms[post.pk]:
+                post.reaction_counts = histograms[post.pk]
+                stale.append(post)
+        Post.objects.bulk_update(stale, ["reaction_counts"])
+        changed += len(stale)
+
+    return changed
+
+
+class ViewCounterBuffer:
+    """
+    Write-behind buffer for post view counts.
+
+    Views are summed in memory and written every ``flush_interval`` seconds
+    (or as soon as ``buffer_size`` distinct posts are pending) with one
+    ``UPDATE ... SET views = views + n`` per distinct increment, instead of
+    loading and saving the post on every view. A daemon thread does the
+    periodic flushes and the buffer is flushed once more when the worker
+    exits.
+    """
+
+    def __init__(self, flush_interval=None, buffer_size=None):
+        self.flush_interval = flush_interval or getattr(
+            settings, "POST_VIEW_FLUSH_INTERVAL", 10
+        )
+        self.buffer_size = buffer_size or getattr(
+            settings, "POST_VIEW_BUFFER_SIZE", 1000
+        )
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._thread = None
+        self._stopped = threading.Event()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.recorded = 0
+            self.flushed = 0
+            self.discarded = 0
+            self.lost = 0
+            self.flushes = 0
+            self.flush_errors = 0
+            self.last_flush_ms = None
+
+    def record(self, post_id, count=1):
+        """Buffer ``count`` views of a post."""
+        with self._lock:
+            self._pending[post_id] += count
+            self.recorded += count
+            full = len(self._pending) >= self.buffer_size
+        self._ensure_thread()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered views to the database.
+
+        Returns:
+            int: The number of view increments written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, defaultdict(int)
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            by_increment = defaultdict(list)
+            for post_id, count in batch.items():
+                by_increment[count].append(post_id)
+
+            written = discarded = 0
+            try:
+                with transaction.atomic():
+                    for count, post_ids in by_increment.items():
+                        updated = Post.objects.filter(pk__in=post_ids).update(
+                            views=F("views") + count
+                        )
+                        written += updated * count
+                        # Views of posts deleted in the meantime
+                        discarded += (len(post_ids) - updated) * count
+            except DatabaseError:
+                logger.exception("Failed to flush %d post view counts", len(batch))
+                self._requeue(batch)
+                return 0
+
+            # Cached payloads read views from the post rows (LIVE_POST_FIELDS),
+            # so the flush leaves their versions alone
+            with self._lock:
+                self.flushed += written
+                self.discarded += discarded
+                self.flushes += 1
+                self.last_flush_ms = round((time.perf_counter() - start) * 1000, 3)
+            return written
+
+    def _requeue(self, batch):
+        """Put a failed batch back, dropping it if the buffer overflows."""
+        with self._lock:
+            self.flush_errors += 1
+            if len(self._pending) + len(batch) > self.buffer_size * 2:
+                self.lost += sum(batch.values())
+                return
+            for post_id, count in batch.items():
+                self._pending[post_id] += count
+
+    def _ensure_thread(self):
+        # Started lazily so that forking servers start it in each worker
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="post-view-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Post view flusher failed")
+            finally:
+                # Connections are per thread; do not keep this one open
+                connections.close_all()
+
+    def stop(self):
+        """Stop the flush thread and write whatever is still buffered."""
+        self._stopped.set()
+        self.flush()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "pending_posts": len(self._pending),
+                "pending_views": sum(self._pending.values()),
+                "recorded": self.recorded,
+                "flushed": self.flushed,
+                "discarded": self.discarded,
+                "lost": self.lost,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "last_flush_ms": self.last_flush_ms,
+                "flush_interval": self.flush_interval,
+                "buffer_size": self.buffer_size,
+            }
+
+
+view_counter = ViewCounterBuffer()
+atexit.register(view_counter.stop)
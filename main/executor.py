@@ -0,0 +1,268 @@
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from rest_framework.exceptions import APIException, Throttled
+
+
+class MediaExecutorBusy(Throttled):
+    default_detail = "Too many media operations in progress, try again shortly."
+    default_code = "media_busy"
+
+
+class MediaTaskTimeout(APIException):
+    status_code = 504
+    default_detail = "The image backend took too long to respond."
+    default_code = "media_timeout"
+
+
+def timed_call(fn, args):
+    """
+    Run ``fn(*args)`` and time it where it runs.
+
+    Module level so that process pools can pickle it; exceptions are
+    returned rather than raised so their timing is not lost.
+    """
+    started = time.monotonic()
+    try:
+        result, failed = fn(*args), False
+    except Exception as e:
+        result, failed = e, True
+    return started, time.monotonic(), failed, result
+
+
+def process_context():
+    """
+    How process pools start their processes: forkserver, or spawn where it
+    is not available.
+
+    Forking copies the threads' locks (executor threads, database and cache
+    clients) into the child in whatever state they are, so the children
+    start from a fresh interpreter instead and import what they run.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+
+
+class MediaBatch:
+    """The tasks of one submit call, waited for with ``results``."""
+
+    def __init__(self, executor, futures, submitted_at=None):
+        self.executor = executor
+        self.futures = futures
+        self.submitted_at = time.monotonic() if submitted_at is None else submitted_at
+
+    def results(self, timeout=None):
+        """
+        Wait for every task and return the results in order.
+
+        Raises:
+            MediaTaskTimeout: If the tasks were not all done ``timeout``
+                seconds (default: MEDIA_TASK_TIMEOUT) after they were
+                submitted; tasks not started yet are cancelled.
+            Exception: The first exception raised by a task.
+        """
+        timeout = self.executor.task_timeout if timeout is None else timeout
+        deadline = self.submitted_at + timeout
+        try:
+            results = []
+            for future in self.futures:
+                started, finished, failed, result = future.result(
+                    timeout=max(deadline - time.monotonic(), 0)
+                )
+                if failed:
+                    raise result
+                results.append(result)
+            return results
+        except FutureTimeoutError:
+            with self.executor._lock:
+                self.executor.timed_out += 1
+            raise MediaTaskTimeout()
+        finally:
+            for future in self.futures:
+                future.cancel()
+
+
+class MediaExecutor:
+    """
+    Process-wide pool for image uploads, conversions and deletions.
+
+    The pool is created on first use with ``workers`` threads (or processes
+    for CPU-bound work). At most MEDIA_QUEUE_SIZE tasks may wait for a
+    worker; a call that does not fit is rejected as a whole with
+    MediaExecutorBusy, which the API returns as a 429, rather than queueing
+    without bound. The tasks of a call are waited for at most
+    MEDIA_TASK_TIMEOUT seconds in all.
+
+    Args:
+        name (str): Prefix of the worker thread names.
+        pool_class (type): ThreadPoolExecutor or ProcessPoolExecutor.
+        workers_setting (str): Setting holding the number of workers.
+        default_workers (int): Workers when the setting is missing.
+    """
+
+    def __init__(
+        self,
+        name="media",
+        pool_class=ThreadPoolExecutor,
+        workers_setting="MEDIA_WORKERS",
+        default_workers=8,
+    ):
+        self.name = name
+        self.pool_class = pool_class
+        self.workers_setting = workers_setting
+        self.default_workers = default_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._in_flight = 0
+            self.submitted = 0
+            self.completed = 0
+            self.failed = 0
+            self.timed_out = 0
+            self.rejected = 0
+            self.queue_wait_seconds = 0.0
+            self.max_queue_wait_seconds = 0.0
+            self.run_seconds = 0.0
+
+    @property
+    def max_workers(self):
+        return getattr(settings, self.workers_setting, self.default_workers)
+
+    @property
+    def max_queue(self):
+        return getattr(settings, "MEDIA_QUEUE_SIZE", 64)
+
+    @property
+    def task_timeout(self):
+        return getattr(settings, "MEDIA_TASK_TIMEOUT", 30)
+
+    def _get_executor(self, broken=None):
+        with self._lock:
+            if broken is not None and self._executor is broken:
+                # A dead worker process (e.g. killed for memory) breaks the
+                # whole pool, so it is replaced
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            if self._executor is None:
+                if self.pool_class is ThreadPoolExecutor:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix=self.name
+                    )
+                else:
+                    self._executor = self.pool_class(
+                        max_workers=self.max_workers, mp_context=process_context()
+                    )
+            return self._executor
+
+    def _reserve(self, count):
+        with self._lock:
+            if self._in_flight + count > self.max_workers + self.max_queue:
+                self.rejected += 1
+                # Rough time for the pool to drain enough for this call
+                average_run = self.run_seconds / self.completed if self.completed else 1
+                raise MediaExecutorBusy(
+                    wait=math.ceil(average_run * self._in_flight / self.max_workers)
+                )
+            self._in_flight += count
+            self.submitted += count
+
+    def _done(self, submitted_at, future):
+        with self._lock:
+            self._in_flight -= 1
+            if future.cancelled() or future.exception() is not None:
+                return
+            started, finished, failed, _ = future.result()
+            wait = max(started - submitted_at, 0)
+            self.completed += 1
+            self.failed += failed
+            self.queue_wait_seconds += wait
+            self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, wait)
+            self.run_seconds += finished - started
+
+    def submit(self, fn, *iterables):
+        """
+        Start ``fn`` over the arguments on the pool without waiting.
+
+        Raises:
+            MediaExecutorBusy: If the pool cannot take every call right now;
+                nothing was started.
+
+        Returns:
+            MediaBatch: The started tasks.
+        """
+        calls = list(zip(*iterables))
+        if not calls:
+            return MediaBatch(self, [])
+        executor = self._get_executor()
+
+        self._reserve(len(calls))
+        submitted_at = time.monotonic()
+        futures = []
+        try:
+            for args in calls:
+                try:
+                    future = executor.submit(timed_call, fn, args)
+                except BrokenProcessPool:
+                    executor = self._get_executor(broken=executor)
+                    future = executor.submit(timed_call, fn, args)
+                future.add_done_callback(lambda f: self._done(submitted_at, f))
+                futures.append(future)
+        except BaseException:
+            # Release the calls that were reserved but never started
+            with self._lock:
+                self._in_flight -= len(calls) - len(futures)
+            raise
+        return MediaBatch(self, futures, submitted_at)
+
+    def map(self, fn, *iterables, timeout=None):
+        """
+        Run ``fn`` over the arguments on the pool and return the results in order.
+
+        See submit and MediaBatch.results for the exceptions raised.
+        """
+        return self.submit(fn, *iterables).results(timeout)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "rejected": self.rejected,
+                "avg_queue_wait_ms": (
+                    round(self.queue_wait_seconds * 1000 / self.completed, 3)
+                    if self.completed
+                    else None
+                ),
+                "max_queue_wait_ms": round(self.max_queue_wait_seconds * 1000, 3),
+                "avg_run_ms": (
+                    round(self.run_seconds * 1000 / self.completed, 3)
+                    if self.completed
+                    else None
+                ),
+            }
+
+
+media_executor = MediaExecutor()
+# BlurHash encoding is CPU-bound, so it runs in processes to avoid the GIL
+hash_executor = MediaExecutor(
+    name="blurhash",
+    pool_class=ProcessPoolExecutor,
+    workers_setting="BLURHASH_PROCESSES",
+    default_workers=2,
+)
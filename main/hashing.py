@@ -0,0 +1,215 @@
+import ctypes
+import ctypes.util
+import math
+from functools import lru_cache
+from io import BytesIO
+
+import blurhash
+from PIL import Image, ImageOps
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - falls back to the blurhash library
+    np = None
+
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+# Components and thumbnail size used for every image
+X_COMPONENTS = 4
+Y_COMPONENTS = 3
+THUMBNAIL_SIZE = (100, 100)
+
+
+def _load_libm():
+    """
+    The C library's cosf and powf, which the reference encoder calls.
+
+    NumPy's own float32 cos and power may differ from them in the last bit,
+    which is enough to change a hash; without libm, float64 results rounded
+    to float32 are used instead.
+    """
+    path = ctypes.util.find_library("m")
+    if path is None:
+        return None, None
+    try:
+        libm = ctypes.CDLL(path)
+    except OSError:
+        return None, None
+    for name in ("cosf", "powf"):
+        function = getattr(libm, name)
+        function.restype = ctypes.c_float
+        function.argtypes = [ctypes.c_float] * (1 if name == "cosf" else 2)
+    return libm.cosf, libm.powf
+
+
+_cosf, _powf = _load_libm()
+
+
+def cosf(values):
+    values = np.asarray(values, dtype=np.float32)
+    if _cosf is None:
+        return np.cos(values.astype(np.float64)).astype(np.float32)
+    return np.array([_cosf(value) for value in values.ravel().tolist()], np.float32)
+
+
+def powf(values, exponent):
+    values = np.asarray(values, dtype=np.float32)
+    exponent = np.float32(exponent)
+    if _powf is None:
+        return np.power(values.astype(np.float64), float(exponent)).astype(np.float32)
+    return np.array(
+        [_powf(value, exponent) for value in values.ravel().tolist()], np.float32
+    ).reshape(values.shape)
+
+
+@lru_cache(maxsize=1)
+def srgb_to_linear_table():
+    """Linear value of every sRGB byte, as float32 like the reference."""
+    v = np.arange(256, dtype=np.float32) / np.float32(255)
+    low = (v.astype(np.float64) / 12.92).astype(np.float32)
+    high = powf(((v.astype(np.float64) + 0.055) / 1.055).astype(np.float32), 2.4)
+    return np.where(v <= 0.04045, low, high)
+
+
+@lru_cache(maxsize=64)
+def cos_table(components, size):
+    """``cos(pi * component * position / size)`` as computed by the reference."""
+    component = np.arange(components, dtype=np.float64)[:, None]
+    position = np.arange(size, dtype=np.float64)[None, :]
+    return cosf(math.pi * component * position / size).reshape(components, size)
+
+
+def encode_base83(value, length):
+    return "".join(
+        BASE83[(value // 83 ** (length - index - 1)) % 83] for index in range(length)
+    )
+
+
+def linear_to_srgb(values):
+    v = np.clip(np.asarray(values, dtype=np.float32), 0, 1)
+    low = v.astype(np.float64) * 12.92 * 255 + 0.5
+    high = (1.055 * powf(v, 1 / 2.4).astype(np.float64) - 0.055) * 255 + 0.5
+    return np.where(v <= 0.0031308, low, high).astype(np.int64)
+
+
+def encode_pixels(pixels, x_components=X_COMPONENTS, y_components=Y_COMPONENTS):
+    """
+    BlurHash of a batch of images with the same size.
+
+    Mirrors the C encoder of the blurhash library operation for operation,
+    including its float32 rounding and summation order, so the hashes are
+    identical to ``blurhash.encode``.
+
+    Args:
+        pixels (ndarray): ``(count, height, width, 3)`` RGB bytes.
+        x_components (int, optional): Horizontal components, 1 to 9.
+        y_components (int, optional): Vertical components, 1 to 9.
+
+    Returns:
+        list: The hash of every image.
+    """
+    if not (1 <= x_components <= 9 and 1 <= y_components <= 9):
+        raise ValueError("Invalid x_components or y_components")
+    count, height, width, _ = pixels.shape
+
+    # Channels first, so the sums below run over contiguous memory
+    linear = np.ascontiguousarray(
+        srgb_to_linear_table()[pixels]
+        .reshape(count, height * width, 3)
+        .transpose(0, 2, 1)
+    ).reshape(count, 1, 1, 3, height * width)
+    basis = (
+        cos_table(y_components, height)[:, None, :, None]
+        * cos_table(x_components, width)[None, :, None, :]
+    ).reshape(1, y_components, x_components, 1, height * width)
+    # A running sum keeps the pixel by pixel float32 rounding of the reference,
+    # which a pairwise np.sum would not
+    factors = np.cumsum(basis * linear, axis=4, dtype=np.float32)[..., -1]
+    normalisation = np.full((y_components, x_components, 1), 2, dtype=np.float32)
+    normalisation[0, 0] = 1
+    factors = factors * (normalisation / np.float32(width * height))
+    factors = factors.reshape(count, -1, 3)
+    dc, ac = factors[:, 0], factors[:, 1:]
+
+    size_flag = encode_base83((x_components - 1) + (y_components - 1) * 9, 1)
+    dc_values = linear_to_srgb(dc)
+    dc_values = (dc_values[:, 0] << 16) + (dc_values[:, 1] << 8) + dc_values[:, 2]
+    if ac.shape[1]:
+        actual_maximum = np.abs(ac).max(axis=(1, 2))
+        quantised_maximum = np.clip(
+            np.floor(
+                ((actual_maximum * np.float32(166)).astype(np.float64) - 0.5).astype(
+                    np.float32
+                )
+            ),
+            0,
+            82,
+        ).astype(np.int64)
+        maximum = (quantised_maximum.astype(np.float32) + 1) / np.float32(166)
+        scaled = ac / maximum[:, None, None]
+        signed = np.copysign(powf(np.abs(scaled), 0.5), scaled)
+        quantised = np.clip(
+            np.floor(
+                ((signed * np.float32(9)).astype(np.float64) + 9.5).astype(np.float32)
+            ),
+            0,
+            18,
+        ).astype(np.int64)
+        ac_values = (
+            quantised[:, :, 0] * 361 + quantised[:, :, 1] * 19 + quantised[:, :, 2]
+        )
+    else:
+        quantised_maximum = np.zeros(count, dtype=np.int64)
+        ac_values = np.zeros((count, 0), dtype=np.int64)
+
+    return [
+        size_flag
+        + encode_base83(int(quantised_maximum[index]), 1)
+        + encode_base83(int(dc_values[index]), 4)
+        + "".join(encode_base83(int(value), 2) for value in ac_values[index])
+        for index in range(count)
+    ]
+
+
+def prepare_image(image):
+    """Open an upload and shrink it to the thumbnail that gets hashed."""
+    image.seek(0)
+    image = Image.open(image)
+    # Convert image to RGBA if it has a palette with transparency
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    image.thumbnail(THUMBNAIL_SIZE)
+    # Upright, as browsers show it
+    return ImageOps.exif_transpose(image)
+
+
+def encode_images(images, x_components=X_COMPONENTS, y_components=Y_COMPONENTS):
+    """
+    BlurHash of prepared images, encoding images of the same size together.
+
+    Falls back to ``blurhash.encode`` one image at a time without NumPy.
+    """
+    if np is None:
+        return [blurhash.encode(image, x_components, y_components) for image in images]
+
+    pixels = [np.asarray(image.convert("RGB")) for image in images]
+    by_shape = {}
+    for index, array in enumerate(pixels):
+        by_shape.setdefault(array.shape, []).append(index)
+
+    hashes = [None] * len(pixels)
+    for indices in by_shape.values():
+        batch = np.stack([pixels[index] for index in indices])
+        for index, value in zip(
+            indices, encode_pixels(batch, x_components, y_components)
+        ):
+            hashes[index] = value
+    return hashes
+
+
+def hash_images(contents):
+    """
+    BlurHash of every image in a list of file contents.
+
+    Takes bytes rather than uploads so it can run in a worker process.
+    """
+    return encode_images([prepare_image(BytesIO(content)) for content in contents])
@@ -0,0 +1,134 @@
+from io import BytesIO
+
+from PIL import ExifTags, Image, ImageOps
+
+from .hashing import THUMBNAIL_SIZE, encode_images
+
+# Formats of the responsive variants, preferred first, with their quality.
+# AVIF needs a Pillow built with it and is skipped otherwise.
+VARIANT_FORMATS = {"avif": 60, "webp": 85}
+
+# EXIF orientations that turn the image a quarter, swapping its sides
+QUARTER_TURNS = (5, 6, 7, 8)
+
+
+def orientation(image):
+    """The EXIF orientation of an image, 1 (as stored) when it has none."""
+    return image.getexif().get(ExifTags.Base.Orientation, 1)
+
+
+def variant_formats():
+    """The variant formats this Pillow can write, preferred first."""
+    extensions = Image.registered_extensions()
+    return [name for name in VARIANT_FORMATS if f".{name}" in extensions]
+
+
+def encode_variant(image, format):
+    buffer = BytesIO()
+    image.save(buffer, format=format.upper(), quality=VARIANT_FORMATS[format])
+    return buffer.getvalue()
+
+
+def make_variants(image, widths):
+    """
+    Downscale an image to every width narrower than it, in every format.
+
+    Each width is resized from the previous, larger one rather than from
+    the full image.
+
+    Returns:
+        tuple: ``(variants, smallest)``, where ``variants`` lists dicts with
+        the ``width``, ``height``, ``format`` and ``content`` of each variant
+        and ``smallest`` is the smallest image made (or ``image``).
+    """
+    variants = []
+    formats = variant_formats()
+    source = image
+    for width in sorted(set(widths), reverse=True):
+        if width >= source.width:
+            continue
+        height = max(1, round(source.height * width / source.width))
+        source = source.resize((width, height), Image.LANCZOS)
+        variants.extend(
+            {
+                "width": width,
+                "height": height,
+                "format": format,
+                "content": encode_variant(source, format),
+            }
+            for format in formats
+        )
+    return variants, source
+
+
+def process_image(content, webp=True, widths=()):
+    """
+    Decode an upload once and derive what is stored for it.
+
+    The WebP output and the variants are encoded from the full decode, and
+    the BlurHash thumbnail is shrunk from the smallest of them. When no WebP
+    output is needed (the image backend converts it), JPEGs are only decoded
+    at a reduced scale. Everything is derived upright, as browsers show the
+    image, applying its EXIF orientation.
+
+    Args:
+        content (bytes): The uploaded file.
+        webp (bool, optional): Whether to produce the WebP output.
+        widths (iterable, optional): Widths of the variants to produce along
+            with the WebP output.
+
+    Returns:
+        tuple: ``(image, thumbnail)``, where ``image`` holds the ``width``,
+        ``height``, ``webp`` bytes (or None) and ``variants`` of the upload.
+    """
+    image = Image.open(BytesIO(content))
+    rotation = orientation(image)
+    width, height = image.size
+    if rotation in QUARTER_TURNS:
+        width, height = height, width
+
+    # Convert image to RGBA if it has a palette with transparency
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+
+    output, variants = None, []
+    if webp:
+        if rotation != 1:
+            image = ImageOps.exif_transpose(image)
+        buffer = BytesIO()
+        image.save(buffer, format="WEBP", optimize=True, quality=85)
+        output = buffer.getvalue()
+        variants, image = make_variants(image, widths)
+
+    # Image.thumbnail drafts JPEGs that are not loaded yet (Image.draft), so
+    # without WebP output they are only decoded at 1/2 to 1/8 of their size
+    image.thumbnail(THUMBNAIL_SIZE)
+    if not webp and rotation != 1:
+        # Turned after the thumbnail, so that the draft still applies
+        image = ImageOps.exif_transpose(image)
+    return {
+        "width": width,
+        "height": height,
+        "webp": output,
+        "variants": variants,
+    }, image
+
+
+def process_images(contents, webp=True, widths=()):
+    """
+    Process a batch of uploads, see process_image, and hash them together.
+
+    Takes bytes rather than uploads so it can run in a worker process.
+
+    Returns:
+        list: Per upload, a dict with its ``width``, ``height``, ``webp``
+        bytes (or None), ``variants`` and ``image_hash``.
+    """
+    images, thumbnails = [], []
+    for content in contents:
+        image, thumbnail = process_image(content, webp, widths)
+        images.append(image)
+        thumbnails.append(thumbnail)
+    for image, image_hash in zip(images, encode_images(thumbnails)):
+        image["image_hash"] = image_hash
+    return images
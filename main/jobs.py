@@ -0,0 +1,414 @@
+import os
+import random
+import socket
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from .cache import bump_post_version
+from .models import ImageMedia, Job, UploadSession
+from .uploads import discard_uploads, purge_uploads, store_uploads
+from .utils import (
+    IMAGE_FIELDS,
+    content_digest,
+    delete_unused_images,
+    process_and_upload_images,
+    read_files,
+    stored_images,
+)
+
+# Handlers by job kind, see register
+HANDLERS = {}
+
+
+def register(kind, on_failure=None):
+    """
+    Register the handler of a job kind.
+
+    Handlers receive the job payload and must be idempotent: a job runs again
+    after a failure, or when its worker died before finishing it. The
+    optional ``on_failure`` receives the payload once the job has used up
+    its attempts.
+    """
+
+    def decorator(handler):
+        HANDLERS[kind] = (handler, on_failure)
+        return handler
+
+    return decorator
+
+
+def media_jobs_enabled():
+    return getattr(settings, "MEDIA_JOBS_ENABLED", False)
+
+
+def enqueue(kind, payload, delay=0):
+    """
+    Add a job to the outbox.
+
+    Call it inside the transaction of the change the job follows up on, so
+    that the job is committed, or rolled back, with it.
+    """
+    return Job.objects.create(
+        kind=kind,
+        payload=payload,
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=getattr(settings, "JOB_MAX_ATTEMPTS", 5),
+    )
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, in seconds, after ``attempts`` runs."""
+    delay = min(
+        getattr(settings, "JOB_RETRY_DELAY", 10) * 2 ** (attempts - 1),
+        getattr(settings, "JOB_RETRY_MAX_DELAY", 3600),
+    )
+    # Half fixed, half random, so jobs that failed together spread out
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_jobs(worker, limit=10):
+    """
+    Claim up to ``limit`` due jobs for ``worker``.
+
+    Due jobs are pending jobs whose time has come and running jobs whose
+    lease (JOB_LEASE_SECONDS) ran out because their worker died. The claim
+    is a conditional update, so two workers never claim the same job; where
+    the database supports it, rows locked by another worker are skipped.
+
+    Returns:
+        list: The claimed jobs, their attempts already counted.
+    """
+    now = timezone.now()
+    due = Q(status="pending", run_at__lte=now) | Q(
+        status="running", locked_until__lt=now
+    )
+    lease = now + timedelta(seconds=getattr(settings, "JOB_LEASE_SECONDS", 300))
+    with transaction.atomic():
+        candidates = Job.objects.filter(due).order_by("run_at", "id")
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        job_ids = list(candidates.values_list("id", flat=True)[:limit])
+        Job.objects.filter(due, id__in=job_ids).update(
+            status="running",
+            locked_by=worker,
+            locked_until=lease,
+            attempts=F("attempts") + 1,
+        )
+    return list(
+        Job.objects.filter(
+            id__in=job_ids, status="running", locked_by=worker, locked_until=lease
+        ).order_by("run_at", "id")
+    )
+
+
+def run_job(job):
+    """
+    Run a claimed job and record the outcome.
+
+    A failed job is retried after retry_delay until it has run
+    ``max_attempts`` times, then it is marked failed.
+
+    Returns:
+        bool: Whether the job succeeded.
+    """
+    handler, on_failure = HANDLERS.get(job.kind, (None, None))
+    # Only the worker still holding the lease records the outcome
+    claimed = Job.objects.filter(id=job.id, locked_by=job.locked_by, status="running")
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for {job.kind} jobs.")
+        handler(job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            claimed.update(
+                status="failed",
+                last_error=error,
+                locked_until=None,
+                finished_at=timezone.now(),
+            )
+            if on_failure is not None:
+                on_failure(job.payload)
+        else:
+            claimed.update(
+                status="pending",
+                last_error=error,
+                locked_until=None,
+                run_at=timezone.now() + timedelta(seconds=retry_delay(job.attempts)),
+            )
+        return False
+
+    claimed.update(status="done", locked_until=None, finished_at=timezone.now())
+    return True
+
+
+def run_due_jobs(worker=None, limit=10):
+    """Claim and run a batch of due jobs; returns how many were run."""
+    jobs = claim_jobs(worker or worker_name(), limit)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
+
+
+def purge_jobs(days=None):
+    """Delete jobs done more than JOB_RETENTION_DAYS days ago."""
+    if days is None:
+        days = getattr(settings, "JOB_RETENTION_DAYS", 7)
+    deleted, _ = Job.objects.filter(
+        status="done", finished_at__lt=timezone.now() - timedelta(days=days)
+    ).delete()
+    return deleted
+
+
+def work(batch_size=10, poll_interval=1.0, once=False, stop=None):
+    """
+    Run due jobs until stopped.
+
+    Sleeps ``poll_interval`` seconds whenever no job is due, and purges old
+    jobs and expired upload sessions about once an hour.
+
+    Args:
+        batch_size (int, optional): Jobs claimed at a time.
+        poll_interval (float, optional): Seconds between polls when idle.
+        once (bool, optional): Stop as soon as no job is due.
+        stop (threading.Event or multiprocessing.Event, optional): Set to stop.
+
+    Returns:
+        int: The number of jobs run.
+    """
+    worker = worker_name()
+    total = 0
+    purged_at = 0
+    while stop is None or not stop.is_set():
+        close_old_connections()
+        if time.monotonic() - purged_at > 3600:
+            purge_jobs()
+            purge_uploads()
+            purged_at = time.monotonic()
+        try:
+            count = run_due_jobs(worker, batch_size)
+        except DatabaseError:
+            # Lost the connection, or another worker holds SQLite's write lock
+            connection.close()
+            count = None
+        total += count or 0
+        if not count:
+            if once and count == 0:
+                break
+            if stop is not None:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+    return total
+
+
+def queue_stats():
+    """Jobs by status and the age of the oldest due job, for the metrics."""
+    counts = {
+        row["status"]: row["count"]
+        for row in Job.objects.order_by().values("status").annotate(count=Count("id"))
+    }
+    oldest = Job.objects.filter(status="pending", run_at__lte=timezone.now()).aggregate(
+        oldest=Min("run_at")
+    )["oldest"]
+    return {
+        **{status: counts.get(status, 0) for status, _ in Job.STATUS_CHOICES},
+        "oldest_due_seconds": (
+            round((timezone.now() - oldest).total_seconds(), 3) if oldest else None
+        ),
+    }
+
+
+# Media jobs
+
+
+@lru_cache(maxsize=1)
+def staging_storage():
+    """
+    Where uploads wait for their upload job, named after their content.
+
+    A directory on disk (MEDIA_STAGING_ROOT) that API and job workers share.
+    """
+    return FileSystemStorage(location=settings.MEDIA_STAGING_ROOT)
+
+
+def stage_images(files):
+    """
+    Stage uploads for create_processing_images.
+
+    Returns:
+        list: The content digest of every file.
+    """
+    storage = staging_storage()
+    digests = []
+    for content in read_files(files):
+        digest = content_digest(content)
+        if not storage.exists(digest):
+            storage.save(digest, ContentFile(content))
+        digests.append(digest)
+    return digests
+
+
+def create_processing_images(post, digests, folder="posts"):
+    """
+    Attach staged uploads to a post and enqueue their upload job.
+
+    Images whose content is already stored are attached ready; the others
+    are processing until the job stores them. Call it inside the
+    transaction that creates the post.
+    """
+    known = stored_images(digests)
+    images = ImageMedia.objects.bulk_create(
+        [
+            (
+                ImageMedia(post=post, content_hash=digest, **known[digest])
+                if digest in known
+                else ImageMedia(post=post, content_hash=digest, status="processing")
+            )
+            for digest in digests
+        ]
+    )
+    # Uploads already stored were staged for nothing
+    transaction.on_commit(lambda: unstage(list(known)))
+    processing = [image for image in images if image.status == "processing"]
+    if processing:
+        enqueue(
+            "media.process_images",
+            {
+                "image_ids": [image.id for image in processing],
+                "digests": sorted({image.content_hash for image in processing}),
+                "folder": folder,
+            },
+        )
+    return images
+
+
+def unstage(digests):
+    """Delete staged uploads that no processing image needs any more."""
+    needed = set(
+        ImageMedia.objects.filter(
+            content_hash__in=digests, status="processing"
+        ).values_list("content_hash", flat=True)
+    )
+    storage = staging_storage()
+    for digest in set(digests) - needed:
+        storage.delete(digest)
+
+
+def mark_images_failed(payload):
+    images = ImageMedia.objects.filter(id__in=payload["image_ids"], status="processing")
+    post_ids = set(images.values_list("post_id", flat=True))
+    images.update(status="failed")
+    bump_post_version(*post_ids)
+    unstage(payload["digests"])
+
+
+def finish_processing_images(images, processed):
+    """
+    Mark processing images ready with what process_and_upload_images stored.
+
+    Images whose post went while they uploaded are deleted again, unless
+    other posts share them (see delete_unused_images).
+    """
+    with transaction.atomic():
+        for image, fields in zip(images, processed):
+            updated = ImageMedia.objects.filter(
+                id=image.id, status="processing"
+            ).update(
+                status="ready",
+                content_hash=fields["content_hash"],
+                **{field: fields[field] for field in IMAGE_FIELDS},
+            )
+            if not updated:
+                enqueue(
+                    "media.delete_images",
+                    {
+                        "image_urls": [fields["image_url"]],
+                        "content_hashes": [fields["content_hash"]],
+                    },
+                )
+        post_ids = {image.post_id for image in images}
+        transaction.on_commit(lambda: bump_post_version(*post_ids))
+
+
+@register("media.process_images", on_failure=mark_images_failed)
+def process_images_job(payload):
+    """Process and upload the staged images of a post, see create_processing_images."""
+    images = list(
+        ImageMedia.objects.filter(id__in=payload["image_ids"], status="processing")
+    )
+    if images:
+        storage = staging_storage()
+        files = [storage.open(image.content_hash) for image in images]
+        try:
+            processed = process_and_upload_images(files, folder=payload["folder"])
+        finally:
+            for file in files:
+                file.close()
+
+        finish_processing_images(images, processed)
+    unstage(payload["digests"])
+
+
+def create_upload_images(post, sessions, folder="posts"):
+    """
+    Attach claimed upload sessions (main.uploads) to a post as processing
+    images and enqueue their upload job. Call it inside the transaction
+    that creates the post.
+    """
+    images = ImageMedia.objects.bulk_create(
+        [ImageMedia(post=post, status="processing") for _ in sessions]
+    )
+    enqueue(
+        "media.process_uploads",
+        {
+            "image_ids": [image.id for image in images],
+            "upload_ids": [str(session.id) for session in sessions],
+            "folder": folder,
+        },
+    )
+    return images
+
+
+def mark_uploads_failed(payload):
+    mark_images_failed({**payload, "digests": []})
+    discard_uploads(payload["upload_ids"])
+
+
+@register("media.process_uploads", on_failure=mark_uploads_failed)
+def process_uploads_job(payload):
+    """Process and upload the uploads attached to a post, see create_upload_images."""
+    upload_ids = dict(zip(payload["image_ids"], payload["upload_ids"]))
+    images = list(
+        ImageMedia.objects.filter(id__in=payload["image_ids"], status="processing")
+    )
+    if images:
+        sessions = UploadSession.objects.in_bulk(
+            [upload_ids[image.id] for image in images]
+        )
+        processed = store_uploads(
+            [sessions[uuid.UUID(upload_ids[image.id])] for image in images],
+            folder=payload["folder"],
+        )
+        finish_processing_images(images, processed)
+    discard_uploads(payload["upload_ids"])
+
+
+@register("media.delete_images")
+def delete_images_job(payload):
+    """Delete images no post uses anymore, see delete_unused_images."""
+    delete_unused_images(payload["image_urls"], payload.get("content_hashes", ()))
@@ -0,0 +1,97 @@
+import time
+from io import BytesIO
+
+import blurhash
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from main.hashing import encode_images, hash_images, np, prepare_image
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the NumPy BlurHash encoder with the blurhash library on "
+        "synthetic images, checking that every hash is identical."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", type=int, default=200)
+        parser.add_argument(
+            "--size",
+            type=int,
+            nargs=2,
+            default=(1200, 800),
+            metavar=("WIDTH", "HEIGHT"),
+            help="Size of the uploads before they are thumbnailed.",
+        )
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            default=4,
+            help="Distinct upload sizes, so that batches mix shapes.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("The NumPy encoder needs NumPy.")
+
+        rng = np.random.default_rng(options["seed"])
+        contents = self.synthetic_uploads(rng, options)
+        thumbnails = [prepare_image(BytesIO(content)) for content in contents]
+        for thumbnail in thumbnails:
+            thumbnail.load()
+        self.stdout.write(
+            f"{len(contents)} uploads of {options['sizes']} sizes around "
+            f"{options['size'][0]}x{options['size'][1]}"
+        )
+
+        # Encoding only, from the same thumbnails
+        start = time.perf_counter()
+        expected = [blurhash.encode(image.copy(), 4, 3) for image in thumbnails]
+        library = time.perf_counter() - start
+        start = time.perf_counter()
+        hashes = encode_images(thumbnails)
+        vectorized = time.perf_counter() - start
+        self.report("encode", library, vectorized, len(thumbnails))
+
+        # Whole pipeline, from the uploaded bytes
+        start = time.perf_counter()
+        for content in contents:
+            blurhash.encode(prepare_image(BytesIO(content)), 4, 3)
+        library = time.perf_counter() - start
+        start = time.perf_counter()
+        hash_images(contents)
+        vectorized = time.perf_counter() - start
+        self.report("decode+encode", library, vectorized, len(contents))
+
+        mismatches = sum(a != b for a, b in zip(expected, hashes))
+        if mismatches:
+            raise CommandError(f"{mismatches} hashes differ from the library.")
+        self.stdout.write(self.style.SUCCESS("Every hash matches the library."))
+
+    def synthetic_uploads(self, rng, options):
+        width, height = options["size"]
+        sizes = [
+            (int(width * scale), int(height * scale))
+            for scale in rng.uniform(0.5, 1.5, size=options["sizes"])
+        ]
+        contents = []
+        for index in range(options["images"]):
+            # Smooth random images, closer to photos than noise
+            image = Image.fromarray(
+                rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+            ).resize(sizes[index % len(sizes)], Image.BICUBIC)
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=85)
+            contents.append(buffer.getvalue())
+        return contents
+
+    def report(self, name, library, vectorized, count):
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{name:>14}: library {library * 1000 / count:.2f} ms/image, "
+                f"numpy {vectorized * 1000 / count:.2f} ms/image "
+                f"({library / vectorized:.1f}x)"
+            )
+        )
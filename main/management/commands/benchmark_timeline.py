@@ -0,0 +1,152 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import Account, Follow
+from accounts.utils import recount_account_stats
+from main.models import Post, TimelineEntry
+from main.timeline import fan_out_post, home_timeline
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare push, pull and hybrid home timelines on a synthetic follow graph. "
+        "All generated data is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=2000)
+        parser.add_argument(
+            "--following", type=int, default=50, help="Average accounts followed."
+        )
+        parser.add_argument(
+            "--celebrities",
+            type=int,
+            default=5,
+            help="Accounts followed by most of the graph.",
+        )
+        parser.add_argument("--posts", type=int, default=200)
+        parser.add_argument("--readers", type=int, default=50)
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument(
+            "--threshold",
+            type=int,
+            default=None,
+            help="Hybrid pull threshold (default: 10%% of the accounts).",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        threshold = options["threshold"] or max(1, options["accounts"] // 10)
+        strategies = [
+            ("push", options["accounts"] + 1),
+            ("pull", 0),
+            (f"hybrid@{threshold}", threshold),
+        ]
+
+        try:
+            with transaction.atomic():
+                accounts = self.build_graph(options)
+                self.stdout.write(
+                    f"Graph: {len(accounts)} accounts, "
+                    f"{Follow.objects.filter(follower__in=accounts).count()} follows"
+                )
+                for name, strategy_threshold in strategies:
+                    self.run_strategy(name, strategy_threshold, accounts, options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def build_graph(self, options):
+        prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        Account.objects.bulk_create(
+            [
+                Account(
+                    username=f"{prefix}-{i}",
+                    email=f"{prefix}-{i}@example.com",
+                    password="!",
+                )
+                for i in range(options["accounts"])
+            ],
+            batch_size=1000,
+        )
+        accounts = list(Account.objects.filter(username__startswith=prefix))
+        celebrities = accounts[: options["celebrities"]]
+
+        follows = set()
+        for account in accounts:
+            # Most of the graph follows the celebrities, plus a random sample
+            for celebrity in celebrities:
+                if celebrity != account and random.random() < 0.8:
+                    follows.add((account.pk, celebrity.pk))
+            for followed in random.sample(
+                accounts, min(options["following"], len(accounts))
+            ):
+                if followed != account:
+                    follows.add((account.pk, followed.pk))
+        Follow.objects.bulk_create(
+            [Follow(follower_id=a, following_id=b) for a, b in follows],
+            batch_size=1000,
+        )
+        # bulk_create skips the counters, the pull threshold reads them
+        recount_account_stats(Account.objects.filter(username__startswith=prefix))
+        return accounts
+
+    def run_strategy(self, name, threshold, accounts, options):
+        sid = transaction.savepoint()
+
+        # Celebrities post as often as everyone else combined
+        celebrities = accounts[: options["celebrities"]] or accounts
+        authors = [random.choice(celebrities) for _ in range(options["posts"] // 2)]
+        authors += [
+            random.choice(accounts) for _ in range(options["posts"] - len(authors))
+        ]
+        random.shuffle(authors)
+
+        write_times = []
+        rows = 0
+        for author in authors:
+            # bulk_create skips the signal receivers so each strategy fans out
+            (post,) = Post.objects.bulk_create([Post(author=author, content="x")])
+            start = time.perf_counter()
+            rows += fan_out_post(post, threshold=threshold)
+            write_times.append(time.perf_counter() - start)
+
+        read_times = []
+        for reader in random.sample(accounts, min(options["readers"], len(accounts))):
+            start = time.perf_counter()
+            list(
+                home_timeline(reader, threshold=threshold, use_cache=False).order_by(
+                    "-feed_at", "-feed_post"
+                )[: options["page_size"]]
+            )
+            read_times.append(time.perf_counter() - start)
+
+        timeline_rows = TimelineEntry.objects.filter(owner__in=accounts).count()
+        transaction.savepoint_rollback(sid)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{name:>14}: {rows} rows written ({timeline_rows} stored), "
+                f"write {self.summarize(write_times)} per post, "
+                f"read {self.summarize(read_times)} per page"
+            )
+        )
+
+    def summarize(self, samples):
+        if not samples:
+            return "n/a"
+        samples = sorted(samples)
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return (
+            f"p50 {statistics.median(samples) * 1000:.2f}ms / p95 {p95 * 1000:.2f}ms"
+        )
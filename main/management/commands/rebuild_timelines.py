@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import Account
+from main.timeline import rebuild_timeline
+
+
+class Command(BaseCommand):
+    help = "Rebuild materialized home timelines from the follow graph"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--username",
+            action="append",
+            dest="usernames",
+            help="Only rebuild the given account (can be repeated).",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            accounts = Account.objects.all()
+            if options["usernames"]:
+                accounts = accounts.filter(username__in=options["usernames"])
+
+            rebuilt = written = 0
+            for account in accounts.iterator():
+                written += rebuild_timeline(account)
+                rebuilt += 1
+
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Rebuilt {rebuilt} timelines with {written} entries."
+                )
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
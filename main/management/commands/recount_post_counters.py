@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from main.counters import recount_post_counters
+from main.models import Post
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized like, reply, retweet and reaction counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--post",
+            type=int,
+            action="append",
+            dest="post_ids",
+            help="Only repair the given post id (can be repeated).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of posts per reaction histogram batch.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            queryset = Post.objects.all()
+            if options["post_ids"]:
+                queryset = queryset.filter(pk__in=options["post_ids"])
+
+            changed = recount_post_counters(
+                queryset, batch_size=options["batch_size"]
+            )
+
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Post counters recounted. Reaction histograms repaired: {changed}"
+                )
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"Unexpected error: {e}"))
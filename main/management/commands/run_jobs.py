@@ -0,0 +1,76 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main.jobs import work
+
+
+def run_worker(stop, options):
+    # Forked workers must not share the parent's database connections
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    work(
+        batch_size=options["batch_size"],
+        poll_interval=options["poll_interval"],
+        once=options["once"],
+        stop=stop,
+    )
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the database-backed job outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Worker processes to run side by side.",
+        )
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds between polls when no job is due.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Stop once no job is due instead of waiting for more.",
+        )
+
+    def handle(self, *args, **options):
+        stop = multiprocessing.Event()
+        if options["processes"] <= 1:
+            try:
+                total = work(
+                    batch_size=options["batch_size"],
+                    poll_interval=options["poll_interval"],
+                    once=options["once"],
+                    stop=stop,
+                )
+            except KeyboardInterrupt:
+                return
+            self.stdout.write(self.style.SUCCESS(f"Ran {total} jobs."))
+            return
+
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(stop, options))
+            for _ in range(options["processes"])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} job workers.")
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # Let every worker finish the job it is running
+            stop.set()
+            for worker in workers:
+                worker.join()
+        self.stdout.write(self.style.SUCCESS("Job workers stopped."))
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:09
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Post = apps.get_model("main", "Post")
+    Reaction = apps.get_model("main", "Reaction")
+
+    def count(queryset, group_by):
+        counts = queryset.order_by().values(group_by).annotate(total=Count("*"))
+        return Coalesce(Subquery(counts.values("total")[:1]), 0)
+
+    Post.objects.update(
+        likes_count=count(Post.likes.through.objects.filter(post=OuterRef("pk")), "post"),
+        replies_count=count(Post.objects.filter(parent=OuterRef("pk")), "parent"),
+        retweets_count=count(Post.objects.filter(original_post=OuterRef("pk")), "original_post"),
+    )
+
+    histograms = {}
+    rows = Reaction.objects.values("post_id", "emoji").annotate(total=Count("id")).order_by()
+    for row in rows:
+        histograms.setdefault(row["post_id"], {})[row["emoji"]] = row["total"]
+    for post_id, histogram in histograms.items():
+        Post.objects.filter(pk=post_id).update(reaction_counts=histogram)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_reaction_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='reaction_counts',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='replies_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='retweets_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
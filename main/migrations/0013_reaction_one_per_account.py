@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:40
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def dedupe_reactions(apps, schema_editor):
+    Post = apps.get_model("main", "Post")
+    Reaction = apps.get_model("main", "Reaction")
+
+    # Keep the most recent reaction of each account on each post
+    duplicates = (
+        Reaction.objects.values("post_id", "user_id")
+        .annotate(total=Count("id"), latest=Max("id"))
+        .filter(total__gt=1)
+        .order_by()
+    )
+    post_ids = set()
+    for row in duplicates:
+        Reaction.objects.filter(post_id=row["post_id"], user_id=row["user_id"]).exclude(
+            id=row["latest"]
+        ).delete()
+        post_ids.add(row["post_id"])
+
+    for post_id in post_ids:
+        histogram = {}
+        rows = Reaction.objects.filter(post_id=post_id).values("emoji").annotate(total=Count("id")).order_by()
+        for row in rows:
+            histogram[row["emoji"]] = row["total"]
+        Post.objects.filter(pk=post_id).update(reaction_counts=histogram)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_timelineentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_reactions, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='reaction',
+            unique_together={('post', 'user')},
+        ),
+    ]
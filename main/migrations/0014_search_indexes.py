@@ -0,0 +1,45 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:55
+
+from django.db import migrations
+
+# GIN expression indexes over the tsvector that main.search queries with.
+# SQLite gets FTS5 tables instead, see main.search.install_sqlite_fts.
+INDEXES = [
+    ("main", "Post", "post_content_search_idx", ("content",)),
+    ("accounts", "Account", "account_search_idx", ("username", "name", "bio")),
+]
+
+
+def gin_indexes(apps):
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+
+    for app_label, model_name, name, fields in INDEXES:
+        index = GinIndex(SearchVector(*fields, config="simple"), name=name)
+        yield apps.get_model(app_label, model_name), index
+
+
+def add_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for model, index in gin_indexes(apps):
+        schema_editor.add_index(model, index)
+
+
+def remove_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for model, index in gin_indexes(apps):
+        schema_editor.remove_index(model, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_account_updated_at'),
+        ('main', '0013_reaction_one_per_account'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_indexes, remove_search_indexes),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 22:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagemedia',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imagemedia',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_imagemedia_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagemedia',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='imagemedia',
+            name='variants',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -1,9 +1,61 @@
+import uuid
+
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models import Count, Exists, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 Account = get_user_model()
 
 
+def count_subquery(queryset, group_by):
+    """Correlated COUNT over ``queryset`` grouped on the outer reference field."""
+    counts = queryset.order_by().values(group_by).annotate(total=Count("*"))
+    return Coalesce(Subquery(counts.values("total")[:1]), 0)
+
+
+class PostQuerySet(models.QuerySet):
+    def for_feed(self, viewer=None):
+        """
+        Load everything PostSerializer renders in a fixed number of queries.
+
+        Engagement counts are read from the denormalized counter columns, the
+        viewer's like/reaction state is annotated on the main query, the
+        author and parent are joined, and media, tagged accounts and likers
+        are prefetched once for the whole page.
+        """
+        return (
+            self.select_related("author", "parent", "parent__author")
+            .prefetch_related(
+                "media",
+                "tagged_accounts",
+                Prefetch("likes", queryset=Account.objects.only("id")),
+            )
+            .with_viewer_state(viewer)
+        )
+
+    def with_viewer_state(self, viewer=None):
+        """Annotate ``viewer_liked`` and ``viewer_reaction`` for the viewer."""
+        if viewer is not None and viewer.is_authenticated:
+            return self.annotate(
+                viewer_liked=Exists(
+                    Post.likes.through.objects.filter(
+                        post=OuterRef("pk"), account=viewer.pk
+                    )
+                ),
+                viewer_reaction=Subquery(
+                    Reaction.objects.filter(post=OuterRef("pk"), user=viewer.pk).values(
+                        "emoji"
+                    )[:1]
+                ),
+            )
+        return self.annotate(
+            viewer_liked=Value(False),
+            viewer_reaction=Value(None, output_field=models.CharField()),
+        )
+
+
 class Post(models.Model):
     content = models.TextField()
     author = models.ForeignKey(Account, on_delete=models.CASCADE)
@@ -29,11 +81,28 @@ class Post(models.Model):
     # Fields for tracking interactions
     likes = models.ManyToManyField(Account, related_name="liked_posts", blank=True)
 
+    # Denormalized engagement counters, maintained by main.counters
+    likes_count = models.PositiveIntegerField(default=0)
+    replies_count = models.PositiveIntegerField(default=0)
+    retweets_count = models.PositiveIntegerField(default=0)
+    reaction_counts = models.JSONField(default=dict, blank=True)
+
+    objects = PostQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.author.username}: {self.content[:50]}"
 
     class Meta:
         ordering = ("-created_at",)
+        indexes = [
+            # Keyset pagination scans (created_at, id) within a feed
+            models.Index(
+                fields=["parent", "-created_at", "-id"], name="post_parent_feed_idx"
+            ),
+            models.Index(
+                fields=["author", "-created_at", "-id"], name="post_author_feed_idx"
+            ),
+        ]
 
 
 class Reaction(models.Model):
@@ -55,18 +124,77 @@ class Reaction(models.Model):
         return f"Post: {self.post.id} {self.user.username} reacted with {self.emoji}"
 
     class Meta:
-        unique_together = ("post", "user", "emoji")  # Prevent duplicate reactions
+        unique_together = ("post", "user")  # One reaction per account and post
 
 
 class ImageMedia(models.Model):
+    STATUS_CHOICES = [
+        ("processing", "Processing"),
+        ("ready", "Ready"),
+        ("failed", "Failed"),
+    ]
+
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="media")
-    image_url = models.URLField()
+    image_url = models.URLField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    image_hash = models.CharField(max_length=255)
+    image_hash = models.CharField(max_length=255, blank=True)
+    # Images uploaded in the background (main.jobs) are processing until the
+    # upload job stores them
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="ready")
+    # Size of the upload, so clients can lay the image out before it loads
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+    # SHA-256 of the uploaded bytes, which the stored files are named after so
+    # that identical uploads share them
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # Smaller copies, each a dict with its url, width, height and format
+    variants = models.JSONField(blank=True, default=list)
 
     def __str__(self):
         return f"Image for {self.post.id}"
 
+    def srcsets(self):
+        """
+        ``srcset`` attribute values by format, preferred format first.
+
+        The WebP set ends with the full-size image. Empty for images uploaded
+        before variants were made.
+        """
+        srcsets = {}
+        for variant in sorted(self.variants, key=lambda variant: variant["width"]):
+            srcsets.setdefault(variant["format"], []).append(
+                f"{variant['url']} {variant['width']}w"
+            )
+        if srcsets and self.width:
+            srcsets.setdefault("webp", []).append(f"{self.image_url} {self.width}w")
+        return {format: ", ".join(entries) for format, entries in srcsets.items()}
+
+
+class TimelineEntry(models.Model):
+    """A post materialized into an account's home timeline (fan-out-on-write)."""
+
+    owner = models.ForeignKey(
+        Account, on_delete=models.CASCADE, related_name="timeline_entries"
+    )
+    post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, related_name="timeline_entries"
+    )
+    author = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="+")
+    # Copy of post.created_at so the feed is a range scan over this table
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Post: {self.post_id} in timeline of {self.owner_id}"
+
+    class Meta:
+        unique_together = ("owner", "post")
+        indexes = [
+            models.Index(
+                fields=["owner", "-created_at", "-post"], name="timeline_owner_idx"
+            ),
+            models.Index(fields=["owner", "author"], name="timeline_owner_author_idx"),
+        ]
+
 
 class Feedback(models.Model):
     rating = models.CharField(max_length=5)
@@ -75,3 +203,70 @@ class Feedback(models.Model):
 
     def __str__(self):
         return f"feedback-{self.id}"
+
+
+class Job(models.Model):
+    """
+    A unit of background work in the database-backed job outbox (main.jobs).
+
+    Jobs are created in the same transaction as the change they follow up
+    on, so they exist exactly when it is committed.
+    """
+
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    kind = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    # Earliest time the job may run, pushed back after every failure
+    run_at = models.DateTimeField(default=timezone.now)
+    # A running job whose worker has not finished it by then is run again
+    locked_until = models.DateTimeField(blank=True, null=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.kind} job {self.id} ({self.status})"
+
+    class Meta:
+        indexes = [
+            # Workers pick the due jobs of a status, oldest first
+            models.Index(fields=["status", "run_at"], name="job_due_idx"),
+        ]
+
+
+class UploadSession(models.Model):
+    """
+    An image the client uploads straight to storage (main.uploads), then
+    attaches to a post or profile by id.
+    """
+
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("uploaded", "Uploaded"),
+        ("attached", "Attached"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        Account, on_delete=models.CASCADE, related_name="upload_sessions"
+    )
+    content_type = models.CharField(max_length=50)
+    # Declared by the client, the upload must have exactly this many bytes
+    size = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Uploads not attached by then are deleted
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Upload {self.id} of {self.owner_id} ({self.status})"
@@ -0,0 +1,276 @@
+import re
+from abc import ABC, abstractmethod
+
+from django.db import OperationalError, connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+from accounts.models import Account
+
+from .models import Post
+
+# The GIN index names are also used by migration 0014_search_indexes
+POST_SEARCH_FIELDS = ("content",)
+# Posts are also found by the username of their author
+POST_AUTHOR_SEARCH_FIELDS = ("username",)
+ACCOUNT_SEARCH_FIELDS = ("username", "name", "bio")
+POST_GIN_INDEX = "post_content_search_idx"
+ACCOUNT_GIN_INDEX = "account_search_idx"
+POST_FTS_TABLE = "main_post_fts"
+ACCOUNT_FTS_TABLE = "accounts_account_fts"
+SEARCH_CONFIG = "simple"
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class SearchBackend(ABC):
+    """
+    Full-text search over posts and accounts.
+
+    ``search_posts`` and ``search_accounts`` return querysets of matching
+    rows annotated with ``search_rank`` and ordered by relevance, so callers
+    can paginate, slice or filter them further.
+    """
+
+    @abstractmethod
+    def search_posts(self, query):
+        """Posts whose content or author's username matches ``query``."""
+
+    @abstractmethod
+    def search_accounts(self, query):
+        """Accounts matching ``query``."""
+
+
+class BasicSearchBackend(SearchBackend):
+    """Unindexed ``icontains`` matching, for databases without full-text search."""
+
+    def search_posts(self, query):
+        return (
+            Post.objects.filter(
+                Q(content__icontains=query) | Q(author__username__icontains=query)
+            )
+            .annotate(search_rank=Value(0.0, output_field=FloatField()))
+            .order_by("-created_at", "-id")
+        )
+
+    def search_accounts(self, query):
+        return (
+            Account.objects.filter(
+                Q(username__icontains=query)
+                | Q(name__icontains=query)
+                | Q(bio__icontains=query)
+            )
+            .annotate(search_rank=Value(0.0, output_field=FloatField()))
+            .order_by("-date_joined", "-id")
+        )
+
+
+def search_vector(*fields):
+    """The tsvector expression the GIN indexes are built on."""
+    from django.contrib.postgres.search import SearchVector
+
+    return SearchVector(*fields, config=SEARCH_CONFIG)
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    tsvector matching with ``ts_rank`` ordering.
+
+    Queries use the same ``to_tsvector`` expression as the GIN expression
+    indexes, so matching is an index scan and the index stays in sync with
+    every write without a stored column. Authors are matched on their
+    username alone, which the accounts index does not cover.
+    """
+
+    def _search(self, queryset, fields, query, extra=None):
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+
+        search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type="websearch")
+        condition = Q(search_document=search_query)
+        if extra is not None:
+            condition |= extra
+        return (
+            queryset.annotate(search_document=search_vector(*fields))
+            .filter(condition)
+            .annotate(search_rank=SearchRank(F("search_document"), search_query))
+        )
+
+    def search_posts(self, query):
+        authors = self._search(
+            Account.objects.all(), POST_AUTHOR_SEARCH_FIELDS, query
+        ).values("id")
+        return self._search(
+            Post.objects.all(), POST_SEARCH_FIELDS, query, Q(author_id__in=authors)
+        ).order_by("-search_rank", "-created_at", "-id")
+
+    def search_accounts(self, query):
+        return self._search(
+            Account.objects.all(), ACCOUNT_SEARCH_FIELDS, query
+        ).order_by("-search_rank", "-id")
+
+
+def fts5_query(query, columns=None):
+    """
+    Turn free text into an FTS5 query that matches every word.
+
+    Words are quoted so that FTS5 operators and punctuation in user input
+    are never interpreted; the last word also matches as a prefix. With
+    ``columns``, only those columns of the table are matched.
+    """
+    terms = _TERM_RE.findall(query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    if columns:
+        return f"{{{' '.join(columns)}}} : ({' '.join(quoted)})"
+    return " ".join(quoted)
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 matching with ``bm25`` ordering, for the SQLite development database.
+
+    The external-content FTS5 tables are kept in sync with the source tables
+    by the triggers that install_sqlite_fts creates.
+    """
+
+    def _matches(self, table, match):
+        return RawSQL(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", (match,))
+
+    def _search(self, queryset, table, query, extra=None):
+        match = fts5_query(query)
+        if match is None:
+            return queryset.none().annotate(
+                search_rank=Value(0.0, output_field=FloatField())
+            )
+        source = queryset.model._meta.db_table
+        # bm25() is lower for better matches, rows matched by ``extra`` only
+        # rank last
+        rank = RawSQL(
+            f"SELECT -bm25({table}) FROM {table} "
+            f'WHERE {table} MATCH %s AND {table}.rowid = "{source}"."id"',
+            (match,),
+            output_field=FloatField(),
+        )
+        condition = Q(id__in=self._matches(table, match))
+        if extra is not None:
+            condition |= extra
+        return queryset.filter(condition).annotate(
+            search_rank=Coalesce(rank, Value(0.0), output_field=FloatField())
+        )
+
+    def search_posts(self, query):
+        authors = None
+        match = fts5_query(query, POST_AUTHOR_SEARCH_FIELDS)
+        if match is not None:
+            authors = Q(author_id__in=self._matches(ACCOUNT_FTS_TABLE, match))
+        return self._search(
+            Post.objects.all(), POST_FTS_TABLE, query, authors
+        ).order_by("-search_rank", "-created_at", "-id")
+
+    def search_accounts(self, query):
+        return self._search(Account.objects.all(), ACCOUNT_FTS_TABLE, query).order_by(
+            "-search_rank", "-id"
+        )
+
+
+FTS_SOURCES = {
+    POST_FTS_TABLE: ("main_post", POST_SEARCH_FIELDS),
+    ACCOUNT_FTS_TABLE: ("accounts_account", ACCOUNT_SEARCH_FIELDS),
+}
+
+
+def install_sqlite_fts(using=connection):
+    """
+    Create the FTS5 tables and their sync triggers if they are missing.
+
+    Runs after every ``migrate`` rather than from a migration because
+    SQLite migrations that alter a table rebuild it, which drops its
+    triggers. Indexes are only rebuilt when something had to be created.
+
+    Returns:
+        bool: Whether anything was (re)created.
+    """
+    if using.vendor != "sqlite":
+        return False
+
+    with using.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        changed = False
+        for table, (source, fields) in FTS_SOURCES.items():
+            if source not in existing:
+                continue
+            columns = ", ".join(fields)
+            new_values = ", ".join(f"new.{field}" for field in fields)
+            old_values = ", ".join(f"old.{field}" for field in fields)
+            insert = (
+                f"INSERT INTO {table}(rowid, {columns}) VALUES (new.id, {new_values});"
+            )
+            delete = (
+                f"INSERT INTO {table}({table}, rowid, {columns}) "
+                f"VALUES ('delete', old.id, {old_values});"
+            )
+            statements = {
+                table: (
+                    f"CREATE VIRTUAL TABLE {table} USING fts5({columns}, "
+                    f"content='{source}', content_rowid='id', "
+                    f"tokenize='unicode61 remove_diacritics 2')"
+                ),
+                f"{table}_ai": (
+                    f"CREATE TRIGGER {table}_ai AFTER INSERT ON {source} "
+                    f"BEGIN {insert} END"
+                ),
+                f"{table}_ad": (
+                    f"CREATE TRIGGER {table}_ad AFTER DELETE ON {source} "
+                    f"BEGIN {delete} END"
+                ),
+                # Counter and timestamp updates do not touch the index
+                f"{table}_au": (
+                    f"CREATE TRIGGER {table}_au AFTER UPDATE OF {columns} ON {source} "
+                    f"BEGIN {delete} {insert} END"
+                ),
+            }
+            missing = [name for name in statements if name not in existing]
+            try:
+                for name in missing:
+                    cursor.execute(statements[name])
+            except OperationalError:
+                # SQLite built without FTS5: keep the icontains fallback
+                return False
+            if missing:
+                cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+                changed = True
+    _backends.pop(using.vendor, None)
+    return changed
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """Return the search backend for the default database."""
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == "postgresql":
+            _backends[vendor] = PostgresSearchBackend()
+        elif (
+            vendor == "sqlite"
+            and POST_FTS_TABLE in connection.introspection.table_names()
+        ):
+            _backends[vendor] = SQLiteSearchBackend()
+        else:
+            _backends[vendor] = BasicSearchBackend()
+    return _backends[vendor]
+
+
+def search_posts(query):
+    return get_search_backend().search_posts(query)
+
+
+def search_accounts(query):
+    return get_search_backend().search_accounts(query)
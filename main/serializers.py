@@ -1,20 +1,64 @@
 import json
 
+from django.conf import settings
 from django.contrib.humanize.templatetags.humanize import naturalday, naturaltime
-from django.db.models import Count
+from django.db import models, transaction
 from rest_framework import serializers
 
 from accounts.models import Account
 from accounts.serializers import BasicAccountSerializer
 
-from .models import Feedback, ImageMedia, Post, Reaction
-from .utils import get_image_hash, upload_images
+from .cache import serialize_posts
+from .counters import adjust_post_counter, reaction_histogram
+from .executor import MediaExecutorBusy, MediaTaskTimeout
+from .jobs import (
+    create_processing_images,
+    create_upload_images,
+    media_jobs_enabled,
+    stage_images,
+)
+from .models import Feedback, ImageMedia, Post, Reaction, UploadSession
+from .uploads import (
+    UPLOAD_CONTENT_TYPES,
+    UploadError,
+    claim_uploads,
+    create_upload_session,
+    discard_uploads,
+    store_uploads,
+    upload_storage,
+    uploaded_sessions,
+)
+from .utils import process_and_upload_images
 
 
 class PostImageSerializer(serializers.ModelSerializer):
+    srcset = serializers.SerializerMethodField()
+    sources = serializers.SerializerMethodField()
+
     class Meta:
         model = ImageMedia
-        fields = ["image_url", "image_hash", "id"]
+        fields = [
+            "image_url",
+            "image_hash",
+            "width",
+            "height",
+            "srcset",
+            "sources",
+            "status",
+            "id",
+        ]
+
+    def get_srcset(self, obj):
+        # WebP, which every client decodes
+        return obj.srcsets().get("webp")
+
+    def get_sources(self, obj):
+        # Smaller formats for <picture> sources, preferred first
+        return [
+            {"type": f"image/{format}", "srcset": srcset}
+            for format, srcset in obj.srcsets().items()
+            if format != "webp"
+        ]
 
 
 class BasicPostSerializer(serializers.ModelSerializer):
@@ -25,11 +69,20 @@ class BasicPostSerializer(serializers.ModelSerializer):
         fields = ["id", "author", "parent", "content"]
 
 
+class PostListSerializer(serializers.ListSerializer):
+    """Render a page of posts through the two-layer payload cache."""
+
+    def to_representation(self, data):
+        posts = data.all() if isinstance(data, models.manager.BaseManager) else data
+        request = self.context.get("request")
+        viewer = request.user if request else None
+        return serialize_posts(posts, type(self.child), viewer)
+
+
 class PostSerializer(serializers.ModelSerializer):
     author = BasicAccountSerializer(read_only=True)
-    comments = serializers.SerializerMethodField()
+    comments = serializers.IntegerField(source="replies_count", read_only=True)
     is_liked = serializers.SerializerMethodField()
-    likes_count = serializers.SerializerMethodField()
     natural_time_created = serializers.SerializerMethodField()
     natural_date_created = serializers.SerializerMethodField()
     parent = BasicPostSerializer()
@@ -40,6 +93,7 @@ class PostSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Post
+        list_serializer_class = PostListSerializer
         fields = [
             "id",
             "content",
@@ -55,6 +109,7 @@ class PostSerializer(serializers.ModelSerializer):
             "views",
             "is_liked",
             "likes_count",
+            "retweets_count",
             "tagged_accounts",
             "images",
             "reaction",
@@ -62,21 +117,15 @@ class PostSerializer(serializers.ModelSerializer):
             "tagged_link",
         ]
 
-    def get_comments(self, obj):
-        # Return the count of comments that have the current post as their parent
-        return Post.objects.filter(parent=obj).count()
-
     def get_is_liked(self, obj):
+        if hasattr(obj, "viewer_liked"):
+            return obj.viewer_liked
         # Get the current user from the context
         request = self.context.get("request")
         if request and not request.user.is_anonymous:
             return obj.likes.filter(id=request.user.id).exists()
         return False
 
-    def get_likes_count(self, obj):
-        # Efficiently return the count of likes
-        return obj.likes.count()
-
     def get_natural_time_created(self, obj):
         # Return the natural time (e.g., '10 minutes ago')
         return naturaltime(obj.created_at)
@@ -86,10 +135,12 @@ class PostSerializer(serializers.ModelSerializer):
         return naturalday(obj.created_at)
 
     def get_images(self, obj):
-        images = ImageMedia.objects.filter(post=obj)
-        return PostImageSerializer(images, many=True).data
+        # obj.media.all() reuses the prefetched images when present
+        return PostImageSerializer(obj.media.all(), many=True).data
 
     def get_reaction(self, obj):
+        if hasattr(obj, "viewer_reaction"):
+            return obj.viewer_reaction
         request = self.context.get("request")
         if request and not request.user.is_anonymous:
             try:
@@ -100,23 +151,8 @@ class PostSerializer(serializers.ModelSerializer):
         return None
 
     def get_post_reactions(self, obj):
-        reactions = {
-            "anger": 0,
-            "laughing": 0,
-            "sad": 0,
-            "hundred": 0,
-            "thumbs-up": 0,
-            "hot": 0,
-        }
-
-        # Query the reactions for this post
-        post_reactions = obj.reactions.values("emoji").annotate(count=Count("emoji"))
-
-        # Fill the reactions dictionary with the counts
-        for reaction in post_reactions:
-            reactions[reaction["emoji"]] = reaction["count"]
-
-        return reactions
+        # Read from the denormalized histogram, no query per post
+        return reaction_histogram(obj.reaction_counts)
 
 
 class CreatePostSerializer(serializers.Serializer):
@@ -128,6 +164,17 @@ class CreatePostSerializer(serializers.Serializer):
         child=serializers.FileField(), required=False, write_only=True
     )
     tagged_link = serializers.URLField(required=False)
+    # Upload sessions to attach, see main.uploads
+    upload_ids = serializers.ListField(
+        child=serializers.UUIDField(), required=False, write_only=True
+    )
+
+    def validate_upload_ids(self, value):
+        try:
+            uploaded_sessions(self.context["request"].user, value)
+        except UploadError as e:
+            raise serializers.ValidationError(str(e))
+        return value
 
     def create(self, validated_data):
         user = self.context["request"].user
@@ -170,36 +217,62 @@ class CreatePostSerializer(serializers.Serializer):
             tagged_accounts = [tagged_accounts]
         # Extract files from request.FILES (since files are handled separately from validated_data)
         files = validated_data.pop("files", [])
-        # Create the post
-        post = Post.objects.create(author=user, parent=parent, **validated_data)
-
-        # Add tagged accounts to the post
-        if tagged_accounts:
-            tagged_users = Account.objects.filter(username__in=tagged_accounts)
-            post.tagged_accounts.add(*tagged_users)
-
-        # Handle files and attach them to the post (assuming you have a PostImage model)
-        if files:
+        try:
+            sessions = uploaded_sessions(user, validated_data.pop("upload_ids", []))
+        except UploadError as e:
+            raise serializers.ValidationError(str(e))
+        background = media_jobs_enabled()
+
+        # Upload before creating anything, so a busy media executor (429) or
+        # a failed upload leaves no post behind
+        images = []
+        digests = []
+        if files and background:
+            # Upload in the background instead, see create_processing_images
+            digests = stage_images(files)
+        elif (files or sessions) and not background:
             try:
-                # Upload all images concurrently
-                image_urls = upload_images(
+                # Decode each image once for its hash and size while it
+                # uploads; direct uploads are processed where they are
+                images = process_and_upload_images(
                     files, request=self.context.get("request"), folder="posts"
+                ) + store_uploads(
+                    sessions, request=self.context.get("request"), folder="posts"
                 )
-                print(image_urls)
-                for index, file in enumerate(files):
-                    hash = get_image_hash(file)
-                    image_url = image_urls[index]  # Get corresponding image URL
-
-                    # Create and save the image entry in the database
-                    new_file = ImageMedia.objects.create(
-                        post=post, image_url=image_url, image_hash=hash
-                    )
-                    new_file.save()
+            except (MediaExecutorBusy, MediaTaskTimeout):
+                raise
             except Exception:
                 raise serializers.ValidationError(
                     "An error occurred while uploading the images."
                 )
 
+        # Create the post
+        with transaction.atomic():
+            post = Post.objects.create(author=user, parent=parent, **validated_data)
+            if parent:
+                adjust_post_counter(parent.id, "replies_count", 1)
+            # Create and save the image entries in the database
+            ImageMedia.objects.bulk_create(
+                [ImageMedia(post=post, **image) for image in images]
+            )
+            if digests:
+                create_processing_images(post, digests, folder="posts")
+            if sessions:
+                try:
+                    claim_uploads(sessions)
+                except UploadError as e:
+                    raise serializers.ValidationError(str(e))
+                if background:
+                    create_upload_images(post, sessions, folder="posts")
+                else:
+                    upload_ids = [session.id for session in sessions]
+                    transaction.on_commit(lambda: discard_uploads(upload_ids))
+
+        # Add tagged accounts to the post
+        if tagged_accounts:
+            tagged_users = Account.objects.filter(username__in=tagged_accounts)
+            post.tagged_accounts.add(*tagged_users)
+
         return post
 
     def save(self, **kwargs):
@@ -207,6 +280,33 @@ class CreatePostSerializer(serializers.Serializer):
         return self.create(validated_data)
 
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    content_type = serializers.ChoiceField(choices=UPLOAD_CONTENT_TYPES)
+    size = serializers.IntegerField(min_value=1)
+    upload = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ["id", "content_type", "size", "status", "expires_at", "upload"]
+        read_only_fields = ["id", "status", "expires_at"]
+
+    def validate_size(self, value):
+        if value > settings.UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(
+                f"Uploads may be at most {settings.UPLOAD_MAX_BYTES} bytes."
+            )
+        return value
+
+    def get_upload(self, obj):
+        # Where and how to send the bytes, while the session waits for them
+        if obj.status != "pending":
+            return None
+        return upload_storage().target(obj, self.context.get("request"))
+
+    def create(self, validated_data):
+        return create_upload_session(self.context["request"].user, **validated_data)
+
+
 class FeedbackSerializer(serializers.ModelSerializer):
     class Meta:
         model = Feedback
@@ -0,0 +1,104 @@
+from django.db import connections, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from accounts.models import Account, Follow
+from accounts.utils import adjust_account_stats
+
+from .cache import bump_account_version, bump_post_version
+from .models import ImageMedia, Post, Reaction
+from .search import install_sqlite_fts
+from .timeline import (
+    author_unfollowed,
+    backfill_timeline,
+    fan_out_post,
+    remove_from_timeline,
+)
+
+
+@receiver(post_save, sender=Post, dispatch_uid="fan_out_new_post")
+def fan_out_new_post(sender, instance, created, **kwargs):
+    if created:
+        fan_out_post(instance)
+
+
+@receiver(post_save, sender=Follow, dispatch_uid="backfill_timeline_on_follow")
+def backfill_timeline_on_follow(sender, instance, created, **kwargs):
+    if created:
+        backfill_timeline(instance.follower, instance.following)
+
+
+@receiver(post_delete, sender=Follow, dispatch_uid="trim_timeline_on_unfollow")
+def trim_timeline_on_unfollow(sender, instance, **kwargs):
+    remove_from_timeline(instance.follower_id, instance.following_id)
+    author_unfollowed(instance.following_id)
+
+
+@receiver(post_save, sender=Post, dispatch_uid="count_new_post")
+def count_new_post(sender, instance, created, **kwargs):
+    # Profiles count top-level posts only
+    if created and instance.parent_id is None:
+        adjust_account_stats(instance.author_id, posts_count=1)
+        author_id = instance.author_id
+        transaction.on_commit(lambda: bump_account_version(author_id))
+
+
+@receiver(post_delete, sender=Post, dispatch_uid="count_deleted_post")
+def count_deleted_post(sender, instance, **kwargs):
+    if instance.parent_id is None:
+        adjust_account_stats(instance.author_id, posts_count=-1)
+        author_id = instance.author_id
+        transaction.on_commit(lambda: bump_account_version(author_id))
+
+
+# Post payload cache invalidation. Versions are bumped once the transaction
+# commits, so a payload rebuilt in between cannot capture half of a change.
+
+
+@receiver(post_save, sender=Post, dispatch_uid="invalidate_saved_post")
+@receiver(post_delete, sender=Post, dispatch_uid="invalidate_deleted_post")
+def invalidate_post(sender, instance, **kwargs):
+    # The parent embeds the reply count, the retweeted post the retweet count
+    post_ids = (instance.pk, instance.parent_id, instance.original_post_id)
+    transaction.on_commit(lambda: bump_post_version(*post_ids))
+
+
+@receiver(post_save, sender=Reaction, dispatch_uid="invalidate_reacted_post")
+@receiver(post_delete, sender=Reaction, dispatch_uid="invalidate_unreacted_post")
+@receiver(post_save, sender=ImageMedia, dispatch_uid="invalidate_post_media")
+@receiver(post_delete, sender=ImageMedia, dispatch_uid="invalidate_deleted_media")
+def invalidate_post_relation(sender, instance, **kwargs):
+    post_id = instance.post_id
+    transaction.on_commit(lambda: bump_post_version(post_id))
+
+
+@receiver(m2m_changed, sender=Post.likes.through, dispatch_uid="invalidate_likes")
+@receiver(
+    m2m_changed, sender=Post.tagged_accounts.through, dispatch_uid="invalidate_tags"
+)
+def invalidate_post_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    post_ids = set(pk_set or ()) if reverse else {instance.pk}
+    transaction.on_commit(lambda: bump_post_version(*post_ids))
+
+
+@receiver(post_save, sender=Account, dispatch_uid="invalidate_account_card")
+def invalidate_account(sender, instance, **kwargs):
+    account_id = instance.pk
+    transaction.on_commit(lambda: bump_account_version(account_id))
+
+
+@receiver(post_save, sender=Follow, dispatch_uid="invalidate_followed_cards")
+@receiver(post_delete, sender=Follow, dispatch_uid="invalidate_unfollowed_cards")
+def invalidate_follow(sender, instance, **kwargs):
+    # Account cards embed follower and following counts
+    account_ids = (instance.follower_id, instance.following_id)
+    transaction.on_commit(lambda: bump_account_version(*account_ids))
+
+
+@receiver(post_migrate, dispatch_uid="install_sqlite_fts")
+def install_search_tables(sender, using, plan=None, **kwargs):
+    # Only once per migrate run, after the last app
+    if sender.label == "main":
+        install_sqlite_fts(connections[using])
@@ -1,3 +1,1368 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import blurhash
+import cloudinary
+import numpy as np
+from django.core.cache import cache
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection, transaction
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import ExifTags, Image
+from rest_framework import serializers
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from accounts.models import Account, AccountStats
+from accounts.serializers import BasicAccountSerializer, UpdateProfileSerializer
+from base.utils import encode_cursor
+
+from . import cache as payload_cache
+from . import jobs, uploads
+from .counters import (
+    ViewCounterBuffer,
+    recount_post_counters,
+    toggle_like,
+    upsert_reaction,
+)
+from .executor import (
+    MediaExecutor,
+    MediaExecutorBusy,
+    MediaTaskTimeout,
+    media_executor,
+)
+from .hashing import encode_images, hash_images, prepare_image
+from .images import process_images
+from .jobs import claim_jobs, enqueue, register, run_due_jobs, run_job
+from .models import ImageMedia, Job, Post, Reaction, TimelineEntry, UploadSession
+from .search import (
+    BasicSearchBackend,
+    SQLiteSearchBackend,
+    get_search_backend,
+    search_posts,
+)
+from .timeline import BACKFILL_FOLLOWERS_JOB, TRIM_TIMELINES_JOB, get_pull_author_ids
+from .utils import process_and_upload_images
+
+
+def jpeg(color=(200, 30, 30), size=(800, 600)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class MediaTestCase(APITestCase):
+    """Stores images and uploads locally, in a directory removed afterwards."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings = override_settings(
+            IMAGE_BACKEND="local",
+            MEDIA_JOBS_ENABLED=False,
+            MEDIA_ROOT=media_root,
+            MEDIA_STAGING_ROOT=f"{media_root}/staging",
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        uploads.emulator_storage.cache_clear()
+        self.addCleanup(uploads.emulator_storage.cache_clear)
+        cache.clear()
+
+        self.user = Account.objects.create_user("user@example.com", "user")
+        self.client.force_authenticate(self.user)
+
+
+class UploadSessionTests(MediaTestCase):
+    def start_upload(self, content, **data):
+        data = {"content_type": "image/jpeg", "size": len(content), **data}
+        return self.client.post(reverse("create_upload"), data, format="json")
+
+    def put_content(self, upload, content, content_type="image/jpeg"):
+        return self.client.generic(
+            "PUT", upload["url"], data=content, content_type=content_type
+        )
+
+    def upload(self, content):
+        """Create, send and complete an upload, returning its id."""
+        response = self.start_upload(content)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            self.put_content(response.data["upload"], content).status_code, 204
+        )
+        upload_id = response.data["id"]
+        response = self.client.post(reverse("complete_upload", args=[upload_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "uploaded")
+        return upload_id
+
+    def create_post(self, upload_ids):
+        return self.client.post(
+            reverse("create_post"),
+            {"content": "hello", "upload_ids": upload_ids},
+            format="json",
+        )
+
+    def test_upload_is_attached_to_a_post(self):
+        content = jpeg(size=(800, 600))
+        upload_id = self.upload(content)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.create_post([upload_id])
+
+        self.assertEqual(response.status_code, 201)
+        image = ImageMedia.objects.get(post_id=response.data["id"])
+        self.assertEqual(image.status, "ready")
+        self.assertEqual((image.width, image.height), (800, 600))
+        self.assertTrue(image.image_hash)
+        self.assertTrue(image.variants)
+        # The session and its bytes are gone once attached
+        self.assertFalse(UploadSession.objects.filter(id=upload_id).exists())
+        self.assertFalse(uploads.emulator_storage().exists(upload_id))
+
+    def test_upload_is_processed_in_the_background(self):
+        upload_id = self.upload(jpeg())
+
+        with self.settings(MEDIA_JOBS_ENABLED=True):
+            response = self.create_post([upload_id])
+            self.assertEqual(response.status_code, 201)
+            image = ImageMedia.objects.get(post_id=response.data["id"])
+            self.assertEqual(image.status, "processing")
+
+            run_due_jobs()
+
+        image.refresh_from_db()
+        self.assertEqual(image.status, "ready")
+        self.assertFalse(UploadSession.objects.filter(id=upload_id).exists())
+
+    def test_completing_before_the_upload_conflicts(self):
+        response = self.start_upload(jpeg())
+
+        response = self.client.post(
+            reverse("complete_upload", args=[response.data["id"]])
+        )
+
+        self.assertEqual(response.status_code, 409)
+
+    def test_expired_session_rejects_content(self):
+        content = jpeg()
+        response = self.start_upload(content)
+        UploadSession.objects.filter(id=response.data["id"]).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        response = self.put_content(response.data["upload"], content)
+
+        self.assertEqual(response.status_code, 410)
+
+    def test_expired_session_cannot_be_attached(self):
+        upload_id = self.upload(jpeg())
+        UploadSession.objects.filter(id=upload_id).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        response = self.create_post([upload_id])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("upload_ids", response.data)
+        self.assertFalse(Post.objects.exists())
+        self.assertEqual(uploads.purge_uploads(), 1)
+        self.assertFalse(uploads.emulator_storage().exists(upload_id))
+
+    def test_oversize_session_is_refused(self):
+        with self.settings(UPLOAD_MAX_BYTES=1000):
+            response = self.start_upload(b"", size=1001)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("size", response.data)
+
+    def test_content_larger_than_declared_is_refused(self):
+        content = jpeg()
+        response = self.start_upload(content, size=len(content) - 1)
+        upload = response.data["upload"]
+
+        self.assertEqual(self.put_content(upload, content).status_code, 413)
+        self.assertEqual(
+            UploadSession.objects.get(id=response.data["id"]).status, "pending"
+        )
+
+    def test_content_of_another_type_is_refused(self):
+        content = jpeg()
+        response = self.start_upload(content)
+
+        response = self.put_content(response.data["upload"], content, "image/png")
+
+        self.assertEqual(response.status_code, 415)
+
+    def test_session_is_attached_once(self):
+        upload_id = self.upload(jpeg())
+        self.assertEqual(self.create_post([upload_id]).status_code, 201)
+
+        response = self.create_post([upload_id])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_session_is_attached_to_a_profile_or_a_post(self):
+        upload_id = self.upload(jpeg())
+        request = APIRequestFactory().patch(reverse("update"))
+        request.user = self.user
+        serializer = UpdateProfileSerializer(
+            self.user,
+            data={"profile_image_upload": upload_id},
+            partial=True,
+            context={"request": request},
+        )
+        self.assertTrue(serializer.is_valid())
+
+        # A post attaches the session between validation and saving
+        self.assertEqual(self.create_post([upload_id]).status_code, 201)
+
+        with self.assertRaises(serializers.ValidationError):
+            serializer.save()
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.profile_image_url)
+
+    def update_profile(self, upload_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.patch(
+                reverse("update"), {"profile_image_upload": upload_id}, format="json"
+            )
+
+    def test_upload_is_attached_to_a_profile(self):
+        upload_id = self.upload(jpeg())
+
+        self.assertEqual(self.update_profile(upload_id).status_code, 200)
+
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.profile_image_url)
+        self.assertTrue(self.user.profile_image_hash)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_failed_profile_upload_can_be_attached_again(self):
+        upload_id = self.upload(jpeg())
+
+        for error, status in [(MediaExecutorBusy(), 429), (OSError("down"), 400)]:
+            with mock.patch("accounts.serializers.store_uploads", side_effect=error):
+                self.assertEqual(self.update_profile(upload_id).status_code, status)
+            self.assertEqual(UploadSession.objects.get(id=upload_id).status, "uploaded")
+
+        self.assertEqual(self.update_profile(upload_id).status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.profile_image_url)
+
+    def test_busy_media_executor_is_a_429(self):
+        upload_id = self.upload(jpeg())
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        with override_settings(MEDIA_WORKERS=1, MEDIA_QUEUE_SIZE=0):
+            blocked = media_executor.submit(release.wait, [10])
+            response = self.create_post([upload_id])
+            release.set()
+            blocked.results()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(UploadSession.objects.get(id=upload_id).status, "uploaded")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.create_post([upload_id]).status_code, 201)
+
+    def test_session_of_another_account_cannot_be_attached(self):
+        upload_id = self.upload(jpeg())
+        other = Account.objects.create_user("other@example.com", "other")
+        self.client.force_authenticate(other)
+
+        self.assertEqual(
+            self.client.post(reverse("complete_upload", args=[upload_id])).status_code,
+            404,
+        )
+        self.assertEqual(self.create_post([upload_id]).status_code, 400)
+
+
+class CloudinaryUploadStorageTests(MediaTestCase):
+    def test_upload_is_stored_without_downloading_it(self):
+        session = UploadSession.objects.create(
+            owner=self.user,
+            content_type="image/jpeg",
+            size=1000,
+            expires_at=timezone.now() + timedelta(minutes=10),
+            status="attached",
+        )
+        resource = {
+            "public_id": f"posts/{session.id}",
+            "version": 7,
+            "width": 1200,
+            "height": 900,
+        }
+        thumbnail = mock.MagicMock()
+        thumbnail.__enter__.return_value.read.return_value = jpeg(size=(100, 75))
+
+        config = mock.patch.object(
+            cloudinary.config(), "cloud_name", "demo", create=True
+        )
+        with config, mock.patch("main.uploads.rename", return_value=resource) as rename:
+            with mock.patch("main.uploads.urlopen", return_value=thumbnail) as urlopen:
+                [image] = uploads.cloudinary_uploads.store([session], folder="posts")
+
+        rename.assert_called_once()
+        self.assertEqual(
+            rename.call_args.args, (f"uploads/{session.id}", resource["public_id"])
+        )
+        # Only the thumbnail is fetched
+        self.assertIn("/c_limit,h_100,w_100/", urlopen.call_args.args[0])
+        self.assertTrue(image["image_url"].endswith(f"/v7/posts/{session.id}.webp"))
+        self.assertEqual((image["width"], image["height"]), (1200, 900))
+        self.assertTrue(image["image_hash"])
+        self.assertTrue(image["variants"])
+        self.assertEqual(image["content_hash"], "")
+
+
+@override_settings(MEDIA_WORKERS=1, MEDIA_QUEUE_SIZE=1, MEDIA_TASK_TIMEOUT=5)
+class MediaExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = MediaExecutor(name="test-media")
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_call_that_does_not_fit_is_rejected_as_a_whole(self):
+        # One task running, one waiting: the queue is full
+        blocked = self.executor.submit(self.release.wait, [5, 5])
+
+        with self.assertRaises(MediaExecutorBusy) as raised:
+            self.executor.map(abs, [-1])
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual((self.executor.submitted, self.executor.rejected), (2, 1))
+
+        self.release.set()
+        self.assertEqual(blocked.results(), [True, True])
+        self.assertEqual(self.executor.map(abs, [-1, -2]), [1, 2])
+        self.assertEqual(self.executor.as_dict()["in_flight"], 0)
+
+    def test_tasks_are_waited_for_at_most_the_timeout(self):
+        batch = self.executor.submit(self.release.wait, [5, 5])
+
+        with self.assertRaises(MediaTaskTimeout):
+            batch.results(timeout=0.05)
+        # The waiting task was cancelled and its place freed
+        self.release.set()
+        self.assertTrue(batch.futures[1].cancelled())
+        self.assertEqual(self.executor.timed_out, 1)
+        self.assertEqual(self.executor.map(abs, [-3]), [3])
+
+    def test_exceptions_of_tasks_are_raised(self):
+        with self.assertRaises(ZeroDivisionError):
+            self.executor.map(divmod, [1], [0])
+        self.assertEqual(self.executor.failed, 1)
+
+
+class PostListQueryTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        accounts = [
+            Account.objects.create_user(f"user{index}@example.com", f"user{index}")
+            for index in range(4)
+        ]
+        for index in range(8):
+            post = Post.objects.create(author=accounts[index % 4], content="hello")
+            post.tagged_accounts.add(accounts[(index + 1) % 4])
+            post.likes.add(accounts[0])
+            ImageMedia.objects.create(post=post, image_url="https://example.com/a.webp")
+            Reaction.objects.create(post=post, user=accounts[1], emoji="hot")
+        self.client.force_authenticate(accounts[0])
+
+    def test_page_costs_the_same_queries_whatever_its_size(self):
+        # The page, its posts for the payloads, their images, tagged accounts
+        # and likes, the accounts' figures, the viewer's likes and reactions
+        # and the viewer's follows
+        for page_size in (2, 8):
+            cache.clear()
+            with self.assertNumQueries(8):
+                response = self.client.get(
+                    reverse("post_list"),
+                    {"pagination": "cursor", "page_size": page_size},
+                )
+            self.assertEqual(len(response.data["results"]), page_size)
+
+
+class PostCounterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.reader = Account.objects.create_user("reader@example.com", "reader")
+        self.post = Post.objects.create(author=self.author, content="hello")
+        self.client.force_authenticate(self.reader)
+
+    def test_replies_are_counted(self):
+        reply = Post.objects.create(author=self.reader, parent=self.post, content="hi")
+        response = self.client.post(
+            reverse("create_post_comment", args=[self.post.id]),
+            {"content": "hi again"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.post.refresh_from_db()
+        # Only replies made through the API are counted as they happen
+        self.assertEqual(self.post.replies_count, 1)
+
+        recount_post_counters()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.replies_count, 2)
+
+        self.client.force_authenticate(self.reader)
+        self.client.delete(reverse("delete_action", args=[reply.id]))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.replies_count, 1)
+
+    def test_recount_repairs_drifted_counters(self):
+        toggle_like(self.post.id, self.reader.id)
+        upsert_reaction(self.post.id, self.reader.id, "hot")
+        Post.objects.filter(pk=self.post.pk).update(
+            likes_count=7, reaction_counts={"sad": 3}
+        )
+
+        self.assertEqual(recount_post_counters(), 1)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 1)
+        self.assertEqual(self.post.reaction_counts, {"hot": 1})
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.posts = [
+            Post.objects.create(author=self.author, content=f"post {index}")
+            for index in range(7)
+        ]
+        # Ties on created_at are broken by id
+        Post.objects.filter(pk__in=[post.pk for post in self.posts[2:5]]).update(
+            created_at=self.posts[2].created_at
+        )
+
+    def get_page(self, **params):
+        response = self.client.get(
+            reverse("post_list"), {"pagination": "cursor", "page_size": 3, **params}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def ids(self, page):
+        return [post["id"] for post in page["results"]]
+
+    def test_pages_walk_every_post_once_newest_first(self):
+        newest_first = sorted(
+            Post.objects.values_list("created_at", "id"), reverse=True
+        )
+        seen = []
+        page = self.get_page()
+        self.assertIsNone(page["previous"])
+        while True:
+            seen += self.ids(page)
+            if page["next"] is None:
+                break
+            page = self.get_page(cursor=page["next"])
+
+        self.assertEqual(seen, [pk for _, pk in newest_first])
+
+    def test_previous_cursor_returns_the_previous_page(self):
+        first = self.get_page()
+        second = self.get_page(cursor=first["next"])
+
+        back = self.get_page(cursor=second["previous"])
+
+        self.assertEqual(self.ids(back), self.ids(first))
+        self.assertIsNone(back["previous"])
+
+    def test_new_posts_do_not_shift_later_pages(self):
+        first = self.get_page()
+        expected = self.ids(self.get_page(cursor=first["next"]))
+
+        Post.objects.create(author=self.author, content="newer")
+
+        self.assertEqual(self.ids(self.get_page(cursor=first["next"])), expected)
+
+    def test_invalid_cursor_is_not_found(self):
+        for cursor in ["not-a-cursor", encode_cursor({"t": "yesterday", "i": 1})]:
+            response = self.client.get(
+                reverse("post_list"), {"pagination": "cursor", "cursor": cursor}
+            )
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(TIMELINE_PULL_FOLLOWER_THRESHOLD=3)
+class TimelineTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.reader = Account.objects.create_user("reader@example.com", "reader")
+        self.client.force_authenticate(self.reader)
+
+    def feed(self):
+        response = self.client.get(reverse("home_feed"))
+        self.assertEqual(response.status_code, 200)
+        return [post["id"] for post in response.data["results"]]
+
+    def make_popular(self, author):
+        for index in range(3):
+            Account.objects.create_user(
+                f"fan{index}@example.com", f"fan{index}"
+            ).follow(author)
+        cache.clear()
+
+    def test_posts_are_pushed_to_followers(self):
+        self.reader.follow(self.author)
+
+        post = Post.objects.create(author=self.author, content="hello")
+        reply = Post.objects.create(author=self.author, parent=post, content="hi")
+
+        self.assertTrue(
+            TimelineEntry.objects.filter(owner=self.reader, post=post).exists()
+        )
+        self.assertFalse(TimelineEntry.objects.filter(post=reply).exists())
+        self.assertEqual(self.feed(), [post.id])
+
+    def test_follow_backfills_and_unfollow_removes(self):
+        older = Post.objects.create(author=self.author, content="older")
+
+        self.reader.follow(self.author)
+        self.assertEqual(self.feed(), [older.id])
+
+        self.reader.unfollow(self.author)
+        self.assertEqual(self.feed(), [])
+
+    @override_settings(TIMELINE_MAX_ENTRIES=3, TIMELINE_TRIM_INTERVAL=0)
+    def test_fan_out_keeps_timelines_capped(self):
+        self.reader.follow(self.author)
+        posts = [
+            Post.objects.create(author=self.author, content=f"post {index}")
+            for index in range(5)
+        ]
+        # One trim however many posts were pushed
+        self.assertEqual(Job.objects.filter(kind=TRIM_TIMELINES_JOB).count(), 1)
+
+        run_due_jobs()
+
+        newest = [post.id for post in reversed(posts[2:])]
+        for owner in (self.reader, self.author):
+            timeline = TimelineEntry.objects.filter(owner=owner).order_by(
+                "-created_at", "-post_id"
+            )
+            self.assertEqual(list(timeline.values_list("post_id", flat=True)), newest)
+        self.assertEqual(self.feed(), newest)
+
+    def test_posts_of_popular_authors_are_pulled(self):
+        self.reader.follow(self.author)
+        self.make_popular(self.author)
+
+        post = Post.objects.create(author=self.author, content="hello")
+
+        self.assertIn(self.author.id, get_pull_author_ids())
+        # Only the author's own timeline gets a row
+        self.assertEqual(
+            list(
+                TimelineEntry.objects.filter(post=post).values_list("owner", flat=True)
+            ),
+            [self.author.id],
+        )
+        self.assertEqual(self.feed(), [post.id])
+
+    def leave_pull_set(self, author):
+        """Unfollow the popular author until it drops below the threshold."""
+        for index in range(2):
+            Account.objects.get(username=f"fan{index}").unfollow(author)
+        cache.clear()
+
+    def test_author_leaving_the_pull_set_is_backfilled(self):
+        self.reader.follow(self.author)
+        self.make_popular(self.author)
+        self.assertIn(self.author.id, get_pull_author_ids())
+        post = Post.objects.create(author=self.author, content="pulled")
+
+        self.leave_pull_set(self.author)
+
+        # Pulled until the backfill job has pushed the post
+        self.assertEqual(Job.objects.filter(kind=BACKFILL_FOLLOWERS_JOB).count(), 1)
+        self.assertIn(self.author.id, get_pull_author_ids())
+        self.assertEqual(self.feed(), [post.id])
+        # Reading the feed schedules nothing
+        self.assertEqual(Job.objects.filter(kind=BACKFILL_FOLLOWERS_JOB).count(), 1)
+
+        run_due_jobs()
+        cache.clear()
+
+        self.assertNotIn(self.author.id, get_pull_author_ids())
+        self.assertTrue(
+            TimelineEntry.objects.filter(owner=self.reader, post=post).exists()
+        )
+        self.assertEqual(self.feed(), [post.id])
+
+    def test_failed_backfill_is_retried(self):
+        self.reader.follow(self.author)
+        self.make_popular(self.author)
+        post = Post.objects.create(author=self.author, content="pulled")
+        self.leave_pull_set(self.author)
+        Job.objects.filter(kind=BACKFILL_FOLLOWERS_JOB).update(max_attempts=1)
+
+        with mock.patch(
+            "main.timeline._insert_entries", side_effect=DatabaseError("down")
+        ):
+            run_due_jobs()
+        cache.clear()
+
+        retry = Job.objects.get(kind=BACKFILL_FOLLOWERS_JOB, status="pending")
+        self.assertGreater(retry.run_at, timezone.now())
+        self.assertIn(self.author.id, get_pull_author_ids())
+        self.assertEqual(self.feed(), [post.id])
+
+        Job.objects.filter(pk=retry.pk).update(run_at=timezone.now())
+        run_due_jobs()
+        cache.clear()
+
+        self.assertNotIn(self.author.id, get_pull_author_ids())
+        self.assertEqual(self.feed(), [post.id])
+
+
+class PayloadCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.reader = Account.objects.create_user("reader@example.com", "reader")
+        self.post = Post.objects.create(author=self.author, content="hello")
+
+    def read_list(self, account):
+        self.client.force_authenticate(account)
+        response = self.client.get(reverse("post_list"))
+        self.assertEqual(response.status_code, 200)
+        return response.data["results"][0]
+
+    def test_process_local_cache_renders_every_read(self):
+        self.assertFalse(payload_cache.is_enabled())
+        self.read_list(self.reader)
+
+        # A write in another worker, whose invalidation this one never sees
+        Post.objects.filter(pk=self.post.pk).update(content="edited")
+
+        self.assertEqual(self.read_list(self.reader)["content"], "edited")
+        self.assertIsNone(cache.get(payload_cache.PAYLOAD_KEY.format(self.post.pk)))
+
+    @override_settings(POST_PAYLOAD_CACHE=True)
+    def test_writes_invalidate_what_other_readers_get(self):
+        self.read_list(self.reader)
+        self.assertIsNotNone(cache.get(payload_cache.PAYLOAD_KEY.format(self.post.pk)))
+
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("post_action", args=["like", self.post.id]))
+        payload = self.read_list(self.reader)
+        self.assertEqual((payload["likes_count"], payload["is_liked"]), (1, False))
+
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse("update"), {"name": "Renamed"})
+        self.client.force_authenticate(self.reader)
+        detail = self.client.get(reverse("post_detail", args=[self.post.id])).data
+        self.assertEqual(detail["author"]["name"], "Renamed")
+        self.assertEqual(self.read_list(self.reader)["author"]["name"], "Renamed")
+
+
+class ConditionalRequestTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.reader = Account.objects.create_user("reader@example.com", "reader")
+        self.post = Post.objects.create(author=self.author, content="hello")
+        self.url = reverse("post_detail", args=[self.post.id])
+
+    def get(self, url, etag=None):
+        self.client.force_authenticate(self.reader)
+        if etag is None:
+            return self.client.get(url)
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def assert_like_changes_the_etag(self):
+        response = self.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertIn("Authorization", response["Vary"])
+
+        response = self.get(self.url, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertFalse(response.content)
+
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("post_action", args=["like", self.post.id]))
+        response = self.get(self.url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["likes_count"], 1)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(self.get(self.url, response["ETag"]).status_code, 304)
+
+    def test_body_etag_without_a_shared_cache(self):
+        self.assert_like_changes_the_etag()
+
+    @override_settings(POST_PAYLOAD_CACHE=True)
+    def test_version_etag_with_a_shared_cache(self):
+        self.assert_like_changes_the_etag()
+
+        etag = self.get(self.url)["ETag"]
+        # The post and its tagged accounts, nothing is serialized
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get(self.url, etag).status_code, 304)
+
+    def test_account_etags(self):
+        for name in ["user_detail", "peep"]:
+            with self.subTest(name):
+                url = reverse(name, args=["author"])
+                etag = self.get(url)["ETag"]
+                self.assertEqual(self.get(url, etag).status_code, 304)
+
+                self.client.force_authenticate(self.author)
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.patch(reverse("update"), {"name": f"Renamed {name}"})
+                response = self.get(url, etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], etag)
+
+
+class ViewCounterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        author = Account.objects.create_user("author@example.com", "author")
+        self.posts = [
+            Post.objects.create(author=author, content=f"post {index}")
+            for index in range(4)
+        ]
+        self.client.force_authenticate(author)
+        # Only flushed by the tests, the thread waits for an hour
+        self.counter = ViewCounterBuffer(flush_interval=3600, buffer_size=4)
+        self.addCleanup(self.counter._stopped.set)
+        patcher = mock.patch("main.views.view_counter", self.counter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def view(self, post, times=1):
+        for _ in range(times):
+            response = self.client.post(reverse("post_view", args=[post.id]))
+            self.assertEqual(response.status_code, 200)
+
+    def views(self):
+        return [
+            Post.objects.values_list("views", flat=True).get(pk=post.pk)
+            for post in self.posts
+        ]
+
+    def test_views_are_buffered_then_flushed(self):
+        self.view(self.posts[0], 3)
+        self.view(self.posts[1], 3)
+        self.view(self.posts[2])
+        self.assertEqual(self.views(), [0, 0, 0, 0])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.counter.flush(), 7)
+
+        # One UPDATE per distinct increment
+        updates = [query for query in queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(self.views(), [3, 3, 1, 0])
+        self.assertEqual(self.counter.flush(), 0)
+        self.assertEqual(self.counter.as_dict()["flushed"], 7)
+
+    def test_full_buffer_is_flushed_at_once(self):
+        for post in self.posts[:3]:
+            self.view(post)
+        self.assertEqual(self.views(), [0, 0, 0, 0])
+        self.view(self.posts[3])
+
+        self.assertEqual(self.views(), [1, 1, 1, 1])
+        self.assertEqual(self.counter.as_dict()["pending_views"], 0)
+
+    def test_views_of_deleted_posts_are_discarded(self):
+        self.view(self.posts[0], 2)
+        self.view(self.posts[3], 2)
+        self.posts.pop().delete()
+
+        self.assertEqual(self.counter.flush(), 2)
+        self.assertEqual(self.counter.as_dict()["discarded"], 2)
+        self.assertEqual(self.views(), [2, 0, 0])
+
+    def test_failed_flush_keeps_the_views(self):
+        self.view(self.posts[0], 2)
+
+        with mock.patch.object(Post.objects, "filter", side_effect=DatabaseError):
+            with self.assertLogs("main.counters", "ERROR"):
+                self.assertEqual(self.counter.flush(), 0)
+        self.view(self.posts[0])
+
+        self.assertEqual(self.counter.flush(), 3)
+        self.assertEqual(self.views(), [3, 0, 0, 0])
+        self.assertEqual(self.counter.as_dict()["flush_errors"], 1)
+
+
+class ConversationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        reply = self.reply
+        self.grandparent = reply(None)
+        self.parent = reply(self.grandparent)
+        self.post = reply(self.parent)
+        self.first = reply(self.post)
+        self.second = reply(self.post)
+        self.nested = reply(self.first)
+        self.deepest = reply(self.nested)
+        recount_post_counters()
+
+    def reply(self, parent):
+        return Post.objects.create(author=self.author, parent=parent, content="hi")
+
+    def get(self, post, **params):
+        response = self.client.get(reverse("conversation", args=[post.id]), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def ids(self, node):
+        return [reply["post"]["id"] for reply in node["replies"]]
+
+    def test_ancestors_and_replies(self):
+        data = self.get(self.post, depth=2)
+
+        self.assertEqual(
+            [post["id"] for post in data["ancestors"]],
+            [self.grandparent.id, self.parent.id],
+        )
+        self.assertEqual(data["post"]["id"], self.post.id)
+        self.assertEqual(self.ids(data), [self.first.id, self.second.id])
+        self.assertFalse(data["has_more_replies"])
+        self.assertIsNone(data["replies_cursor"])
+        first = data["replies"][0]
+        self.assertEqual(self.ids(first), [self.nested.id])
+
+    def test_depth_cutoff_continues_from_a_cursor(self):
+        nested = self.get(self.post, depth=2)["replies"][0]["replies"][0]
+        # Cut off by the depth limit
+        self.assertEqual(nested["replies"], [])
+        self.assertTrue(nested["has_more_replies"])
+
+        data = self.get(self.nested, cursor=nested["replies_cursor"])
+
+        self.assertEqual(data["ancestors"], [])
+        self.assertEqual(self.ids(data), [self.deepest.id])
+        self.assertFalse(data["has_more_replies"])
+
+    def test_size_cutoff_continues_from_a_cursor(self):
+        data = self.get(self.post, limit=1)
+        self.assertEqual(self.ids(data), [self.first.id])
+        self.assertTrue(data["has_more_replies"])
+        # Its replies were cut off before any was returned
+        first = data["replies"][0]
+        self.assertEqual(first["replies"], [])
+        self.assertIsNotNone(first["replies_cursor"])
+
+        rest = self.get(self.post, limit=1, cursor=data["replies_cursor"])
+        self.assertEqual(self.ids(rest), [self.second.id])
+        self.assertFalse(rest["has_more_replies"])
+        nested = self.get(self.first, limit=1, cursor=first["replies_cursor"])
+        self.assertEqual(self.ids(nested), [self.nested.id])
+
+    def test_each_level_costs_one_query(self):
+        for _ in range(20):
+            self.reply(self.reply(self.post))
+        cache.clear()
+        # The ancestors, one query per level and the payloads
+        with self.assertNumQueries(9):
+            data = self.get(self.post, depth=3, limit=50)
+
+        def count(node):
+            return sum(1 + count(reply) for reply in node["replies"])
+
+        self.assertEqual(count(data), 44)
+
+    def test_missing_post_and_invalid_cursor(self):
+        url = reverse("conversation", args=[self.deepest.id + 100])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.get(
+            reverse("conversation", args=[self.post.id]), {"cursor": "nope"}
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class LikeTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.reader = Account.objects.create_user("reader@example.com", "reader")
+        self.post = Post.objects.create(author=self.author, content="hello")
+        self.client.force_authenticate(self.reader)
+
+    def like(self, post_id=None):
+        return self.client.post(
+            reverse("post_action", args=["like", post_id or self.post.id])
+        )
+
+    def test_like_toggles(self):
+        response = self.like()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            (response.data["liked"], response.data["likes_count"]), (True, 1)
+        )
+
+        response = self.like()
+        self.assertEqual(
+            (response.data["liked"], response.data["likes_count"]), (False, 0)
+        )
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 0)
+        self.assertFalse(self.post.likes.exists())
+
+    def test_likes_of_several_accounts_are_counted(self):
+        toggle_like(self.post.id, self.author.id)
+
+        self.assertEqual(toggle_like(self.post.id, self.reader.id), (True, 2))
+
+    def test_like_of_missing_post_is_not_found(self):
+        self.assertEqual(self.like(self.post.id + 100).status_code, 404)
+        with self.assertRaises(Post.DoesNotExist):
+            toggle_like(self.post.id + 100, self.reader.id)
+
+
+class ReactionTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user("author@example.com", "author")
+        self.reader = Account.objects.create_user("reader@example.com", "reader")
+        self.post = Post.objects.create(author=self.author, content="hello")
+        self.client.force_authenticate(self.reader)
+
+    def test_reaction_replaces_the_previous_one(self):
+        self.assertEqual(
+            upsert_reaction(self.post.id, self.reader.id, "hot"), {"hot": 1}
+        )
+        self.assertEqual(
+            upsert_reaction(self.post.id, self.author.id, "hot"), {"hot": 2}
+        )
+
+        counts = upsert_reaction(self.post.id, self.reader.id, "sad")
+
+        self.assertEqual(counts, {"hot": 1, "sad": 1})
+        self.assertEqual(upsert_reaction(self.post.id, self.reader.id, "sad"), counts)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.reaction_counts, counts)
+
+    def test_reaction_histogram_lists_every_emoji(self):
+        response = self.client.post(
+            reverse("set_reaction", args=[self.post.id]),
+            {"emoji_name": "hundred"},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        histogram = response.data["post_reactions"]
+        self.assertEqual(histogram["hundred"], 1)
+        self.assertEqual(sum(histogram.values()), 1)
+        self.assertEqual(len(histogram), 6)
+
+
+class AccountCardQueryTests(APITestCase):
+    def setUp(self):
+        self.viewer = Account.objects.create_user("viewer@example.com", "viewer")
+        self.accounts = [
+            Account.objects.create_user(f"card{index}@example.com", f"card{index}")
+            for index in range(6)
+        ]
+        for account in self.accounts[:3]:
+            self.viewer.follow(account)
+            account.follow(self.accounts[5])
+        # Counted from the follows table instead
+        AccountStats.objects.filter(account=self.accounts[0]).delete()
+        self.request = APIRequestFactory().get("/")
+        self.request.user = self.viewer
+
+    def serialize(self, accounts):
+        return BasicAccountSerializer(
+            accounts, many=True, context={"request": self.request}
+        ).data
+
+    def test_cards_cost_the_same_queries_whatever_their_number(self):
+        # The accounts, their stats, the viewer's follows, and the four
+        # counts of the accounts without stats
+        for size in [2, 6]:
+            with self.subTest(size=size):
+                accounts = Account.objects.filter(
+                    pk__in=[account.pk for account in self.accounts[:size]]
+                )
+                with self.assertNumQueries(7):
+                    self.serialize(accounts)
+
+    def test_cards_show_the_batched_figures(self):
+        data = {card["username"]: card for card in self.serialize(self.accounts)}
+
+        self.assertEqual(
+            [
+                (card["followers"], card["following"], card["is_following_account"])
+                for card in data.values()
+            ],
+            [(1, 1, True)] * 3 + [(0, 0, False), (0, 0, False), (3, 0, False)],
+        )
+
+
+class SearchTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = Account.objects.create_user(
+            "author@example.com", "author", name="Ada Lovelace"
+        )
+        self.gardener = Account.objects.create_user(
+            "gardener@example.com", "gardener", name="Green Thumb"
+        )
+        self.client.force_authenticate(self.author)
+        self.posts = {
+            content: Post.objects.create(author=self.author, content=content)
+            for content in ["python python tips", "learning python today", "cooking"]
+        }
+        self.tomatoes = Post.objects.create(author=self.gardener, content="tomatoes")
+
+    def search(self, query, **params):
+        return self.client.get(reverse("search"), {"q": query, **params})
+
+    def post_ids(self, query):
+        return list(search_posts(query).values_list("id", flat=True))
+
+    def test_sqlite_uses_fts5(self):
+        self.assertIsInstance(get_search_backend(), SQLiteSearchBackend)
+
+    def test_posts_are_ranked_by_relevance(self):
+        self.assertEqual(
+            self.post_ids("python"),
+            [
+                self.posts["python python tips"].id,
+                self.posts["learning python today"].id,
+            ],
+        )
+        # The last word also matches as a prefix
+        self.assertEqual(
+            self.post_ids("learning pyth"), [self.posts["learning python today"].id]
+        )
+        self.assertEqual(self.post_ids("python cooking"), [])
+
+    def test_posts_are_found_by_their_author_username(self):
+        Post.objects.create(author=self.author, content="my gardener grows these")
+
+        ids = self.post_ids("gardener")
+
+        # Content matches rank first
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids[1], self.tomatoes.id)
+        # Names and bios of the author are not matched
+        self.assertEqual(self.post_ids("thumb"), [])
+        self.assertIn(self.tomatoes, BasicSearchBackend().search_posts("garden"))
+
+    def test_index_follows_edits_and_deletes(self):
+        post = self.posts["cooking"]
+        post.content = "baking"
+        post.save()
+        self.assertEqual(self.post_ids("cooking"), [])
+        self.assertEqual(self.post_ids("baking"), [post.id])
+
+        post.delete()
+        self.assertEqual(self.post_ids("baking"), [])
+
+    def test_search_view(self):
+        response = self.search("gardener")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [post["id"] for post in response.data["posts"]], [self.tomatoes.id]
+        )
+        self.assertEqual(
+            [account["username"] for account in response.data["accounts"]],
+            ["gardener"],
+        )
+
+        response = self.search("lovelace", type="accounts")
+        self.assertEqual(
+            [account["username"] for account in response.data["results"]], ["author"]
+        )
+        response = self.search("python", type="posts")
+        self.assertEqual(
+            [post["content"] for post in response.data["results"]],
+            ["python python tips", "learning python today"],
+        )
+        self.assertEqual(response.data["count"], 2)
+
+    def test_query_syntax_is_not_interpreted(self):
+        for query in ['python" OR', "(python", "-python", "NEAR(python tips)", "*"]:
+            with self.subTest(query):
+                self.assertEqual(self.search(query).status_code, 200)
+        self.assertEqual(self.search(" ").status_code, 400)
+
+
+class BlurHashTests(SimpleTestCase):
+    def images(self):
+        random = np.random.default_rng(21)
+        images = []
+        for width, height in [(1, 1), (3, 7), (17, 5), (33, 33), (100, 61)]:
+            pixels = random.integers(0, 256, (height, width, 4), dtype=np.uint8)
+            images += [
+                Image.fromarray(pixels[..., :3], "RGB"),
+                Image.fromarray(pixels[..., 0], "L"),
+                Image.fromarray(pixels, "RGBA"),
+                Image.fromarray(pixels[..., :2], "LA"),
+            ]
+        # Smooth gradients too, where rounding differences would show first
+        gradient = np.linspace(0, 255, 99 * 41 * 3).reshape(41, 99, 3)
+        images.append(Image.fromarray(gradient.astype(np.uint8), "RGB"))
+        return images
+
+    def test_hashes_match_the_reference_encoder(self):
+        images = self.images()
+        for components in [(4, 3), (1, 1), (9, 9), (2, 7)]:
+            with self.subTest(components=components):
+                # The reference closes the images it encodes
+                expected = [
+                    blurhash.encode(image.copy(), *components) for image in images
+                ]
+                self.assertEqual(encode_images(images, *components), expected)
+
+    def test_hashes_of_uploads_match_the_reference_encoder(self):
+        contents = [jpeg(size=(640, 480)), jpeg((10, 200, 90), (333, 517))]
+        buffer = BytesIO()
+        Image.new("RGBA", (250, 90), (0, 0, 255, 40)).save(buffer, format="PNG")
+        contents.append(buffer.getvalue())
+
+        expected = [
+            blurhash.encode(prepare_image(BytesIO(content)), 4, 3)
+            for content in contents
+        ]
+
+        self.assertEqual(hash_images(contents), expected)
+
+
+def turned(image, format="PNG"):
+    """``image`` stored a quarter turn off, with the EXIF orientation fixing it."""
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6
+    buffer = BytesIO()
+    image.transpose(Image.Transpose.ROTATE_90).save(buffer, format=format, exif=exif)
+    return buffer.getvalue()
+
+
+class ImageProcessingTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        # Portrait, with a different colour in every corner
+        pixels = np.zeros((400, 200, 3), dtype=np.uint8)
+        pixels[:200, :100] = (255, 0, 0)
+        pixels[:200, 100:] = (0, 255, 0)
+        pixels[200:, :100] = (0, 0, 255)
+        self.image = Image.fromarray(pixels, "RGB")
+        buffer = BytesIO()
+        self.image.save(buffer, format="PNG")
+        self.upright = buffer.getvalue()
+
+    def test_exif_orientation_is_applied(self):
+        for webp in [True, False]:
+            with self.subTest(webp=webp):
+                rotated, upright = process_images(
+                    [turned(self.image), self.upright], webp, widths=[100]
+                )
+                self.assertEqual((rotated["width"], rotated["height"]), (200, 400))
+                self.assertEqual(rotated["image_hash"], upright["image_hash"])
+                if webp:
+                    output = Image.open(BytesIO(rotated["webp"]))
+                    self.assertEqual(output.size, (200, 400))
+                    self.assertEqual(
+                        {(v["width"], v["height"]) for v in rotated["variants"]},
+                        {(100, 200)},
+                    )
+
+        # JPEGs without WebP output are decoded at a reduced scale, then turned
+        (image,) = process_images([turned(self.image, "JPEG")], webp=False)
+        self.assertEqual((image["width"], image["height"]), (200, 400))
+
+    def test_each_upload_is_decoded_once(self):
+        files = [
+            ContentFile(content, name=f"{index}.jpg")
+            for index, content in enumerate([jpeg(), turned(self.image), jpeg()])
+        ]
+
+        # In this process, so the decodes can be counted
+        with mock.patch("main.utils.hash_executor", MediaExecutor(name="test-hash")):
+            with mock.patch("PIL.Image.open", wraps=Image.open) as opened:
+                images = process_and_upload_images(files, folder="posts")
+
+        # The third upload repeats the first one
+        self.assertEqual(opened.call_count, 2)
+        self.assertEqual(images[0]["image_url"], images[2]["image_url"])
+        self.assertEqual((images[1]["width"], images[1]["height"]), (200, 400))
+
+
+class SharedImageTests(MediaTestCase):
+    def create_post(self, content):
+        upload = SimpleUploadedFile("photo.jpg", content, content_type="image/jpeg")
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("create_post"), {"content": "hello", "files": [upload]}
+            )
+        self.assertEqual(response.status_code, 201)
+        return ImageMedia.objects.get(post_id=response.data["id"])
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), settings.MEDIA_ROOT)
+            for root, _, names in os.walk(settings.MEDIA_ROOT)
+            for name in names
+            if "staging" not in root
+        )
+
+    def delete_post(self, image):
+        response = self.client.delete(reverse("delete_action", args=[image.post_id]))
+        self.assertEqual(response.status_code, 204)
+
+    def test_identical_content_is_stored_once(self):
+        content = jpeg(size=(800, 600))
+        first = self.create_post(content)
+        stored = self.stored_files()
+
+        # In this process, so the decodes can be counted
+        with mock.patch("main.utils.hash_executor", MediaExecutor(name="test-hash")):
+            with mock.patch("PIL.Image.open", wraps=Image.open) as opened:
+                second = self.create_post(content)
+
+        self.assertEqual(opened.call_count, 0)
+        self.assertEqual(self.stored_files(), stored)
+        for field in ["image_url", "image_hash", "content_hash", "variants"]:
+            self.assertEqual(getattr(second, field), getattr(first, field))
+        self.assertNotEqual(
+            self.create_post(jpeg((0, 0, 255))).image_url, first.image_url
+        )
+
+    def test_shared_image_is_deleted_with_its_last_post(self):
+        content = jpeg(size=(800, 600))
+        first = self.create_post(content)
+        second = self.create_post(content)
+        stored = self.stored_files()
+        self.assertGreater(len(stored), 1)
+
+        self.delete_post(first)
+        self.assertEqual(self.stored_files(), stored)
+
+        with override_settings(MEDIA_JOBS_ENABLED=True):
+            self.delete_post(second)
+        self.assertEqual(self.stored_files(), stored)
+        run_due_jobs()
+        self.assertEqual(self.stored_files(), [])
+
+
+class JobTests(APITestCase):
+    def setUp(self):
+        self.calls = []
+        self.failures = []
+        self.fail = False
+
+        def handler(payload):
+            self.calls.append(payload)
+            if self.fail:
+                raise RuntimeError("boom")
+
+        register("tests.job", on_failure=self.failures.append)(handler)
+        self.addCleanup(jobs.HANDLERS.pop, "tests.job")
+
+    def test_job_runs_once(self):
+        job = enqueue("tests.job", {"n": 1})
+
+        self.assertEqual(run_due_jobs("worker"), 1)
+        self.assertEqual(run_due_jobs("worker"), 0)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("done", 1))
+        self.assertEqual(self.calls, [{"n": 1}])
+
+    def test_claimed_job_is_not_claimed_again(self):
+        enqueue("tests.job", {})
+
+        self.assertEqual(len(claim_jobs("first")), 1)
+        self.assertEqual(claim_jobs("second"), [])
+
+    def test_delayed_job_waits(self):
+        enqueue("tests.job", {}, delay=60)
+
+        self.assertEqual(claim_jobs("worker"), [])
+
+    def test_failed_job_is_retried_later_then_given_up(self):
+        self.fail = True
+        job = enqueue("tests.job", {"n": 1})
+        Job.objects.filter(pk=job.pk).update(max_attempts=2)
+
+        run_due_jobs("worker")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("pending", 1))
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(run_due_jobs("worker"), 0)
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        run_due_jobs("worker")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+        self.assertEqual(self.failures, [{"n": 1}])
+
+    def test_job_of_a_dead_worker_is_run_again(self):
+        enqueue("tests.job", {})
+        [stale] = claim_jobs("dead")
+        Job.objects.filter(pk=stale.pk).update(
+            locked_until=timezone.now() - timedelta(seconds=1)
+        )
+
+        [job] = claim_jobs("alive")
+        self.assertEqual(job.attempts, 2)
+        # The dead worker no longer holds the lease, so its outcome is dropped
+        self.fail = True
+        run_job(stale)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), ("running", "alive"))
+
+        self.fail = False
+        self.assertTrue(run_job(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, "done")
+
+    def test_job_is_committed_with_its_change(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            enqueue("tests.job", {})
+            raise RuntimeError("rolled back")
+
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(TIMELINE_PULL_FOLLOWER_THRESHOLD=3)
+    def test_backfill_job_is_idempotent(self):
+        author = Account.objects.create_user("author@example.com", "author")
+        reader = Account.objects.create_user("reader@example.com", "reader")
+        reader.follow(author)
+        AccountStats.objects.filter(account=author).update(followers_count=3)
+        post = Post.objects.create(author=author, content="pulled")
+        AccountStats.objects.filter(account=author).update(followers_count=1)
+
+        for _ in range(2):
+            enqueue(BACKFILL_FOLLOWERS_JOB, {"author_id": author.id})
+            run_due_jobs("worker")
+
+        self.assertEqual(
+            TimelineEntry.objects.filter(owner=reader, post=post).count(), 1
+        )
+        self.assertFalse(
+            Job.objects.filter(kind=BACKFILL_FOLLOWERS_JOB)
+            .exclude(status="done")
+            .exists()
+        )
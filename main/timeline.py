@@ -0,0 +1,337 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+
+from accounts.models import AccountStats, Follow
+
+from .jobs import enqueue, register
+from .models import Job, Post, TimelineEntry
+
+PULL_AUTHORS_CACHE_KEY = "timeline:pull-authors:{threshold}"
+BACKFILL_FOLLOWERS_JOB = "timeline.backfill_followers"
+TRIM_TIMELINES_JOB = "timeline.trim"
+
+
+def get_max_entries():
+    return getattr(settings, "TIMELINE_MAX_ENTRIES", 800)
+
+
+def get_pull_threshold():
+    return getattr(settings, "TIMELINE_PULL_FOLLOWER_THRESHOLD", 10000)
+
+
+def get_pull_author_ids(threshold=None, use_cache=True):
+    """
+    Return the ids of accounts whose posts are pulled at read time.
+
+    Authors with at least ``threshold`` followers are not fanned out, since a
+    single post would write one timeline row per follower. The set is small
+    and changes slowly, so it is cached for TIMELINE_PULL_AUTHORS_TTL seconds.
+
+    Authors who dropped below the threshold stay pulled until their
+    backfill_followers job has pushed the posts they made while pulled, see
+    author_unfollowed.
+    """
+    if threshold is None:
+        threshold = get_pull_threshold()
+
+    key = PULL_AUTHORS_CACHE_KEY.format(threshold=threshold)
+    author_ids = cache.get(key) if use_cache else None
+    if author_ids is None:
+        over_threshold = set(
+            AccountStats.objects.filter(followers_count__gte=threshold).values_list(
+                "account_id", flat=True
+            )
+        )
+        author_ids = over_threshold | backfilling_author_ids()
+        if use_cache:
+            timeout = getattr(settings, "TIMELINE_PULL_AUTHORS_TTL", 300)
+            cache.set(key, author_ids, timeout)
+    return author_ids
+
+
+def backfilling_author_ids():
+    """Authors whose followers' timelines still miss the posts they made while pulled."""
+    return set(
+        Job.objects.filter(
+            kind=BACKFILL_FOLLOWERS_JOB, status__in=["pending", "running"]
+        ).values_list("payload__author_id", flat=True)
+    )
+
+
+def enqueue_backfill_followers(author_id, delay=0):
+    # Concurrent unfollows may all notice the author leave; one job is enough
+    pending = Job.objects.filter(
+        kind=BACKFILL_FOLLOWERS_JOB, status="pending", payload__author_id=author_id
+    )
+    if not pending.exists():
+        enqueue(BACKFILL_FOLLOWERS_JOB, {"author_id": author_id}, delay=delay)
+
+
+def retry_backfill_followers(payload):
+    # The author stays pulled until a backfill succeeds, or their followers
+    # would miss the posts they made while pulled
+    enqueue_backfill_followers(
+        payload["author_id"], delay=getattr(settings, "JOB_RETRY_MAX_DELAY", 3600)
+    )
+
+
+def author_unfollowed(author_id, threshold=None):
+    """
+    Schedule backfill_followers when an unfollow took an author below the
+    pull threshold. Call it after the Follow row is deleted.
+    """
+    if threshold is None:
+        threshold = get_pull_threshold()
+    followers = (
+        AccountStats.objects.filter(account_id=author_id)
+        .values_list("followers_count", flat=True)
+        .first()
+    )
+    # Only an author around the threshold can have just crossed it; the
+    # rows themselves tell whether this unfollow did
+    if followers is None or not threshold - 1 <= followers <= threshold:
+        return
+    if Follow.objects.filter(following_id=author_id).count() == threshold - 1:
+        enqueue_backfill_followers(author_id)
+
+
+def is_pull_author(author_id, threshold=None):
+    """Check if an author's followers count reaches the pull threshold."""
+    if threshold is None:
+        threshold = get_pull_threshold()
+    followers = (
+        AccountStats.objects.filter(account_id=author_id)
+        .values_list("followers_count", flat=True)
+        .first()
+    )
+    if followers is None:
+        followers = Follow.objects.filter(following_id=author_id).count()
+    return followers >= threshold
+
+
+def _insert_entries(owner_ids, posts):
+    """Bulk insert timeline rows, skipping any that already exist."""
+    batch_size = getattr(settings, "TIMELINE_FANOUT_BATCH_SIZE", 1000)
+    entries = [
+        TimelineEntry(
+            owner_id=owner_id,
+            post_id=post.id,
+            author_id=post.author_id,
+            created_at=post.created_at,
+        )
+        for owner_id in owner_ids
+        for post in posts
+    ]
+    TimelineEntry.objects.bulk_create(
+        entries, batch_size=batch_size, ignore_conflicts=True
+    )
+    return len(entries)
+
+
+def fan_out_post(post, threshold=None):
+    """
+    Push a new top-level post into the timeline of its author and followers.
+
+    Posts by pull authors only land in the author's own timeline; followers
+    merge them in at read time.
+
+    Args:
+        post (Post): The post that was just created.
+        threshold (int, optional): Follower count at which the author is
+            pulled instead of pushed (default: TIMELINE_PULL_FOLLOWER_THRESHOLD).
+
+    Returns:
+        int: The number of timeline rows written.
+    """
+    if post.parent_id:
+        # Replies only show up in their conversation, not in home timelines
+        return 0
+
+    # Every push grows timelines by a row, trimmed in the background
+    enqueue_trim_timelines()
+    if is_pull_author(post.author_id, threshold):
+        return _insert_entries([post.author_id], [post])
+
+    follower_ids = Follow.objects.filter(following_id=post.author_id).values_list(
+        "follower_id", flat=True
+    )
+    return _insert_entries([post.author_id, *follower_ids], [post])
+
+
+def backfill_timeline(owner, author, threshold=None):
+    """
+    Copy an author's recent posts into the owner's timeline after a follow.
+
+    Nothing is copied for pull authors, whose posts are merged at read time.
+
+    Args:
+        owner (Account): The account that started following.
+        author (Account): The account that was followed.
+        threshold (int, optional): See fan_out_post.
+
+    Returns:
+        int: The number of timeline rows written.
+    """
+    if is_pull_author(author.pk, threshold):
+        return 0
+
+    limit = getattr(settings, "TIMELINE_BACKFILL_SIZE", 50)
+    posts = Post.objects.filter(author=author, parent=None).only(
+        "id", "author_id", "created_at"
+    )[:limit]
+    written = _insert_entries([owner.pk], posts)
+    trim_timeline(owner)
+    return written
+
+
+@register(BACKFILL_FOLLOWERS_JOB, on_failure=retry_backfill_followers)
+def backfill_followers(payload, threshold=None):
+    """
+    Push the recent posts of an author who left the pull set into the
+    timelines of their followers, see get_pull_author_ids.
+    """
+    author_id = payload["author_id"]
+    if is_pull_author(author_id, threshold):
+        # Back over the threshold: followers keep pulling the posts
+        return 0
+
+    limit = getattr(settings, "TIMELINE_BACKFILL_SIZE", 50)
+    batch_size = getattr(settings, "TIMELINE_FANOUT_BATCH_SIZE", 1000)
+    posts = list(
+        Post.objects.filter(author_id=author_id, parent=None).only(
+            "id", "author_id", "created_at"
+        )[:limit]
+    )
+    follower_ids = list(
+        Follow.objects.filter(following_id=author_id).values_list(
+            "follower_id", flat=True
+        )
+    )
+    written = 0
+    for start in range(0, len(follower_ids), batch_size):
+        written += _insert_entries(follower_ids[start : start + batch_size], posts)
+    return written
+
+
+def remove_from_timeline(owner, author):
+    """Drop an author's posts from the owner's timeline after an unfollow."""
+    return TimelineEntry.objects.filter(owner=owner, author=author).delete()[0]
+
+
+def trim_timeline(owner, max_entries=None):
+    """
+    Keep only the newest ``max_entries`` rows of the owner's timeline.
+
+    Returns:
+        int: The number of rows deleted.
+    """
+    if max_entries is None:
+        max_entries = get_max_entries()
+
+    entries = TimelineEntry.objects.filter(owner=owner).order_by(
+        "-created_at", "-post_id"
+    )
+    boundary = entries.values("created_at", "post_id")[max_entries : max_entries + 1]
+    boundary = next(iter(boundary), None)
+    if boundary is None:
+        return 0
+
+    stale = TimelineEntry.objects.filter(owner=owner).filter(
+        Q(created_at__lt=boundary["created_at"])
+        | Q(created_at=boundary["created_at"], post_id__lte=boundary["post_id"])
+    )
+    return stale.delete()[0]
+
+
+def enqueue_trim_timelines():
+    """
+    Schedule trim_timelines unless a run is already scheduled, so timelines
+    are trimmed at most every TIMELINE_TRIM_INTERVAL seconds while posts are
+    fanned out.
+    """
+    pending = Job.objects.filter(kind=TRIM_TIMELINES_JOB, status="pending")
+    if not pending.exists():
+        enqueue(
+            TRIM_TIMELINES_JOB,
+            {},
+            delay=getattr(settings, "TIMELINE_TRIM_INTERVAL", 300),
+        )
+
+
+@register(TRIM_TIMELINES_JOB)
+def trim_timelines(payload=None, max_entries=None):
+    """
+    Trim every timeline that grew over ``max_entries`` rows.
+
+    Trimming the followers' timelines on every fan-out would read up to
+    TIMELINE_MAX_ENTRIES rows per follower per post; a periodic pass counts
+    the rows once and only trims the timelines that overflowed.
+
+    Returns:
+        int: The number of rows deleted.
+    """
+    if max_entries is None:
+        max_entries = get_max_entries()
+
+    owner_ids = (
+        TimelineEntry.objects.values("owner")
+        .annotate(entries=Count("pk"))
+        .filter(entries__gt=max_entries)
+        .values_list("owner", flat=True)
+    )
+    return sum(trim_timeline(owner_id, max_entries) for owner_id in owner_ids)
+
+
+def rebuild_timeline(owner, threshold=None):
+    """
+    Rebuild an account's timeline from scratch out of the follow graph.
+
+    Returns:
+        int: The number of timeline rows written.
+    """
+    pull_ids = get_pull_author_ids(threshold)
+    author_ids = [
+        owner.pk,
+        *Follow.objects.filter(follower=owner)
+        .exclude(following_id__in=pull_ids)
+        .values_list("following_id", flat=True),
+    ]
+    posts = Post.objects.filter(author_id__in=author_ids, parent=None).only(
+        "id", "author_id", "created_at"
+    )[: get_max_entries()]
+
+    TimelineEntry.objects.filter(owner=owner).delete()
+    return _insert_entries([owner.pk], posts)
+
+
+def home_timeline(owner, threshold=None, use_cache=True):
+    """
+    Build the queryset behind an account's home feed.
+
+    Pushed posts come from the owner's timeline rows; posts by followed pull
+    authors are merged in from their Post rows. Both branches expose the
+    ``feed_at``/``feed_post`` keyset columns, so cursors stay valid when an
+    author crosses the threshold.
+
+    Returns:
+        QuerySet: Unordered posts; the paginator applies the ordering.
+    """
+    pull_ids = get_pull_author_ids(threshold, use_cache=use_cache)
+    followed_pull_ids = list(
+        Follow.objects.filter(follower=owner, following_id__in=pull_ids).values_list(
+            "following_id", flat=True
+        )
+    )
+
+    if not followed_pull_ids:
+        # Pure push: a single range scan over the owner's timeline rows
+        return Post.objects.filter(timeline_entries__owner=owner).annotate(
+            feed_at=F("timeline_entries__created_at"),
+            feed_post=F("timeline_entries__post_id"),
+        )
+
+    pushed = TimelineEntry.objects.filter(owner=owner).values("post_id")
+    return Post.objects.filter(
+        Q(pk__in=pushed) | Q(author_id__in=followed_pull_ids, parent=None)
+    ).annotate(feed_at=F("created_at"), feed_post=F("id"))
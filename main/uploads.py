@@ -0,0 +1,395 @@
+import json
+import os
+import time
+import uuid
+from datetime import timedelta
+from functools import lru_cache
+from urllib.parse import urljoin
+from urllib.request import urlopen
+
+import cloudinary
+import cloudinary.api
+from cloudinary.exceptions import NotFound
+from cloudinary.uploader import destroy, rename
+from cloudinary.utils import (
+    api_sign_request,
+    cloudinary_api_url,
+    cloudinary_url,
+    verify_notification_signature,
+)
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from django.utils import timezone
+
+from .executor import hash_executor, media_executor
+from .hashing import THUMBNAIL_SIZE, hash_images
+from .models import UploadSession
+from .utils import (
+    cloudinary_variants,
+    get_variant_widths,
+    process_and_upload_images,
+    uses_local_storage,
+)
+
+# Image types clients may upload directly
+UPLOAD_CONTENT_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif"]
+
+# Signs the upload targets of the local emulator
+TOKEN_SALT = "main.uploads"
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """An upload session that cannot be completed or attached."""
+
+
+def session_ttl():
+    return getattr(settings, "UPLOAD_SESSION_TTL", 600)
+
+
+def absolute_url(path, request=None):
+    if request:
+        return request.build_absolute_uri(path)
+    return urljoin(settings.SITE_URL, path)
+
+
+class LocalUploadStorage:
+    """
+    Emulates direct uploads with local storage, for development and tests.
+
+    The upload target is the upload_content view, signed for the lifetime
+    of the session, which writes the bytes to the staging directory and
+    completes the session the way a storage notification would.
+    """
+
+    def name(self, session):
+        return str(session.id)
+
+    def target(self, session, request=None):
+        token = signing.dumps(str(session.id), salt=TOKEN_SALT)
+        url = absolute_url(reverse("upload_content", args=[session.id]), request)
+        return {
+            "url": f"{url}?token={token}",
+            "method": "PUT",
+            "headers": {"Content-Type": session.content_type},
+            "fields": {},
+        }
+
+    def verify(self, upload_id, token):
+        """Whether ``token`` signs the upload target of ``upload_id`` and is current."""
+        try:
+            signed = signing.loads(token, salt=TOKEN_SALT, max_age=session_ttl())
+        except signing.BadSignature:
+            return False
+        return signed == str(upload_id)
+
+    def receive(self, session, stream):
+        """
+        Write an upload from ``stream`` in chunks, refusing more bytes than
+        the session declared.
+        """
+        storage = emulator_storage()
+        path = storage.path(self.name(session))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        received = 0
+        with open(f"{path}.part", "wb") as file:
+            while chunk := stream.read(CHUNK_SIZE):
+                received += len(chunk)
+                if received > session.size:
+                    break
+                file.write(chunk)
+        if received > session.size:
+            os.remove(f"{path}.part")
+            raise UploadError("The upload is larger than declared.")
+        os.replace(f"{path}.part", path)
+
+    def size(self, session):
+        storage = emulator_storage()
+        name = self.name(session)
+        return storage.size(name) if storage.exists(name) else None
+
+    def store(self, sessions, folder=None, request=None, file_names=None):
+        """
+        Store uploads the way process_and_upload_images stores files; the
+        emulator's uploads are on this machine, so they are read from disk.
+        """
+        files = [emulator_storage().open(self.name(session)) for session in sessions]
+        try:
+            return process_and_upload_images(
+                files, folder=folder, request=request, file_names=file_names
+            )
+        finally:
+            for file in files:
+                file.close()
+
+    def delete(self, session):
+        emulator_storage().delete(self.name(session))
+
+
+class CloudinaryUploadStorage:
+    """
+    Direct uploads to Cloudinary with signed upload parameters.
+
+    Cloudinary accepts a signature for an hour; the session's own expiry is
+    enforced when it completes. Cloudinary completes the session with a
+    signed notification (upload_notification).
+    """
+
+    def public_id(self, session):
+        return f"uploads/{session.id}"
+
+    def target(self, session, request=None):
+        config = cloudinary.config()
+        params = {
+            "public_id": self.public_id(session),
+            "timestamp": int(time.time()),
+            "notification_url": absolute_url(reverse("upload_notification"), request),
+        }
+        params["signature"] = api_sign_request(params, config.api_secret)
+        params["api_key"] = config.api_key
+        return {
+            "url": cloudinary_api_url("upload"),
+            "method": "POST",
+            "headers": {},
+            "fields": params,
+        }
+
+    def verify_notification(self, body, timestamp, signature):
+        return verify_notification_signature(
+            body, timestamp, signature, valid_for=session_ttl()
+        )
+
+    def notified_session(self, body):
+        """The pending session a notification is about, if any."""
+        public_id = json.loads(body).get("public_id", "")
+        try:
+            upload_id = uuid.UUID(public_id.removeprefix("uploads/"))
+        except ValueError:
+            return None
+        return UploadSession.objects.filter(id=upload_id, status="pending").first()
+
+    def resource(self, session):
+        try:
+            return cloudinary.api.resource(
+                self.public_id(session), timeout=media_executor.task_timeout
+            )
+        except NotFound:
+            return None
+
+    def size(self, session):
+        resource = self.resource(session)
+        return resource["bytes"] if resource else None
+
+    def place(self, session, public_id):
+        """
+        Rename an upload to ``public_id`` and return the renamed resource.
+
+        An upload renamed before, by an attempt that failed later, is found
+        at ``public_id``.
+        """
+        try:
+            return rename(
+                self.public_id(session),
+                public_id,
+                overwrite=True,
+                invalidate=True,
+                timeout=media_executor.task_timeout,
+            )
+        except NotFound:
+            try:
+                return cloudinary.api.resource(
+                    public_id, timeout=media_executor.task_timeout
+                )
+            except NotFound:
+                raise UploadError(f"Upload {session.id} is gone.")
+
+    def thumbnail(self, resource):
+        """The image scaled down by Cloudinary to be hashed, see hash_images."""
+        url, _ = cloudinary_url(
+            resource["public_id"],
+            version=resource["version"],
+            format="jpg",
+            crop="limit",
+            width=THUMBNAIL_SIZE[0],
+            height=THUMBNAIL_SIZE[1],
+            secure=True,
+        )
+        with urlopen(url, timeout=media_executor.task_timeout) as response:
+            return response.read()
+
+    def prepare(self, session, public_id):
+        resource = self.place(session, public_id)
+        return resource, self.thumbnail(resource)
+
+    def store(self, sessions, folder=None, request=None, file_names=None):
+        """
+        Store uploads the way process_and_upload_images stores files, without
+        downloading them: each upload is renamed into ``folder`` and only a
+        thumbnail of it is fetched, for its BlurHash.
+
+        Without ``file_names``, images are named after their session, since
+        their content is not read, and get the same variants as other images.
+        They are not shared with other posts (empty ``content_hash``).
+        """
+        folders = folder if isinstance(folder, list) else [folder] * len(sessions)
+        names = file_names or [str(session.id) for session in sessions]
+        prepared = media_executor.map(
+            self.prepare,
+            sessions,
+            [
+                f"{image_folder}/{name}" if image_folder else name
+                for image_folder, name in zip(folders, names)
+            ],
+        )
+        image_hashes = hash_executor.map(
+            hash_images, [[thumbnail for _, thumbnail in prepared]]
+        )[0]
+
+        images = []
+        for (resource, _), image_hash in zip(prepared, image_hashes):
+            image_url, _ = cloudinary_url(
+                resource["public_id"],
+                version=resource["version"],
+                format="webp",
+                secure=True,
+            )
+            image = {
+                "image_url": image_url,
+                "image_hash": image_hash,
+                "width": resource["width"],
+                "height": resource["height"],
+            }
+            if file_names is None:
+                image["variants"] = cloudinary_variants(image, get_variant_widths())
+                image["content_hash"] = ""
+            images.append(image)
+        return images
+
+    def delete(self, session):
+        destroy(self.public_id(session))
+
+
+@lru_cache(maxsize=1)
+def emulator_storage():
+    """Where the local emulator keeps uploads, next to the staged ones."""
+    return FileSystemStorage(
+        location=os.path.join(settings.MEDIA_STAGING_ROOT, "uploads")
+    )
+
+
+local_uploads = LocalUploadStorage()
+cloudinary_uploads = CloudinaryUploadStorage()
+
+
+def upload_storage():
+    """The upload storage of the image backend, see uses_local_storage."""
+    return local_uploads if uses_local_storage() else cloudinary_uploads
+
+
+def create_upload_session(owner, content_type, size):
+    return UploadSession.objects.create(
+        owner=owner,
+        content_type=content_type,
+        size=size,
+        expires_at=timezone.now() + timedelta(seconds=session_ttl()),
+    )
+
+
+def finish_upload(session):
+    """
+    Mark an upload session uploaded once its bytes are in storage.
+
+    Called by the client's completion callback and by storage notifications,
+    so finishing a session twice is not an error.
+
+    Raises:
+        UploadError: If the upload is missing, incomplete or expired.
+    """
+    if session.status != "pending":
+        return session
+    if session.expires_at <= timezone.now():
+        raise UploadError("The upload session has expired.")
+    storage = upload_storage()
+    size = storage.size(session)
+    if size is None:
+        raise UploadError("Nothing was uploaded yet.")
+    if size != session.size:
+        storage.delete(session)
+        raise UploadError(f"Expected {session.size} bytes but {size} were uploaded.")
+    UploadSession.objects.filter(id=session.id, status="pending").update(
+        status="uploaded"
+    )
+    session.status = "uploaded"
+    return session
+
+
+def uploaded_sessions(owner, upload_ids):
+    """
+    The uploaded, unexpired sessions of ``owner`` with these ids, in order.
+
+    Raises:
+        UploadError: If any of them is unknown, unfinished or expired.
+    """
+    sessions = UploadSession.objects.filter(
+        id__in=upload_ids,
+        owner=owner,
+        status="uploaded",
+        expires_at__gt=timezone.now(),
+    ).in_bulk()
+    if any(upload_id not in sessions for upload_id in upload_ids):
+        raise UploadError("Unknown, unfinished or expired upload.")
+    return [sessions[upload_id] for upload_id in upload_ids]
+
+
+def claim_uploads(sessions):
+    """
+    Mark sessions attached, once: call it inside the transaction that
+    attaches them.
+
+    Raises:
+        UploadError: If another request attached one of them first.
+    """
+    upload_ids = {session.id for session in sessions}
+    claimed = UploadSession.objects.filter(id__in=upload_ids, status="uploaded").update(
+        status="attached"
+    )
+    if claimed != len(upload_ids):
+        raise UploadError("The upload is already attached.")
+
+
+def store_uploads(sessions, folder=None, request=None, file_names=None):
+    """
+    Store uploaded sessions as images where their bytes already are.
+
+    Takes the arguments of process_and_upload_images, with sessions instead
+    of files, and returns the same fields.
+    """
+    if not sessions:
+        return []
+    return upload_storage().store(
+        sessions, folder=folder, request=request, file_names=file_names
+    )
+
+
+def discard_uploads(upload_ids):
+    """Delete upload sessions and their bytes, once attached or abandoned."""
+    sessions = list(UploadSession.objects.filter(id__in=upload_ids))
+    if sessions:
+        media_executor.map(upload_storage().delete, sessions)
+        UploadSession.objects.filter(
+            id__in=[session.id for session in sessions]
+        ).delete()
+
+
+def purge_uploads():
+    """Discard sessions that expired before being attached."""
+    upload_ids = list(
+        UploadSession.objects.filter(expires_at__lt=timezone.now())
+        .exclude(status="attached")
+        .values_list("id", flat=True)
+    )
+    discard_uploads(upload_ids)
+    return len(upload_ids)
@@ -3,9 +3,15 @@ from django.urls import path
 from .views import (
     account_post_list,
     comment_list,
+    complete_upload,
+    conversation_view,
     create_post,
+    create_upload,
     delete_action,
     get_feedback,
+    home_feed,
+    like_state,
+    metrics,
     ping,
     post_action,
     post_detail,
@@ -13,20 +19,30 @@ from .views import (
     register_post_view,
     search_view,
     set_reaction,
+    upload_content,
+    upload_notification,
 )
 
 urlpatterns = [
     path("ping", ping, name="ping"),
+    path("metrics", metrics, name="metrics"),
     path("posts/", post_list, name="post_list"),
+    path("feed/home", home_feed, name="home_feed"),
     path("posts/create", create_post, name="create_post"),
     path("posts/comment/<int:post_id>", create_post, name="create_post_comment"),
     path("posts/<int:pk>", post_detail, name="post_detail"),
     path("posts/<int:pk>/comments", comment_list, name="comment_list"),
+    path("posts/<int:pk>/conversation", conversation_view, name="conversation"),
     path("posts/action/<str:action>/<int:post_id>", post_action, name="post_action"),
+    path("posts/likes/state", like_state, name="like_state"),
     path("posts/views/<int:post_id>", register_post_view, name="post_view"),
     path("search", search_view, name="search"),
     path("feedback", get_feedback, name="feedback"),
     path("delete/<int:post_id>", delete_action, name="delete_action"),
     path("post/react/<int:post_id>", set_reaction, name="set_reaction"),
     path("account/posts", account_post_list, name="account_post_list"),
+    path("uploads", create_upload, name="create_upload"),
+    path("uploads/notify", upload_notification, name="upload_notification"),
+    path("uploads/<uuid:upload_id>/content", upload_content, name="upload_content"),
+    path("uploads/<uuid:upload_id>/complete", complete_upload, name="complete_upload"),
 ]
@@ -1,16 +1,43 @@
+import hashlib
+import logging
 import os
+import posixpath
+import re
 import uuid
-from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from urllib.parse import urljoin
+from urllib.parse import unquote, urljoin, urlparse
 
-import blurhash
 from cloudinary.uploader import destroy, upload
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from PIL import Image
 
+from .executor import MediaTaskTimeout, hash_executor, media_executor
+from .hashing import encode_images, prepare_image
+from .images import VARIANT_FORMATS, process_images
+from .models import ImageMedia
+
+# Stored for every image named after its content, see process_and_upload_images
+IMAGE_FIELDS = ["image_url", "image_hash", "width", "height", "variants"]
+
+logger = logging.getLogger(__name__)
+
+# Version segment of Cloudinary delivery URLs, after any transformations
+CLOUDINARY_VERSION_RE = re.compile(r"v\d+")
+
+
+def uses_local_storage():
+    """
+    Whether images go to local storage instead of Cloudinary.
+
+    IMAGE_BACKEND picks "local" or "cloudinary"; unset, local storage is
+    used in DEBUG mode. Local storage is the stand-in for Cloudinary when
+    running everything on one machine.
+    """
+    backend = getattr(settings, "IMAGE_BACKEND", "")
+    return backend == "local" if backend else settings.DEBUG
+
 
 def convert_and_save_image(file, file_name):
     """
@@ -30,32 +57,31 @@ def convert_and_save_image(file, file_name):
     return ContentFile(buffer.getvalue(), name=f"{file_name}.webp")
 
 
-def handle_image_upload(file, file_name, folder=None, request=None, overwrite=True):
+def handle_image_upload(
+    file, file_name, folder=None, request=None, overwrite=True, webp=None
+):
     """
-    Handle image upload either to Cloudinary or local storage based on DEBUG mode.
+    Handle image upload either to Cloudinary or local storage, see uses_local_storage.
     Args:
         file (_file_): The file to upload.
         file_name (str): The file name to use.
         folder (str, optional): The folder where the image should be saved.
         request (HttpRequest, optional): The request object for building URLs (optional).
         overwrite (bool, optional): Whether to overwrite the file in Cloudinary (default: True).
+        webp (bytes, optional): The file already converted to WebP, saved as is locally.
 
     Returns:
         str: The URL of the uploaded image.
     """
-    if settings.DEBUG:
+    if uses_local_storage():
         # Save locally and convert to WebP
-        webp_file = convert_and_save_image(file, file_name)
+        if webp is not None:
+            webp_file = ContentFile(webp, name=f"{file_name}.webp")
+        else:
+            webp_file = convert_and_save_image(file, file_name)
         file_path = os.path.join(folder, webp_file.name) if folder else webp_file.name
         saved_file = default_storage.save(file_path, webp_file)
-        relative_url = default_storage.url(saved_file)
-
-        # Generate absolute URL if `request` is provided
-        if request:
-            file_url = request.build_absolute_uri(relative_url)
-        else:
-            base_url = settings.SITE_URL
-            file_url = urljoin(base_url, relative_url)
+        file_url = build_file_url(saved_file, request)
     else:
         # Cloudinary upload with optimization
         file.seek(0)
@@ -67,39 +93,68 @@ def handle_image_upload(file, file_name, folder=None, request=None, overwrite=Tr
             format="webp",  # Convert to WebP in Cloudinary
             quality="auto",  # Automatically optimize quality based on Cloudinary's algorithms
             resource_type="image",  # Ensure the upload is treated as an image
+            timeout=media_executor.task_timeout,
         )
         file_url = response["secure_url"]
 
     return file_url
 
 
-def upload_profile_image(file, file_name, folder=None, request=None):
+def build_file_url(saved_file, request=None):
+    """Absolute URL of a file in local storage."""
+    relative_url = default_storage.url(saved_file)
+
+    # Generate absolute URL if `request` is provided
+    if request:
+        return request.build_absolute_uri(relative_url)
+    return urljoin(settings.SITE_URL, relative_url)
+
+
+def save_content_file(file_path, content, request=None):
+    """
+    Save a file named after its content to local storage, once.
+
+    Returns:
+        str: The URL of the file.
+    """
+    if not default_storage.exists(file_path):
+        file_path = default_storage.save(file_path, ContentFile(content))
+    return build_file_url(file_path, request)
+
+
+def upload_profile_image(file, file_name, folder=None, request=None, webp=None):
     """
     Upload image to Cloudinary in production or handle locally in development.
     Always name the image after the file_name and overwrite if it exists.
     """
-    return handle_image_upload(file, file_name, folder, request, overwrite=True)
+    return handle_image_upload(
+        file, file_name, folder, request, overwrite=True, webp=webp
+    )
 
 
-def upload_single_image(file, folder=None, request=None):
+def upload_single_image(file, folder=None, request=None, webp=None):
     """
     Upload a single image with a unique name to Cloudinary or handle locally in development.
     """
     unique_name = f"{uuid.uuid4()}"
-    return handle_image_upload(file, unique_name, folder, request, overwrite=False)
+    return handle_image_upload(
+        file, unique_name, folder, request, overwrite=False, webp=webp
+    )
 
 
 def upload_images(files, folder=None, request=None):
     """
     Upload multiple images concurrently to Cloudinary or locally in development.
+
+    Uploads run on the shared media executor, which rejects the whole batch
+    with a 429 when it is saturated.
     """
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(upload_single_image, file, folder, request)
-            for file in files
-        ]
-        results = [future.result() for future in futures]
-    return results
+    return media_executor.map(
+        upload_single_image,
+        files,
+        [folder] * len(files),
+        [request] * len(files),
+    )
 
 
 def get_image_hash(image):
@@ -112,45 +167,285 @@ def get_image_hash(image):
     Returns:
         str: The BlurHash
     """
-    image.seek(0)  # Go to the start of the file
+    return encode_images([prepare_image(image)])[0]
+
+
+def get_variant_widths():
+    return getattr(settings, "IMAGE_VARIANT_WIDTHS", [320, 640, 1080])
+
+
+def content_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def read_files(files):
+    """Read uploads, which cannot be sent to another process, to bytes."""
+    contents = []
+    for file in files:
+        file.seek(0)
+        contents.append(file.read())
+        file.seek(0)
+    return contents
+
+
+def stored_images(digests):
+    """The stored fields of the images already uploaded with these digests."""
+    images = ImageMedia.objects.filter(content_hash__in=digests, status="ready")
+    return {
+        media["content_hash"]: {field: media[field] for field in IMAGE_FIELDS}
+        for media in images.values("content_hash", *IMAGE_FIELDS)
+    }
 
-    # Open the image file
-    image = Image.open(image)
 
-    # Convert image to RGBA if it has a palette with transparency
-    if image.mode == "P" and "transparency" in image.info:
-        image = image.convert("RGBA")
+def cloudinary_variant_url(image_url, width, format):
+    """URL of a Cloudinary image scaled down to ``width`` in ``format``."""
+    base = image_url.rsplit(".", 1)[0]
+    return base.replace("/upload/", f"/upload/c_limit,w_{width}/", 1) + f".{format}"
 
-    # Process the image (e.g., creating a thumbnail)
-    image.thumbnail((100, 100))
 
-    # Generate BlurHash
-    hash = blurhash.encode(image, x_components=4, y_components=3)
-    return hash
+def cloudinary_variants(image, widths):
+    """Variants of an uploaded image, which Cloudinary derives on request."""
+    return [
+        {
+            "url": cloudinary_variant_url(image["image_url"], width, format),
+            "width": width,
+            "height": max(1, round(image["height"] * width / image["width"])),
+            "format": format,
+        }
+        for width in sorted(set(widths), reverse=True)
+        if width < image["width"]
+        for format in VARIANT_FORMATS
+    ]
 
 
-def delete_images_from_cloudinary(image_urls):
+def save_variants(variants, folder, digest, request=None):
+    """Save the variants made by process_images to local storage."""
+    paths = [
+        os.path.join(folder or "", digest, f"{variant['width']}.{variant['format']}")
+        for variant in variants
+    ]
+    urls = media_executor.map(
+        save_content_file,
+        paths,
+        [variant.pop("content") for variant in variants],
+        [request] * len(variants),
+    )
+    for variant, url in zip(variants, urls):
+        variant["url"] = url
+    return variants
+
+
+def process_and_upload_images(files, folder=None, request=None, file_names=None):
     """
-    Delete a list of images from Cloudinary concurrently.
+    Upload images and derive their BlurHash, dimensions and variants.
+
+    Each image is decoded once, in a worker process; Cloudinary uploads run
+    meanwhile, local uploads save the WebP output of that decode.
+
+    Without ``file_names``, images are named after a hash of their content:
+    bytes uploaded before, or twice in the same call, are not processed or
+    stored again but share the stored image. These images also get
+    responsive variants of IMAGE_VARIANT_WIDTHS, made locally or derived by
+    Cloudinary.
+
+    Args:
+        files (list): The image files.
+        folder (str or list, optional): The folder where the images should be
+            saved, or the folder of each image.
+        request (HttpRequest, optional): The request object for building URLs.
+        file_names (list, optional): Names to overwrite, see
+            upload_profile_image (default: content hashes).
+
+    Returns:
+        list: Per image, a dict with its ``image_url``, ``image_hash``,
+        ``width`` and ``height``, and its ``variants`` and ``content_hash``
+        when named after its content.
+    """
+    local = uses_local_storage()
+    contents = read_files(files)
+    folders = folder if isinstance(folder, list) else [folder] * len(files)
+    digests = known = None
+    if file_names is None:
+        digests = [content_digest(content) for content in contents]
+        known = stored_images(digests)
+        todo = {}
+        for index, digest in enumerate(digests):
+            if digest not in known:
+                todo.setdefault(digest, index)
+        indices = list(todo.values())
+        names = list(todo)
+        overwrite, widths = False, get_variant_widths()
+    else:
+        indices = list(range(len(files)))
+        names, overwrite, widths = file_names, True, ()
+
+    images = []
+    if indices:
+        processing = hash_executor.submit(
+            process_images,
+            [[contents[index] for index in indices]],
+            [local],
+            [widths],
+        )
+        folders = [folders[index] for index in indices]
+        requests = [request] * len(indices)
+        if local:
+            # The local upload stores the WebP output, so it waits for it
+            images = processing.results()[0]
+            if digests is None:
+                image_urls = media_executor.map(
+                    upload_profile_image,
+                    [files[index] for index in indices],
+                    names,
+                    folders,
+                    requests,
+                    [image.pop("webp") for image in images],
+                )
+            else:
+                image_urls = media_executor.map(
+                    save_content_file,
+                    [
+                        os.path.join(image_folder or "", f"{name}.webp")
+                        for image_folder, name in zip(folders, names)
+                    ],
+                    [image.pop("webp") for image in images],
+                    requests,
+                )
+        else:
+            image_urls = media_executor.map(
+                handle_image_upload,
+                [files[index] for index in indices],
+                names,
+                folders,
+                requests,
+                [overwrite] * len(indices),
+            )
+            images = processing.results()[0]
+
+        for image, image_url, image_folder, name in zip(
+            images, image_urls, folders, names
+        ):
+            image.pop("webp", None)
+            image["image_url"] = image_url
+            variants = image.pop("variants")
+            if digests is not None:
+                if local:
+                    image["variants"] = save_variants(
+                        variants, image_folder, name, request
+                    )
+                else:
+                    image["variants"] = cloudinary_variants(image, widths)
+                known[name] = image
+
+    if digests is None:
+        return images
+    return [dict(known[digest], content_hash=digest) for digest in digests]
+
+
+def delete_images_from_cloudinary(image_urls, content_hashes=()):
+    """
+    Delete images concurrently, unless other posts still use them, see
+    delete_unused_images. Failures are logged rather than raised.
 
     Args:
         image_urls (list): List of image URLs to delete.
+        content_hashes (iterable, optional): Content hashes of the images.
 
     Returns:
         None
     """
-    if not settings.DEBUG:
+    try:
+        delete_unused_images(image_urls, content_hashes)
+    except MediaTaskTimeout:
+        # The post goes anyway, the images are only left behind
+        logger.warning("Timed out deleting images %s", image_urls)
+    except Exception:
+        logger.exception("Could not delete images %s", image_urls)
+
+
+def delete_unused_images(image_urls, content_hashes=()):
+    """
+    Delete images, and their variants, that no image row uses anymore.
+
+    Images named after their content are shared by every post with the same
+    upload, so whether one is still used is checked when deleting it, after
+    the rows that let go of it are gone.
 
-        def delete_single_image(image_url):
-            # Extract the public ID from the image URL (assuming standard Cloudinary URL structure)
-            public_id = image_url.split("/")[-1].split(".")[0]
+    Args:
+        image_urls (list): URLs of the images to delete.
+        content_hashes (iterable, optional): Content hashes of the images;
+            images without one are never shared.
+
+    Raises:
+        Exception: The first image the backend failed to delete.
+    """
+    in_use = set(
+        ImageMedia.objects.filter(
+            content_hash__in=[digest for digest in content_hashes if digest]
+        ).values_list("image_url", flat=True)
+    )
+    media_executor.map(
+        delete_stored_image, [url for url in image_urls if url not in in_use]
+    )
+
+
+def local_storage_path(image_url):
+    """Name in local storage of a file served at ``image_url``."""
+    path = unquote(urlparse(image_url).path).lstrip("/")
+    prefix = urlparse(settings.MEDIA_URL).path.strip("/")
+    if prefix and path.startswith(f"{prefix}/"):
+        path = path[len(prefix) + 1 :]
+    return path
+
+
+def cloudinary_public_id(image_url):
+    """
+    Public id of the Cloudinary image served at ``image_url``, folders
+    included, e.g. ``posts/<digest>`` for
+    ``https://res.cloudinary.com/<cloud>/image/upload/v123/posts/<digest>.webp``.
+
+    Raises:
+        ValueError: If ``image_url`` is not a versioned Cloudinary upload URL.
+    """
+    path = unquote(urlparse(image_url).path)
+    _, upload, rest = path.partition("/upload/")
+    segments = rest.split("/")
+    versions = [
+        index
+        for index, segment in enumerate(segments)
+        if CLOUDINARY_VERSION_RE.fullmatch(segment)
+    ]
+    if not upload or not versions or versions[0] == len(segments) - 1:
+        raise ValueError(f"Not a Cloudinary upload URL: {image_url}")
+    return posixpath.splitext("/".join(segments[versions[0] + 1 :]))[0]
+
+
+def delete_stored_image(image_url):
+    """
+    Delete an image, and its variants, from Cloudinary or local storage.
+
+    Deleting an image that is already gone is not an error, so this can be
+    retried safely.
+
+    Raises:
+        ValueError: If the URL does not name a Cloudinary image.
+        Exception: If the image backend did not delete the image.
+    """
+    if uses_local_storage():
+        path = local_storage_path(image_url)
+        default_storage.delete(path)
+        # Variants of images named after their content, see save_variants
+        variants = os.path.splitext(path)[0]
+        if default_storage.exists(variants):
+            for name in default_storage.listdir(variants)[1]:
+                default_storage.delete(os.path.join(variants, name))
             try:
-                # Delete the image from Cloudinary using the public ID
-                destroy(public_id)
-            except Exception as e:
-                # Optionally log the error or handle it
-                print(f"Error deleting image {image_url}: {e}")
-
-        # Use ThreadPoolExecutor to delete images concurrently
-        with ThreadPoolExecutor() as executor:
-            executor.map(delete_single_image, image_urls)
+                os.rmdir(default_storage.path(variants))
+            except (NotImplementedError, OSError):
+                pass
+        return
+
+    # Cloudinary drops the derived variants along with the image
+    result = destroy(cloudinary_public_id(image_url), invalidate=True).get("result")
+    if result not in ("ok", "not found"):
+        raise RuntimeError(f"Cloudinary did not delete {image_url}: {result}")
@@ -1,24 +1,81 @@
-from django.db.models import Q
+from datetime import datetime
+
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import generics, status
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+)
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from accounts.graph import follow_graph
 from accounts.models import Account
 from accounts.serializers import BasicAccountSerializer
-
-from .models import ImageMedia, Post, Reaction
-from .serializers import CreatePostSerializer, FeedbackSerializer, PostSerializer
+from accounts.suggestions import suggestion_cache
+from base.utils import (
+    CustomPageNumberPagination,
+    KeysetPagination,
+    SelectablePaginationMixin,
+    decode_cursor,
+    not_modified_response,
+    validated_response,
+)
+
+from . import conversation, uploads
+from .cache import post_etag, serialize_posts
+from .cache import stats as payload_cache_stats
+from .counters import (
+    adjust_post_counter,
+    reaction_histogram,
+    toggle_like,
+    upsert_reaction,
+    view_counter,
+)
+from .executor import hash_executor, media_executor
+from .jobs import enqueue, media_jobs_enabled, queue_stats
+from .models import ImageMedia, Post, Reaction, UploadSession
+from .search import search_accounts, search_posts
+from .serializers import (
+    CreatePostSerializer,
+    FeedbackSerializer,
+    PostSerializer,
+    UploadSessionSerializer,
+)
+from .timeline import home_timeline
 from .utils import delete_images_from_cloudinary
 
+SEARCH_PREVIEW_SIZE = 10
+
 
 @api_view(["GET"])
 def ping(request):
     return Response({"msg": "pong"}, status=status.HTTP_200_OK)
 
 
-class PostList(generics.ListAPIView):
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """Per-process performance counters of this worker."""
+    return Response(
+        {
+            "post_payload_cache": payload_cache_stats.as_dict(),
+            "post_view_counter": view_counter.as_dict(),
+            "media_executor": media_executor.as_dict(),
+            "hash_executor": hash_executor.as_dict(),
+            "follow_graph": follow_graph.as_dict(),
+            "suggestion_cache": suggestion_cache.as_dict(),
+            "jobs": queue_stats(),
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
+class PostList(SelectablePaginationMixin, generics.ListAPIView):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
 
@@ -35,7 +92,23 @@ class PostList(generics.ListAPIView):
 post_list = PostList.as_view()
 
 
-class AccountPostList(generics.ListAPIView):
+class HomeFeed(generics.ListAPIView):
+    """The viewer's materialized home timeline, newest first."""
+
+    permission_classes = [IsAuthenticated]
+    serializer_class = PostSerializer
+    pagination_class = KeysetPagination
+    # Page on the timeline row so each page is a range scan of its index
+    cursor_fields = ("feed_at", "feed_post")
+
+    def get_queryset(self):
+        return home_timeline(self.request.user)
+
+
+home_feed = HomeFeed.as_view()
+
+
+class AccountPostList(SelectablePaginationMixin, generics.ListAPIView):
     serializer_class = PostSerializer
 
     def get_queryset(self):
@@ -54,14 +127,27 @@ account_post_list = AccountPostList.as_view()
 
 
 class PostDetail(generics.RetrieveAPIView):
-    queryset = Post.objects.all()
+    queryset = Post.objects.select_related("parent")
     serializer_class = PostSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        post = self.get_object()
+
+        # Answer conditional requests before doing any serialization
+        etag = post_etag(post, request.user)
+        if etag is not None:
+            not_modified = not_modified_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
+        (data,) = serialize_posts([post], PostSerializer, request.user)
+        return validated_response(request, data, etag)
+
 
 post_detail = PostDetail.as_view()
 
 
-class PostCommentsList(generics.ListAPIView):
+class PostCommentsList(SelectablePaginationMixin, generics.ListAPIView):
     serializer_class = PostSerializer
 
     def get_queryset(self):
@@ -75,6 +161,53 @@ class PostCommentsList(generics.ListAPIView):
 comment_list = PostCommentsList.as_view()
 
 
+@api_view(["GET"])
+def conversation_view(request, pk):
+    """
+    A post with its ancestors and a tree of replies, from one query per level.
+
+    ``depth`` and ``limit`` bound the reply tree; a node's ``replies_cursor``
+    passed back as ``cursor`` to that node's conversation continues its
+    replies.
+    """
+    try:
+        depth = int(request.GET.get("depth", conversation.DEFAULT_DEPTH))
+        size = int(request.GET.get("limit", conversation.DEFAULT_SIZE))
+    except ValueError:
+        return Response(
+            {"error": "depth and limit must be integers."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    depth = max(1, min(depth, conversation.MAX_DEPTH))
+    size = max(1, min(size, conversation.MAX_SIZE))
+
+    after, seen = None, 0
+    cursor = request.GET.get("cursor")
+    if cursor:
+        try:
+            payload = decode_cursor(cursor)
+            if "t" in payload:
+                after = (datetime.fromisoformat(payload["t"]), int(payload["i"]))
+            seen = int(payload["n"])
+        except (KeyError, TypeError, ValueError):
+            raise NotFound("Invalid cursor")
+
+    try:
+        data = conversation.build_conversation(
+            pk,
+            PostSerializer,
+            viewer=request.user,
+            depth=depth,
+            size=size,
+            after=after,
+            seen=seen,
+            ancestors=not cursor,
+        )
+    except Post.DoesNotExist:
+        return Response({"error": "Post not found."}, status=status.HTTP_404_NOT_FOUND)
+    return Response(data, status=status.HTTP_200_OK)
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def create_post(request, post_id=None):
@@ -96,61 +229,204 @@ def create_post(request, post_id=None):
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
-def post_action(request, action, post_id):
-    user = request.user
+def create_upload(request):
+    """
+    Start a direct upload: the response's ``upload`` says where to send the
+    bytes, then complete_upload and attach the session by id.
+    """
+    serializer = UploadSessionSerializer(
+        data=request.data, context={"request": request}
+    )
+    if serializer.is_valid():
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def complete_upload(request, upload_id):
+    session = get_object_or_404(UploadSession, id=upload_id, owner=request.user)
+    try:
+        uploads.finish_upload(session)
+    except uploads.UploadError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_409_CONFLICT)
+    return Response(
+        UploadSessionSerializer(session, context={"request": request}).data,
+        status=status.HTTP_200_OK,
+    )
+
+
+@api_view(["PUT"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def upload_content(request, upload_id):
+    """Upload target of the local emulator of direct uploads, see LocalUploadStorage."""
+    storage = uploads.upload_storage()
+    if storage is not uploads.local_uploads:
+        raise NotFound()
+    if not storage.verify(upload_id, request.query_params.get("token", "")):
+        return Response(
+            {"detail": "Invalid or expired upload URL."},
+            status=status.HTTP_403_FORBIDDEN,
+        )
+    session = get_object_or_404(UploadSession, id=upload_id, status="pending")
+    if session.expires_at <= timezone.now():
+        return Response(
+            {"detail": "The upload session has expired."}, status=status.HTTP_410_GONE
+        )
+    if request.content_type != session.content_type:
+        return Response(
+            {"detail": f"Expected {session.content_type} content."},
+            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        )
+    if int(request.META.get("CONTENT_LENGTH") or 0) > session.size:
+        return Response(
+            {"detail": "The upload is larger than declared."},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
     try:
-        post = Post.objects.get(id=post_id)
-    except Exception as e:
-        return Response(str(e), status=status.HTTP_404_NOT_FOUND)
+        storage.receive(session, request.stream)
+        uploads.finish_upload(session)
+    except uploads.UploadError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def upload_notification(request):
+    """Cloudinary's notification of a direct upload, see CloudinaryUploadStorage."""
+    storage = uploads.upload_storage()
+    if storage is not uploads.cloudinary_uploads:
+        raise NotFound()
+    body = request.body.decode()
+    if not storage.verify_notification(
+        body,
+        request.headers.get("X-Cld-Timestamp", 0),
+        request.headers.get("X-Cld-Signature", ""),
+    ):
+        return Response(
+            {"detail": "Invalid signature."}, status=status.HTTP_403_FORBIDDEN
+        )
+    session = storage.notified_session(body)
+    if session is not None:
+        try:
+            uploads.finish_upload(session)
+        except uploads.UploadError:
+            # The client's completion callback reports it
+            pass
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def post_action(request, action, post_id):
+    if not Post.objects.filter(id=post_id).exists():
+        return Response("Post not found.", status=status.HTTP_404_NOT_FOUND)
     if action == "like":
-        if user in post.likes.all():
-            post.likes.remove(user)
-        else:
-            post.likes.add(user)
-        post.save()
+        try:
+            liked, likes_count = toggle_like(post_id, request.user.id)
+        except Post.DoesNotExist:
+            return Response("Post not found.", status=status.HTTP_404_NOT_FOUND)
     else:
         return Response(
             {"msg": "No action provided"}, status=status.HTTP_400_BAD_REQUEST
         )
 
-    return Response({"msg": "Updated"}, status=status.HTTP_200_OK)
+    return Response(
+        {"msg": "Updated", "liked": liked, "likes_count": likes_count},
+        status=status.HTTP_200_OK,
+    )
 
 
 @api_view(["POST"])
-def register_post_view(request, post_id):
+@permission_classes([IsAuthenticated])
+def like_state(request):
+    """
+    Return the viewer's like and reaction state of up to 100 posts.
+
+    Lets clients fill in the per-viewer fields of posts they already have,
+    e.g. from a cached feed, with a single query.
+    """
+    post_ids = request.data.get("ids")
+    if not isinstance(post_ids, list) or len(post_ids) > 100:
+        return Response(
+            {"error": "ids must be a list of at most 100 post ids."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
     try:
-        post = Post.objects.get(id=post_id)
-        post.views += 1
-        post.save()
-        return Response({"msg": "success"}, status=status.HTTP_200_OK)
-    except Exception:
+        post_ids = [int(post_id) for post_id in post_ids]
+    except (TypeError, ValueError):
+        return Response(
+            {"error": "ids must be a list of at most 100 post ids."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    rows = (
+        Post.objects.filter(id__in=post_ids)
+        .with_viewer_state(request.user)
+        .values_list("id", "viewer_liked", "viewer_reaction")
+    )
+    return Response(
+        [
+            {"id": pk, "is_liked": is_liked, "reaction": reaction}
+            for pk, is_liked, reaction in rows
+        ],
+        status=status.HTTP_200_OK,
+    )
+
+
+@api_view(["POST"])
+def register_post_view(request, post_id):
+    if not Post.objects.filter(id=post_id).exists():
         return Response({"msg": "error"}, status=status.HTTP_400_BAD_REQUEST)
+    # Written in bulk by the view counter's periodic flush
+    view_counter.record(post_id)
+    return Response({"msg": "success"}, status=status.HTTP_200_OK)
 
 
 @api_view(["GET"])
 def search_view(request):
-    search_term = request.GET.get("q")
-
-    if search_term:
-        # Search in Post model for content containing the search term
-        post_results = Post.objects.filter(Q(content__icontains=search_term))
-
-        # Search in Account model for username or name containing the search term
-        account_results = Account.objects.filter(
-            Q(username__icontains=search_term) | Q(name__icontains=search_term)
+    """
+    Ranked full-text search over posts and accounts.
+
+    Without ``type`` the best ``SEARCH_PREVIEW_SIZE`` posts and accounts are
+    returned together; ``type=posts`` or ``type=accounts`` pages through one
+    of them.
+    """
+    search_term = request.GET.get("q", "").strip()
+    if not search_term:
+        return Response(
+            {"error": "No search term provided."}, status=status.HTTP_400_BAD_REQUEST
         )
 
-        # Serialize the results (assume you have PostSerializer and AccountSerializer)
-        post_serializer = PostSerializer(post_results, many=True)
-        account_serializer = BasicAccountSerializer(account_results, many=True)
-
-        return Response(
-            {"posts": post_serializer.data, "accounts": account_serializer.data},
-            status=status.HTTP_200_OK,
+    context = {"request": request}
+    search_type = request.GET.get("type")
+    if search_type == "posts":
+        paginator = CustomPageNumberPagination()
+        page = paginator.paginate_queryset(search_posts(search_term), request)
+        return paginator.get_paginated_response(
+            PostSerializer(page, many=True, context=context).data
+        )
+    if search_type == "accounts":
+        paginator = CustomPageNumberPagination()
+        page = paginator.paginate_queryset(search_accounts(search_term), request)
+        return paginator.get_paginated_response(
+            BasicAccountSerializer(page, many=True, context=context).data
         )
 
+    post_results = search_posts(search_term)[:SEARCH_PREVIEW_SIZE]
+    account_results = search_accounts(search_term)[:SEARCH_PREVIEW_SIZE]
     return Response(
-        {"error": "No search term provided."}, status=status.HTTP_400_BAD_REQUEST
+        {
+            "posts": PostSerializer(post_results, many=True, context=context).data,
+            "accounts": BasicAccountSerializer(
+                account_results, many=True, context=context
+            ).data,
+        },
+        status=status.HTTP_200_OK,
     )
 
 
@@ -176,16 +452,28 @@ def delete_action(request, post_id):
             status=status.HTTP_403_FORBIDDEN,
         )
 
-    # Get associated images from the ImageMedia model
-    images = ImageMedia.objects.filter(post=post)
-    image_urls = [image.image_url for image in images]
-
-    # Call the function to delete images from Cloudinary concurrently
-    delete_images_from_cloudinary(image_urls)
-
-    # Delete the post and associated images from the database
-    images.delete()
-    post.delete()
+    # Delete the post and associated images from the database, and the
+    # stored images once it is gone, or leave them to a job
+    background = media_jobs_enabled()
+    with transaction.atomic():
+        images = list(ImageMedia.objects.filter(post=post))
+        image_urls = [image.image_url for image in images if image.image_url]
+        content_hashes = [image.content_hash for image in images]
+        if background and image_urls:
+            enqueue(
+                "media.delete_images",
+                {"image_urls": image_urls, "content_hashes": content_hashes},
+            )
+        ImageMedia.objects.filter(post=post).delete()
+        post.delete()
+        if post.parent_id:
+            adjust_post_counter(post.parent_id, "replies_count", -1)
+        if post.original_post_id:
+            adjust_post_counter(post.original_post_id, "retweets_count", -1)
+
+    if not background:
+        # Images other posts share are kept, see delete_unused_images
+        delete_images_from_cloudinary(image_urls, content_hashes)
 
     return Response(
         {"detail": "Post and associated images deleted successfully."},
@@ -195,31 +483,26 @@ def delete_action(request, post_id):
 
 @api_view(["POST"])
 def set_reaction(request, post_id):
-    user = request.user
     emoji_name = request.data.get("emoji_name")
 
     if not emoji_name:
         return Response(
             {"error": "Emoji name is required."}, status=status.HTTP_400_BAD_REQUEST
         )
+    if emoji_name not in dict(Reaction.REACTION_CHOICES):
+        return Response(
+            {"error": "Unknown emoji name."}, status=status.HTTP_400_BAD_REQUEST
+        )
 
     try:
-        post = Post.objects.get(id=post_id)
+        reaction_counts = upsert_reaction(post_id, request.user.id, emoji_name)
     except Post.DoesNotExist:
         return Response({"error": "Post not found."}, status=status.HTTP_404_NOT_FOUND)
 
-    try:
-        # Check if the user already has a reaction on the post and remove it
-        Reaction.objects.filter(user=user, post=post).delete()
-
-        # Create a new reaction with the provided emoji
-        new_reaction = Reaction.objects.create(user=user, post=post, emoji=emoji_name)
-        new_reaction.save()
-        total_reactions = Reaction.objects.filter(post=post, emoji=emoji_name).count()
-        return Response(data=total_reactions, status=status.HTTP_200_OK)
-
-    except Exception as e:
-        return Response(
-            {"error": "Failed to update reaction.", "details": str(e)},
-            status=status.HTTP_400_BAD_REQUEST,
-        )
+    return Response(
+        {
+            "reaction": emoji_name,
+            "post_reactions": reaction_histogram(reaction_counts),
+        },
+        status=status.HTTP_200_OK,
+    )
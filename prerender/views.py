@@ -1,10 +1,35 @@
 from django.core.paginator import Paginator
-from django.db.models import Q
 from django.shortcuts import get_object_or_404, render
 from django.template.defaultfilters import truncatechars
+from django.views.decorators.http import condition
 
 from accounts.models import Account
+from main.cache import account_etag, post_etag, versions_etag
 from main.models import Post
+from main.search import search_accounts, search_posts
+
+
+def profile_etag(request, username):
+    account = Account.objects.filter(username=username).only("updated_at").first()
+    return account_etag(account) if account else None
+
+
+def post_detail_etag(request, post_id):
+    post = Post.objects.select_related("parent").filter(id=post_id).first()
+    if post is None:
+        return None
+    # The page also renders every reply with its author, likes and views
+    replies = list(
+        Post.objects.filter(parent_id=post_id).values_list(
+            "id", "author_id", "views", "likes_count"
+        )
+    )
+    replies_etag = versions_etag(
+        post_ids=[reply[0] for reply in replies],
+        account_ids=[reply[1] for reply in replies],
+        extra=replies,
+    )
+    return post_etag(post, extra=(replies_etag,))
 
 
 def index(request):
@@ -25,8 +50,11 @@ def index(request):
     return render(request, "main/index.html", context=context)
 
 
+@condition(etag_func=profile_etag)
 def profile_view(request, username):
-    account = get_object_or_404(Account, username=username)
+    account = get_object_or_404(
+        Account.objects.select_related("stats"), username=username
+    )
     desc = f"Discover valuable insights, expertise, and contributions from {account.name} (@{account.username}) on Alloqet. Connect, learn, and engage with their latest posts and activities."
     if account.bio and account.bio.strip():
         desc = account.bio.strip()
@@ -41,6 +69,7 @@ def profile_view(request, username):
     return render(request, "main/profile.html", context=context)
 
 
+@condition(etag_func=post_detail_etag)
 def post_detail_view(request, post_id):
     post = get_object_or_404(Post, id=post_id)
 
@@ -79,15 +108,9 @@ def search_view(request):
     results = False
 
     if query:
-        # Search posts by content and accounts by name or username
-        posts = Post.objects.filter(
-            Q(content__icontains=query) | Q(author__username__icontains=query)
-        )[:5]
-        accounts = Account.objects.filter(
-            Q(name__icontains=query)
-            | Q(username__icontains=query)
-            | Q(bio__icontains=query)
-        )[:5]
+        # Best matching posts and accounts, ranked by the search backend
+        posts = list(search_posts(query).select_related("author")[:5])
+        accounts = list(search_accounts(query)[:5])
     if posts or accounts:
         results = True
     # Set title and description based on the search query